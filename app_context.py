@@ -0,0 +1,143 @@
+"""
+Контекст приложения: единственные экземпляры общих ресурсов.
+
+База данных, исходящий диспетчер, кэш и реестр метрик создаются здесь
+один раз (лениво) и передаются боту, планировщику отчетов и системе
+почасовых push-уведомлений.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict
+
+from metrics import MetricsRegistry
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Общий LRU-кэш со временем жизни записей"""
+
+    def __init__(self, max_size: int = 10000, default_ttl: float = 300, metrics: MetricsRegistry = None):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        # ключ -> (истекает в, значение)
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+
+    def get(self, key, default=None):
+        """Значение по ключу или default, если его нет или оно устарело"""
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING and item[0] > time.monotonic():
+                self._data.move_to_end(key)
+                hit = True
+            else:
+                if item is not _MISSING:
+                    del self._data[key]
+                hit = False
+
+        if self.metrics is not None:
+            self.metrics.inc('cache_requests_total', result='hit' if hit else 'miss')
+        return item[1] if hit else default
+
+    def set(self, key, value, ttl: float = None):
+        """Сохранение значения"""
+        expires_at = time.monotonic() + (ttl if ttl is not None else self.default_ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """Удаление значения"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_prefix(self, prefix: tuple):
+        """Удаление всех ключей-кортежей, начинающихся с prefix"""
+        with self._lock:
+            for key in [key for key in self._data if isinstance(key, tuple) and key[:len(prefix)] == prefix]:
+                del self._data[key]
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class AppContext:
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or os.getenv('DATABASE_PATH', 'bot_database.db')
+        self.bot = None
+        self.metrics = MetricsRegistry()
+        self.cache = TTLCache(
+            max_size=int(os.getenv('APP_CACHE_SIZE', '10000')),
+            default_ttl=float(os.getenv('APP_CACHE_TTL', '300')),
+            metrics=self.metrics
+        )
+        self._db = None
+        self._outbound = None
+        self._habit_render_model = None
+        self._habit_analytics = None
+        self._lock = threading.Lock()
+
+    def bind_bot(self, bot):
+        """Привязка экземпляра бота (нужен исходящему диспетчеру)"""
+        self.bot = bot
+        self._outbound = None
+
+    @property
+    def db(self):
+        """Единственный экземпляр базы данных"""
+        if self._db is None:
+            with self._lock:
+                if self._db is None:
+                    from database import Database
+                    self._db = Database(self.db_path, cache=self.cache, metrics=self.metrics)
+        return self._db
+
+    @property
+    def outbound(self):
+        """Исходящий диспетчер сообщений"""
+        if self._outbound is None:
+            if self.bot is None:
+                raise RuntimeError("Bot is not bound to the application context")
+            from outbound import OutboundDispatcher
+            self._outbound = OutboundDispatcher(self.bot, self.metrics)
+        return self._outbound
+
+    @property
+    def habit_render_model(self):
+        """Модель отображения привычек в памяти"""
+        if self._habit_render_model is None:
+            from habit_render import HabitRenderModel
+            self._habit_render_model = HabitRenderModel(self.db)
+        return self._habit_render_model
+
+    @property
+    def habit_analytics(self):
+        """Аналитика привычек: серии, проценты выполнения, тепловая карта"""
+        if self._habit_analytics is None:
+            from habit_analytics import HabitAnalytics
+            self._habit_analytics = HabitAnalytics(self.db)
+        return self._habit_analytics
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Использование общих ресурсов"""
+        return {
+            'db_path': self.db_path,
+            'cache_size': len(self.cache),
+            'cache_hits': int(self.metrics.get_counter('cache_requests_total', result='hit')),
+            'cache_misses': int(self.metrics.get_counter('cache_requests_total', result='miss')),
+            'outbound': self._outbound.get_stats() if self._outbound else {},
+        }
+
+
+# Глобальный контекст приложения (ресурсы создаются при первом обращении)
+app_context = AppContext()
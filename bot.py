@@ -1,10 +1,15 @@
 import asyncio
 import logging
 import sqlite3
+import time
 from datetime import datetime, date
 from typing import Dict, Optional
 
+# Профиль запуска импортируется раньше тяжелых библиотек, чтобы замерить их импорт
+from startup_profile import startup_profile
+
 from aiogram import Bot, Dispatcher, F, types
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -13,15 +18,25 @@ from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardBu
 from dotenv import load_dotenv
 import os
 
-from database import Database
-from openai_service import OpenAIService
+from app_context import app_context
+from openai_service import OpenAIService, openai_service
 from scheduler import ReportScheduler
 from reminder_system import start_habit_reminders, stop_habit_reminders, start_daily_reminder_check, active_reminders
 from hourly_push_system import HourlyPushSystem
+from llm_queue import llm_job_queue, PRIORITY_GENERATE, PRIORITY_REGENERATE
+from event_reminders import event_reminder_engine
+from metrics import start_metrics_server
+from tracing import tracer
+from loop_watchdog import loop_watchdog
+from sampling_profiler import sampling_profiler, format_profile_summary
+from habit_analytics import format_weekday_heatmap
+from recurrence import parse_rule, RULE_DAILY, RULE_EVERY_OTHER_DAY, RULE_WEEKDAYS, RULE_WEEKLY, RULE_MONTHLY
 
 # Загружаем переменные окружения
 load_dotenv()
 
+startup_profile.mark("imports")
+
 
 async def safe_callback_answer(callback, text=None):
     """Безопасная обертка для callback.answer() с обработкой ошибок"""
@@ -37,6 +52,15 @@ async def safe_callback_answer(callback, text=None):
 # Константы
 CORRECT_BOT_USERNAME = "Alteria_8_bot"
 
+# ID администраторов (в реальности нужна более надежная проверка)
+ADMIN_IDS = [123456789]  # Замените на реальные ID администраторов
+
+# Не чаще одного edit_text в секунду при потоковой генерации визитки
+STREAM_EDIT_INTERVAL = 1.0
+# Попыток итоговой правки при flood control (с ожиданием retry_after)
+STREAM_FINAL_EDIT_ATTEMPTS = 3
+TELEGRAM_MESSAGE_LIMIT = 4096
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -47,16 +71,99 @@ if not BOT_TOKEN:
     logger.error("BOT_TOKEN not found in environment variables")
     raise ValueError("BOT_TOKEN is required")
 
-bot = Bot(token=BOT_TOKEN)
+# Свой сервер Bot API: локальный telegram-bot-api или fake_telegram_server.py для нагрузочных тестов
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+if TELEGRAM_API_URL:
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=BOT_TOKEN)
+# Спан на каждый вызов Bot API внутри трассы запроса
+bot.session.middleware(tracer.request_middleware)
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 
+# Общий контекст приложения: одна база, кэш, метрики и исходящий диспетчер
+app_context.bind_bot(bot)
+
 # Инициализация базы данных
-db = Database()
+db = app_context.db
+
+# Модель отображения привычек в памяти
+habit_render_model = app_context.habit_render_model
+
+# Аналитика привычек (кэш до следующей отметки)
+habit_analytics = app_context.habit_analytics
 
 # Глобальный планировщик
 scheduler = None
 
+startup_profile.mark("bot, dispatcher, database")
+
+
+@dp.update.outer_middleware()
+async def startup_profile_middleware(handler, event, data):
+    """Замер времени до первого апдейта после запуска"""
+    if startup_profile.first_update_after is None:
+        startup_profile.on_first_update()
+    return await handler(event, data)
+
+@dp.update.outer_middleware()
+async def user_activity_middleware(handler, event, data):
+    """Отметка активности пользователя для DAU/WAU/MAU (запись — раз в день на пользователя)"""
+    user = data.get('event_from_user')
+    if user is not None:
+        db.record_user_activity(user.id)
+    return await handler(event, data)
+
+# Префиксы callback_data, уже ставшие метками: ограничивает число рядов метрик
+_callback_prefixes = set()
+MAX_CALLBACK_PREFIXES = 200
+
+def callback_prefix(callback_data: Optional[str]) -> str:
+    """Префикс callback_data без идентификаторов: event_detail_12 -> event_detail"""
+    parts = []
+    for part in (callback_data or "").split("_"):
+        if any(char.isdigit() for char in part):
+            break
+        parts.append(part)
+    prefix = "_".join(parts) or "other"
+    if prefix not in _callback_prefixes:
+        if len(_callback_prefixes) >= MAX_CALLBACK_PREFIXES:
+            return "other"
+        _callback_prefixes.add(prefix)
+    return prefix
+
+async def handler_metrics_middleware(handler, event, data):
+    """Длительность и ошибки обработчиков: telegram_handler_seconds{handler, prefix}"""
+    labels = {'handler': data['handler'].callback.__name__}
+    if isinstance(event, types.CallbackQuery):
+        labels['prefix'] = callback_prefix(event.data)
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        app_context.metrics.inc('telegram_handler_errors_total', **labels)
+        raise
+    finally:
+        app_context.metrics.observe('telegram_handler_seconds', time.perf_counter() - started, **labels)
+
+async def tracing_middleware(handler, event, data):
+    """Корневой спан трассы на апдейт: база и Bot API внутри обработчика станут его дочерними спанами"""
+    if not tracer.enabled:
+        return await handler(event, data)
+    attrs = {'user_id': event.from_user.id if event.from_user else None}
+    if isinstance(event, types.CallbackQuery):
+        attrs['callback_data'] = event.data
+    with tracer.trace(f"handler.{data['handler'].callback.__name__}", **attrs):
+        return await handler(event, data)
+
+dp.message.middleware(tracing_middleware)
+dp.callback_query.middleware(tracing_middleware)
+dp.message.middleware(handler_metrics_middleware)
+dp.callback_query.middleware(handler_metrics_middleware)
+
 # Состояния для FSM
 class OnboardingStates(StatesGroup):
     waiting_for_first_name = State()
@@ -96,6 +203,7 @@ class CalendarStates(StatesGroup):
     waiting_for_event_time = State()
     waiting_for_event_type = State()
     waiting_for_reminder_time = State()
+    waiting_for_event_recurrence = State()
 
 # Клавиатуры
 def get_main_menu_keyboard():
@@ -220,42 +328,37 @@ def get_habit_type_keyboard():
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
             [InlineKeyboardButton(text="📅 Ежедневная", callback_data="habit_type_daily")],
+            [InlineKeyboardButton(text="🗓 По будням", callback_data="habit_type_weekdays")],
+            [InlineKeyboardButton(text="🔁 Через день", callback_data="habit_type_every_other_day")],
             [InlineKeyboardButton(text="📆 Еженедельная", callback_data="habit_type_weekly")],
             [InlineKeyboardButton(text="🔧 Настраиваемая", callback_data="habit_type_custom")]
         ]
     )
     return keyboard
 
+def format_habit_button_text(habit):
+    """Текст кнопки привычки в списке"""
+    habit_name = habit['habit_name']
+    
+    # Формируем отображение с молнией и галочкой в разные стороны
+    if habit['is_active']:
+        completed_today = habit.get('today_count', 0) or 0  # Защита от None
+        target_frequency = habit.get('target_frequency', 1) or 1  # Защита от None
+        # Центрированное форматирование с равномерными пробелами
+        spaces_before = " " * max(0, (20 - len(habit_name)) // 2)
+        spaces_after = " " * max(0, 20 - len(habit_name) - len(spaces_before))
+        return f"{target_frequency} ⚡{spaces_before}{habit_name}{spaces_after}✅ {completed_today}"
+    
+    spaces = " " * max(0, (25 - len(habit_name)) // 2)
+    return f"⏸️{spaces}{habit_name}{spaces}"
+
 def get_habits_list_keyboard(habits):
-    """Клавиатура со списком привычек пользователя"""
+    """Клавиатура со списком привычек пользователя (строки модели отображения)"""
     keyboard_buttons = []
     
     for habit in habits:
-        # Получаем статистику за сегодня
-        from datetime import date
-        today = date.today()
-        
-        # Получаем количество выполнений за сегодня из базы данных
-        habit_stats = db.get_habit_stats(habit['user_id'], habit['habit_id'], days=1)
-        completed_today = habit_stats.get('completed_count', 0) or 0  # Защита от None
-        target_frequency = habit.get('target_frequency', 1) or 1  # Защита от None
-        
-        # Формируем отображение с молнией и галочкой в разные стороны
-        if habit['is_active']:
-            # Центрированное форматирование с равномерными пробелами
-            habit_name = habit['habit_name']
-            # Добавляем пробелы для центрирования
-            spaces_before = " " * max(0, (20 - len(habit_name)) // 2)
-            spaces_after = " " * max(0, 20 - len(habit_name) - len(spaces_before))
-            text = f"{target_frequency} ⚡{spaces_before}{habit_name}{spaces_after}✅ {completed_today}"
-            status_emoji = "🟢" if completed_today >= target_frequency else "🟡"
-        else:
-            habit_name = habit['habit_name']
-            spaces = " " * max(0, (25 - len(habit_name)) // 2)
-            text = f"⏸️{spaces}{habit_name}{spaces}"
-            status_emoji = "⏸️"
         button = InlineKeyboardButton(
-            text=text,
+            text=format_habit_button_text(habit),
             callback_data=f"habit_detail_{habit['habit_id']}"
         )
         keyboard_buttons.append([button])
@@ -269,6 +372,104 @@ def get_habits_list_keyboard(habits):
     keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
     return keyboard
 
+def markup_signature(markup):
+    """Видимое содержимое клавиатуры для сравнения"""
+    if not markup:
+        return ()
+    return tuple(
+        tuple((button.text, button.callback_data, button.url) for button in row)
+        for row in markup.inline_keyboard
+    )
+
+async def render_view(message, text, reply_markup, parse_mode="Markdown"):
+    """Отрисовка экрана с минимальным изменением сообщения.
+    
+    Ничего не отправляет, если видимых изменений нет; если поменялась
+    только клавиатура — вызывает edit_message_reply_markup.
+    """
+    view_key = (message.chat.id, message.message_id)
+    new_signature = markup_signature(reply_markup)
+    current = (message.text, markup_signature(message.reply_markup))
+    
+    diff = habit_render_model.diff_view(view_key, text, new_signature, current)
+    
+    if diff == 'full':
+        result = await message.edit_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+    elif diff == 'markup':
+        result = await message.edit_reply_markup(reply_markup=reply_markup)
+    else:
+        return diff
+    
+    observed = None
+    if isinstance(result, types.Message):
+        observed = (result.text, markup_signature(result.reply_markup))
+    habit_render_model.remember_view(view_key, text, new_signature, observed)
+    return diff
+
+async def stream_to_message(message, chunks, header: str, reply_markup=None) -> Optional[str]:
+    """Постепенный вывод потоковой генерации в сообщение.
+    
+    Промежуточные версии отправляются без разметки (незакрытый Markdown
+    ломает edit_text), итоговая — с Markdown и клавиатурой.
+    """
+    text = ""
+    last_sent = None
+    last_edit_at = 0.0
+    
+    try:
+        async for delta in chunks:
+            text += delta
+            now = time.monotonic()
+            if now - last_edit_at < STREAM_EDIT_INTERVAL:
+                continue
+            
+            preview = (header + text)[:TELEGRAM_MESSAGE_LIMIT - 2] + " ▌"
+            if preview == last_sent:
+                continue
+            try:
+                await message.edit_text(preview)
+                last_sent = preview
+            except Exception as e:
+                # Flood control или устаревшее сообщение — пропускаем кадр
+                logger.warning(f"Stream edit skipped: {e}")
+            last_edit_at = now
+    except Exception as e:
+        logger.error(f"Streaming generation failed: {e}")
+        return None
+    
+    text = text.strip()
+    if not text:
+        return None
+    
+    # Итоговая правка — не раньше интервала после последнего кадра, иначе flood control
+    delay = last_edit_at + STREAM_EDIT_INTERVAL - time.monotonic()
+    if delay > 0:
+        await asyncio.sleep(delay)
+    
+    final_text = (header + text)[:TELEGRAM_MESSAGE_LIMIT]
+    try:
+        await edit_text_with_retry(message, final_text, reply_markup=reply_markup, parse_mode="Markdown")
+    except Exception as e:
+        # Модель могла вернуть некорректный Markdown — показываем как есть
+        logger.warning(f"Markdown edit failed, sending plain text: {e}")
+        try:
+            await edit_text_with_retry(message, final_text, reply_markup=reply_markup)
+        except Exception as e:
+            # Текст сгенерирован — его сохраняет вызывающий код, даже если сообщение не обновилось
+            logger.error(f"Final stream edit failed: {e}")
+    return text
+
+async def edit_text_with_retry(message, text: str, attempts: int = STREAM_FINAL_EDIT_ATTEMPTS, **kwargs):
+    """edit_text с ожиданием retry_after при flood control"""
+    for attempt in range(1, attempts + 1):
+        try:
+            return await message.edit_text(text, **kwargs)
+        except TelegramRetryAfter as e:
+            if attempt == attempts:
+                raise
+            logger.warning(f"Flood control on edit, retry in {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+
 def get_habit_detail_keyboard(habit_id, is_active=True):
     """Клавиатура для детального просмотра привычки"""
     keyboard_buttons = []
@@ -348,8 +549,21 @@ def get_reminder_time_keyboard():
     )
     return keyboard
 
-def get_events_list_keyboard(events):
-    """Клавиатура со списком событий"""
+def get_event_recurrence_keyboard():
+    """Клавиатура выбора повторения события"""
+    keyboard = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="Каждый день", callback_data="recurrence_daily")],
+            [InlineKeyboardButton(text="По будням", callback_data="recurrence_weekdays")],
+            [InlineKeyboardButton(text="Каждую неделю", callback_data="recurrence_weekly")],
+            [InlineKeyboardButton(text="Каждый месяц", callback_data="recurrence_monthly")],
+            [InlineKeyboardButton(text="Не повторять", callback_data="recurrence_none")]
+        ]
+    )
+    return keyboard
+
+def get_events_list_keyboard(events, navigation=None):
+    """Клавиатура со списком событий (navigation — ряд кнопок листания)"""
     keyboard_buttons = []
     
     for event in events:
@@ -368,12 +582,17 @@ def get_events_list_keyboard(events):
         }.get(event['event_type'], '📝')
         
         text = f"{type_emoji} {event['event_title']} ({start_time})"
+        if event['status'] == 'completed':
+            text = f"✅ {text}"
         button = InlineKeyboardButton(
             text=text[:50] + "..." if len(text) > 50 else text,
-            callback_data=f"event_detail_{event['event_id']}"
+            callback_data=f"event_detail_{event_callback_suffix(event)}"
         )
         keyboard_buttons.append([button])
     
+    if navigation:
+        keyboard_buttons.append(navigation)
+    
     # Добавляем кнопки управления
     keyboard_buttons.append([
         InlineKeyboardButton(text="➕ Добавить", callback_data="add_event"),
@@ -383,16 +602,41 @@ def get_events_list_keyboard(events):
     keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
     return keyboard
 
-def get_event_detail_keyboard(event_id):
-    """Клавиатура для детального просмотра события"""
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
+def event_callback_suffix(event) -> str:
+    """<event_id> разового события или <event_id>_<ГГГГММДДЧЧММ> вхождения повторяющегося"""
+    if not event.get('recurrence_rule'):
+        return str(event['event_id'])
+    stamp = datetime.fromisoformat(event['start_datetime']).strftime("%Y%m%d%H%M")
+    return f"{event['event_id']}_{stamp}"
+
+def parse_event_callback(callback_data: str):
+    """event_id и начало вхождения (или None) из event_<действие>_<event_id>[_<ГГГГММДДЧЧММ>]"""
+    parts = callback_data.split("_")
+    occurrence_start = None
+    if len(parts) > 3:
+        occurrence_start = datetime.strptime(parts[3], "%Y%m%d%H%M").isoformat(sep=' ')
+    return int(parts[2]), occurrence_start
+
+def get_event_detail_keyboard(event_id, occurrence_suffix=None, is_series=False):
+    """Клавиатура для детального просмотра события (вхождения, если передан occurrence_suffix)"""
+    if occurrence_suffix:
+        # Действия над одним вхождением серии; вся серия удаляется только с подтверждением
+        inline_keyboard = [
+            [InlineKeyboardButton(text="✅ Выполнено (только это)", callback_data=f"event_complete_{occurrence_suffix}")],
+            [InlineKeyboardButton(text="❌ Отменить только это", callback_data=f"event_cancel_{occurrence_suffix}")],
+            [InlineKeyboardButton(text="🗑 Удалить всю серию", callback_data=f"series_delete_{event_id}")]
+        ]
+    elif is_series:
+        inline_keyboard = [
+            [InlineKeyboardButton(text="🗑 Удалить всю серию", callback_data=f"series_delete_{event_id}")]
+        ]
+    else:
+        inline_keyboard = [
             [InlineKeyboardButton(text="✅ Отметить выполненным", callback_data=f"event_complete_{event_id}")],
-            [InlineKeyboardButton(text="❌ Отменить событие", callback_data=f"event_cancel_{event_id}")],
-            [InlineKeyboardButton(text="🔙 К списку", callback_data="all_events")]
+            [InlineKeyboardButton(text="❌ Отменить событие", callback_data=f"event_cancel_{event_id}")]
         ]
-    )
-    return keyboard
+    inline_keyboard.append([InlineKeyboardButton(text="🔙 К списку", callback_data="all_events")])
+    return InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
 
 # Обработчики команд
 @dp.message(Command("start"))
@@ -411,9 +655,8 @@ async def cmd_start(message: types.Message, state: FSMContext):
     if message.text and len(message.text.split()) > 1:
         start_param = message.text.split()[1]
         logger.info(f"Start parameter: '{start_param}'")
-        if start_param.startswith('REF_'):
-            referral_code = start_param
-            logger.info(f"Referral code found: '{referral_code}'")
+        # Новые коды декодируются без запроса, старые ищутся по таблице алиасов
+        referral_code = start_param
     
     # Проверяем, есть ли пользователь в базе
     user = db.get_user(user_id)
@@ -423,12 +666,9 @@ async def cmd_start(message: types.Message, state: FSMContext):
         # Создаем нового пользователя
         referrer_id = None
         if referral_code:
-            # Ищем пользователя по реферальному коду
-            referrer = db.get_user_by_referral_code(referral_code)
-            logger.info(f"Referrer found: {referrer}")
-            if referrer:
-                referrer_id = referrer['user_id']
-                logger.info(f"Referrer ID: {referrer_id}")
+            # Определяем реферера по реферальному коду
+            referrer_id = db.resolve_referral_code(referral_code)
+            logger.info(f"Referrer ID: {referrer_id}")
         
         db.create_user(user_id, first_name, last_name, username, referrer_id)
         logger.info(f"New user created with referrer_id: {referrer_id}")
@@ -467,10 +707,7 @@ async def cmd_start(message: types.Message, state: FSMContext):
 @dp.message(Command("admin"))
 async def cmd_admin(message: types.Message):
     """Админ-панель (упрощенная версия)"""
-    # Простая проверка на админа (в реальности нужно более надежную)
-    admin_ids = [123456789]  # Замените на реальные ID администраторов
-    
-    if message.from_user.id not in admin_ids:
+    if message.from_user.id not in ADMIN_IDS:
         await message.answer("❌ У вас нет прав администратора.")
         return
     
@@ -519,16 +756,30 @@ async def process_broadcast_message(message: types.Message, state: FSMContext):
 @dp.callback_query(F.data == "admin_stats")
 async def admin_stats(callback: types.CallbackQuery):
     """Показ статистики бота"""
-    # Получаем статистику из базы данных
-    all_users = db.get_all_active_users()
-    total_users = len(all_users)
+    # Счетчики поддерживаются на путях записи: чтение не зависит от числа пользователей
+    stats = db.get_admin_stats()
+    
+    # Метрики очереди генерации визиток и исходящих рассылок
+    llm_metrics = llm_job_queue.get_metrics()
+    outbound_stats = app_context.outbound.get_stats()
     
     # Можно добавить больше статистики
     stats_text = f"""📊 **Статистика бота**
 
-👥 Всего пользователей: {total_users}
-✅ Активных: {total_users}
-🚫 Заблокировали: 0
+👥 Всего пользователей: {stats['total_users']}
+✅ Активных: {stats['active_users']}
+🚫 Заблокировали: {stats['blocked_users']}
+🆕 Новых сегодня: {stats['new_users_today']}
+
+📈 DAU: {stats['dau']} | WAU: {stats['wau']} | MAU: {stats['mau']}
+🎯 Выполнений привычек: сегодня {stats['completions_today']}, за 7 дней {stats['completions_7_days']}
+🤝 Рефералов: {stats['referrals_total']}, конверсий: {stats['referral_conversions']} ({stats['referral_conversion_rate']:.0%})
+
+🤖 Генерация визиток: в очереди {llm_metrics['queue_depth']}, выполняется {llm_metrics['running']}
+✅ Готово: {llm_metrics['completed']} ❌ Ошибок: {llm_metrics['failed']} 🔁 Вытеснено: {llm_metrics['superseded']}
+⏱️ Среднее ожидание: {llm_metrics['wait_seconds_avg']:.1f} с
+
+📤 Рассылки: отправлено {outbound_stats['sent']}, 429: {outbound_stats['retry_after']}, заблокировали: {outbound_stats['blocked']}, ошибок: {outbound_stats['failed']}
 
 📅 Сегодня: {datetime.now().strftime('%d.%m.%Y')}"""
     
@@ -539,6 +790,43 @@ async def admin_stats(callback: types.CallbackQuery):
     )
     await callback.answer()
 
+@dp.message(Command("profile"))
+async def cmd_profile(message: types.Message):
+    """Сэмплирующий профиль работающего бота: /profile [секунды] [all]"""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ У вас нет прав администратора.")
+        return
+    
+    if sampling_profiler.is_running:
+        await message.answer("⏳ Профилирование уже идет, дождитесь результата.")
+        return
+    
+    args = (message.text or "").split()[1:]
+    seconds = int(args[0]) if args and args[0].isdigit() else 30
+    all_threads = "all" in args
+    
+    await message.answer(f"🔬 Профилирую {seconds} с{' (все потоки)' if all_threads else ''}...")
+    
+    # Ожидание не блокирует бота: сэмплы снимает отдельный поток
+    try:
+        result = await sampling_profiler.profile(seconds, all_threads=all_threads)
+    except Exception as e:
+        logger.error(f"Error profiling: {e}")
+        await message.answer(f"❌ Ошибка профилирования: {e}")
+        return
+    
+    await message.answer("🔬 Профиль готов\n\n" + "\n".join(format_profile_summary(result)))
+    # Файлы профиля нужны только для отправки: на диске они не копятся
+    try:
+        for path in (result['folded'], result['pstats']):
+            await message.answer_document(types.FSInputFile(path))
+    finally:
+        for path in (result['folded'], result['pstats']):
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning(f"Failed to remove profile file {path}: {e}")
+
 @dp.callback_query(F.data == "yes")
 async def start_onboarding(callback: types.CallbackQuery, state: FSMContext):
     """Начало процесса онбординга"""
@@ -643,12 +931,60 @@ async def process_social_and_generate_card(message: types.Message, state: FSMCon
             parse_mode="Markdown"
         )
     
-    # Показываем прогресс
+    # Показываем прогресс; визитку допишет воркер очереди генерации
     progress_msg = await message.answer("⏳ Генерирую вашу визитку...")
     
-    try:
-        # Временная заглушка вместо openai_service
-        business_card = f"""📋 **Визитка {data.get('first_name', 'Пользователь')}**
+    # Выходим из онбординга сразу, данные анкеты остаются для сохранения визитки
+    await state.set_state(None)
+    
+    async def generate_card():
+        # Визитка выводится по мере генерации
+        business_card = await stream_to_message(
+            progress_msg,
+            openai_service.stream_business_card(data),
+            "🎉 Ваша визитка готова!\n\n",
+            reply_markup=get_card_management_keyboard()
+        )
+        
+        if not business_card:
+            # Запасной вариант, если OpenAI недоступен
+            business_card = build_fallback_business_card(data)
+            try:
+                await progress_msg.edit_text(
+                    "🎉 Ваша визитка готова!\n\n" + business_card,
+                    reply_markup=get_card_management_keyboard(),
+                    parse_mode="Markdown"
+                )
+            except Exception as e:
+                logger.error(f"Failed to show fallback business card: {e}")
+                await progress_msg.edit_text(
+                    "❌ Произошла ошибка при генерации визитки. Попробуйте позже."
+                )
+        
+        # Сохраняем данные в состоянии для дальнейшего использования
+        await state.update_data(generated_card=business_card)
+    
+    if not llm_job_queue.submit(message.from_user.id, 'generate', generate_card, priority=PRIORITY_GENERATE):
+        # Очередь переполнена: не ждем генерацию в обработчике, показываем запасную визитку
+        business_card = build_fallback_business_card(data)
+        await state.update_data(generated_card=business_card)
+        try:
+            await progress_msg.edit_text(
+                "⏳ Сейчас слишком много запросов на генерацию, поэтому пока так — "
+                "нажмите «Перегенерировать» через минуту.\n\n" + business_card,
+                reply_markup=get_card_management_keyboard(),
+                parse_mode="Markdown"
+            )
+        except Exception as e:
+            logger.error(f"Failed to show fallback business card: {e}")
+            await progress_msg.edit_text(
+                "⏳ Сейчас слишком много запросов на генерацию. Попробуйте через минуту.",
+                reply_markup=get_card_management_keyboard()
+            )
+
+def build_fallback_business_card(data: Dict) -> str:
+    """Шаблонная визитка без OpenAI"""
+    return f"""📋 **Визитка {data.get('first_name', 'Пользователь')}**
 
 👤 **Имя:** {data.get('first_name', '')} {data.get('last_name', '')}
 🏢 **Компания:** {data.get('company', 'Не указана')}
@@ -660,22 +996,6 @@ async def process_social_and_generate_card(message: types.Message, state: FSMCon
 💡 **О себе:** {data.get('bio', 'Информация не указана')}
 🎯 **Цели:** {data.get('goals', 'Не указаны')}
 🤝 **Интересы:** {data.get('interests', 'Не указаны')}"""
-        
-        if business_card:
-            await progress_msg.delete()
-            await message.answer(
-                "🎉 Ваша визитка готова!\n\n" + business_card,
-                reply_markup=get_card_management_keyboard(),
-                parse_mode="Markdown"
-            )
-    except Exception as e:
-        await progress_msg.edit_text(
-            "❌ Произошла ошибка при генерации визитки. Попробуйте позже."
-        )
-    
-    # Сохраняем данные в состоянии для дальнейшего использования
-    await state.update_data(generated_card=business_card)
-    await state.clear()
 
 # Обработчики управления визиткой
 @dp.callback_query(F.data == "save_card")
@@ -747,26 +1067,32 @@ async def regenerate_business_card(callback: types.CallbackQuery, state: FSMCont
     data = await state.get_data()
     
     progress_msg = await callback.message.edit_text("⏳ Создаю новую версию визитки...")
+    await callback.answer()
     
-    # Перегенерируем визитку
-    new_card = openai_service.regenerate_business_card(data, data.get('generated_card', ''))
-    
-    if new_card:
-        await progress_msg.edit_text(
-            "🎉 Новая версия визитки готова!\n\n" + new_card,
-            reply_markup=get_card_management_keyboard(),
-            parse_mode="Markdown"
+    async def regenerate_card():
+        # Перегенерируем визитку, выводя текст по мере генерации
+        new_card = await stream_to_message(
+            progress_msg,
+            openai_service.stream_regenerate_business_card(data, data.get('generated_card', '')),
+            "🎉 Новая версия визитки готова!\n\n",
+            reply_markup=get_card_management_keyboard()
         )
         
-        # Обновляем данные
-        await state.update_data(generated_card=new_card)
-    else:
+        if new_card:
+            # Обновляем данные
+            await state.update_data(generated_card=new_card)
+        else:
+            await progress_msg.edit_text(
+                "❌ Произошла ошибка при генерации новой визитки.",
+                reply_markup=get_card_management_keyboard()
+            )
+    
+    # Повторное нажатие вытесняет предыдущую перегенерацию этого пользователя
+    if not llm_job_queue.submit(callback.from_user.id, 'regenerate', regenerate_card, priority=PRIORITY_REGENERATE):
         await progress_msg.edit_text(
-            "❌ Произошла ошибка при генерации новой визитки.",
+            "⏳ Сейчас слишком много запросов на генерацию. Попробуйте через минуту.",
             reply_markup=get_card_management_keyboard()
         )
-    
-    await callback.answer()
 
 @dp.callback_query(F.data == "edit_card")
 async def edit_business_card(callback: types.CallbackQuery, state: FSMContext):
@@ -854,9 +1180,9 @@ async def show_habits_menu(message: types.Message):
     """Показ списка ежедневных привычек"""
     user_id = message.from_user.id
     
-    # Получаем только ежедневные привычки
-    habits = db.get_user_habits(user_id, active_only=True)
-    daily_habits = [habit for habit in habits if habit.get('habit_type') == 'daily']
+    # Получаем привычки, которые нужно выполнять сегодня (ежедневные и по расписанию)
+    habits = habit_render_model.get_rows(user_id, active_only=True)
+    daily_habits = [habit for habit in habits if db.is_habit_due(habit)]
     
     if not daily_habits:
         await message.answer(
@@ -890,11 +1216,11 @@ async def show_calendar_menu(message: types.Message):
     today = date.today()
     tomorrow = today + timedelta(days=1)
     
-    today_events = db.get_user_events(user_id, start_date=today.isoformat(), end_date=today.isoformat())
-    upcoming_events = db.get_user_events(user_id, start_date=tomorrow.isoformat(), end_date=(today + timedelta(days=7)).isoformat())
+    today_count = db.count_event_occurrences(user_id, start_date=today.isoformat(), end_date=today.isoformat())
+    upcoming_count = db.count_event_occurrences(user_id, start_date=tomorrow.isoformat(), end_date=(today + timedelta(days=7)).isoformat())
     
-    stats_text = f"📊 События на сегодня: {len(today_events)}\n"
-    stats_text += f"📅 Предстоящие (7 дней): {len(upcoming_events)}"
+    stats_text = f"📊 События на сегодня: {today_count}\n"
+    stats_text += f"📅 Предстоящие (7 дней): {upcoming_count}"
     
     await message.answer(
         f"📆 **Календарь и планировщик**\n\n{stats_text}",
@@ -954,17 +1280,14 @@ async def process_goal_type(callback: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     goals_list = data.get('goals_list', [])
     
-    # Сохраняем цели в базу данных
-    saved_count = 0
-    for goal_text in goals_list:
-        goal_id = db.add_goal(
-            user_id=callback.from_user.id,
-            goal_text=goal_text,
-            goal_type=goal_type,
-            due_date=date.today() if goal_type == 'daily' else None
-        )
-        if goal_id:
-            saved_count += 1
+    # Сохраняем цели в базу данных одной транзакцией
+    goal_ids = db.add_goals(
+        user_id=callback.from_user.id,
+        goal_texts=goals_list,
+        goal_type=goal_type,
+        due_date=date.today() if goal_type == 'daily' else None
+    )
+    saved_count = len(goal_ids)
     
     type_text = "ежедневные" if goal_type == "daily" else "ежемесячные"
     await callback.message.edit_text(
@@ -1110,7 +1433,7 @@ async def complete_goal(callback: types.CallbackQuery):
     """Отметка цели как выполненной"""
     goal_id = int(callback.data.split("_")[2])
     
-    if db.update_goal_status(goal_id, 'completed'):
+    if db.update_goal_status(goal_id, 'completed', callback.from_user.id):
         await callback.message.edit_text(
             "✅ Цель отмечена как выполненная!",
             reply_markup=InlineKeyboardMarkup(
@@ -1132,7 +1455,7 @@ async def set_goal_in_progress(callback: types.CallbackQuery):
     """Отметка цели как в процессе"""
     goal_id = int(callback.data.split("_")[2])
     
-    if db.update_goal_status(goal_id, 'in_progress'):
+    if db.update_goal_status(goal_id, 'in_progress', callback.from_user.id):
         await callback.message.edit_text(
             "⚡️ Цель отмечена как в процессе выполнения!",
             reply_markup=InlineKeyboardMarkup(
@@ -1207,6 +1530,7 @@ async def partners_handler_new(message: types.Message):
     """НОВЫЙ обработчик раздела Партнёры"""
     user_id = message.from_user.id
     referral_stats = db.get_referral_stats(user_id)
+    referral_tree = db.get_referral_tree(user_id)
     
     # Создаем кнопку для копирования ссылки
     referral_link = f"https://t.me/{CORRECT_BOT_USERNAME}?start={referral_stats['referral_code']}"
@@ -1227,7 +1551,8 @@ async def partners_handler_new(message: types.Message):
     text = f"""🤝 **Партнёры**
 
 📊 **Ваша статистика:**
-👥 Приглашено: {referral_stats['referral_count']} человек
+👥 Приглашено: {referral_stats['referral_count']} человек (за 30 дней: {referral_stats['referrals_last_30_days']})
+🌳 2-й уровень: {referral_tree[2]['count']} · 3-й уровень: {referral_tree[3]['count']}
 💰 Заработано: {referral_stats['total_earnings']:.2f} ₽
 🔗 **Ваша реферальная ссылка:**
 `{referral_link}`
@@ -1239,13 +1564,27 @@ async def partners_handler_new(message: types.Message):
     
     await message.answer(text, parse_mode="Markdown", reply_markup=keyboard)
 
+REFERRALS_PAGE_SIZE = 10
+
 @dp.callback_query(F.data == "show_my_referrals")
+@dp.callback_query(F.data.startswith("referrals_page_"))
 async def show_my_referrals(callback: types.CallbackQuery):
-    """Показать список рефералов пользователя"""
+    """Показать список рефералов пользователя (постранично, keyset по referral_id)"""
     user_id = callback.from_user.id
     
+    # referrals_page_<before_id>_<номер первой записи на странице>
+    before_id = None
+    start_index = 1
+    if callback.data.startswith("referrals_page_"):
+        _, _, before_id, start_index = callback.data.split("_")
+        before_id = int(before_id)
+        start_index = int(start_index)
+    
     try:
-        referrals = db.get_user_referrals(user_id)
+        # Одна лишняя запись показывает, есть ли следующая страница
+        referrals = db.get_user_referrals(user_id, limit=REFERRALS_PAGE_SIZE + 1, before_id=before_id)
+        has_next = len(referrals) > REFERRALS_PAGE_SIZE
+        referrals = referrals[:REFERRALS_PAGE_SIZE]
         
         if not referrals:
             await callback.message.edit_text(
@@ -1262,9 +1601,10 @@ async def show_my_referrals(callback: types.CallbackQuery):
             await callback.answer()
             return
         
-        text = f"👥 **Мои рефералы ({len(referrals)})**\n\n"
+        total_count = db.get_referral_stats(user_id)['referral_count']
+        text = f"👥 **Мои рефералы ({total_count})**\n\n"
         
-        for i, referral in enumerate(referrals[:10], 1):  # Показываем первые 10
+        for i, referral in enumerate(referrals, start_index):
             name = referral['first_name'] or "Пользователь"
             if referral['last_name']:
                 name += f" {referral['last_name']}"
@@ -1288,11 +1628,21 @@ async def show_my_referrals(callback: types.CallbackQuery):
                 text += f"   📝 {bio_escaped}\n"
             text += f"   💰 Заработано: {referral['earnings']:.2f} ₽\n\n"
         
-        if len(referrals) > 10:
-            text += f"... и еще {len(referrals) - 10} рефералов"
+        last_index = start_index + len(referrals) - 1
+        if has_next or start_index > 1:
+            text += f"Показаны {start_index}–{last_index} из {total_count}"
+        
+        navigation = []
+        if start_index > 1:
+            navigation.append(InlineKeyboardButton(text="⏮ В начало", callback_data="show_my_referrals"))
+        if has_next:
+            navigation.append(InlineKeyboardButton(
+                text="Далее ▶️",
+                callback_data=f"referrals_page_{referrals[-1]['referral_id']}_{last_index + 1}"
+            ))
         
         keyboard = InlineKeyboardMarkup(
-            inline_keyboard=[
+            inline_keyboard=([navigation] if navigation else []) + [
                 [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_partners")]
             ]
         )
@@ -1328,6 +1678,7 @@ async def back_to_partners(callback: types.CallbackQuery):
     """Вернуться к разделу партнеры"""
     user_id = callback.from_user.id
     referral_stats = db.get_referral_stats(user_id)
+    referral_tree = db.get_referral_tree(user_id)
     
     referral_link = f"https://t.me/{CORRECT_BOT_USERNAME}?start={referral_stats['referral_code']}"
     
@@ -1347,7 +1698,8 @@ async def back_to_partners(callback: types.CallbackQuery):
     text = f"""🤝 **Партнёры**
 
 📊 **Ваша статистика:**
-👥 Приглашено: {referral_stats['referral_count']} человек
+👥 Приглашено: {referral_stats['referral_count']} человек (за 30 дней: {referral_stats['referrals_last_30_days']})
+🌳 2-й уровень: {referral_tree[2]['count']} · 3-й уровень: {referral_tree[3]['count']}
 💰 Заработано: {referral_stats['total_earnings']:.2f} ₽
 🔗 **Ваша реферальная ссылка:**
 `{referral_link}`
@@ -1391,15 +1743,11 @@ async def habits_menu_callback(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     
     # Получаем краткую статистику
-    habits = db.get_user_habits(user_id, active_only=True)
+    habits = habit_render_model.get_rows(user_id, active_only=True)
     total_habits = len(habits)
     
-    # Получаем статистику выполнения за сегодня
-    today_completed = 0
-    for habit in habits:
-        today_logs = db.get_habit_stats(user_id, habit['habit_id'], days=1)
-        if today_logs.get('completed_count', 0) > 0:
-            today_completed += 1
+    # Статистика выполнения за сегодня берется из модели отображения
+    today_completed = sum(1 for habit in habits if habit['today_count'] > 0)
     
     stats_text = f"📊 У вас {total_habits} активных привычек\n"
     if total_habits > 0:
@@ -1463,8 +1811,15 @@ async def process_habit_type(callback: types.CallbackQuery, state: FSMContext):
         "habit_type_custom": "custom"
     }
     
-    habit_type = habit_type_map.get(callback.data)
-    await state.update_data(habit_type=habit_type)
+    # Ежедневные привычки по расписанию: тип daily, дни задает правило повторения
+    habit_recurrence_map = {
+        "habit_type_weekdays": RULE_WEEKDAYS,
+        "habit_type_every_other_day": RULE_EVERY_OTHER_DAY
+    }
+    
+    habit_recurrence = habit_recurrence_map.get(callback.data)
+    habit_type = "daily" if habit_recurrence else habit_type_map.get(callback.data)
+    await state.update_data(habit_type=habit_type, habit_recurrence=habit_recurrence)
     
     if habit_type == "custom":
         await callback.message.edit_text(
@@ -1544,14 +1899,20 @@ async def finish_habit_creation(message, state: FSMContext, user_id: int):
         habit_name=data['habit_name'],
         habit_description=data.get('habit_description'),
         habit_type=data.get('habit_type', 'daily'),
-        target_frequency=data.get('target_frequency', 1)
+        target_frequency=data.get('target_frequency', 1),
+        recurrence_rule=data.get('habit_recurrence')
     )
     
     if success:
+        habit_render_model.invalidate(user_id)
+        habit_analytics.invalidate(user_id)
+        rule = parse_rule(data.get('habit_recurrence'))
+        recurrence_text = f"🔁 Расписание: {rule.describe()}\n" if rule else ""
         await message.answer(
             f"✅ **Привычка создана!**\n\n"
             f"📝 Название: {data['habit_name']}\n"
             f"📅 Тип: {data.get('habit_type', 'daily')}\n"
+            f"{recurrence_text}"
             f"🔢 Частота: {data.get('target_frequency', 1)} раз\n\n"
             f"Теперь вы можете отмечать выполнение в разделе 'Мои привычки'.",
             reply_markup=get_habits_menu_keyboard(),
@@ -1569,22 +1930,22 @@ async def finish_habit_creation(message, state: FSMContext, user_id: int):
 async def show_my_habits(callback: types.CallbackQuery):
     """Показ списка привычек пользователя"""
     user_id = callback.from_user.id
-    habits = db.get_user_habits(user_id, active_only=False)
+    habits = habit_render_model.get_rows(user_id)
     
     if not habits:
-        await callback.message.edit_text(
+        await render_view(
+            callback.message,
             "📅 **Мои привычки**\n\n"
             "У вас пока нет привычек.\n"
             "Создайте первую привычку, чтобы начать отслеживание!",
-            reply_markup=get_habits_menu_keyboard(),
-            parse_mode="Markdown"
+            get_habits_menu_keyboard()
         )
     else:
-        await callback.message.edit_text(
+        await render_view(
+            callback.message,
             f"📅 **Мои привычки** ({len(habits)})\n\n"
             "Выберите привычку для просмотра деталей:",
-            reply_markup=get_habits_list_keyboard(habits),
-            parse_mode="Markdown"
+            get_habits_list_keyboard(habits)
         )
     
     await callback.answer()
@@ -1595,16 +1956,20 @@ async def show_habit_detail(callback: types.CallbackQuery):
     habit_id = int(callback.data.split("_")[2])
     user_id = callback.from_user.id
     
-    # Получаем информацию о привычке
-    habits = db.get_user_habits(user_id, active_only=False)
-    habit = next((h for h in habits if h['habit_id'] == habit_id), None)
+    # Получаем информацию о привычке из модели отображения
+    habit = habit_render_model.get_row(user_id, habit_id)
     
     if not habit:
         await callback.answer("❌ Привычка не найдена")
         return
     
-    # Получаем статистику
-    stats = db.get_habit_stats(user_id, habit_id, days=30)
+    # Статистика за период считается по той же формуле, что и get_habit_stats
+    period_days = habit_render_model.period_days
+    expected_total = habit['target_frequency'] * period_days
+    stats = {
+        'completed_count': habit['period_count'],
+        'completion_rate': (habit['period_count'] / expected_total * 100) if expected_total > 0 else 0
+    }
     
     status_emoji = "✅" if habit['is_active'] else "⏸️"
     status_text = "Активна" if habit['is_active'] else "Приостановлена"
@@ -1620,10 +1985,10 @@ async def show_habit_detail(callback: types.CallbackQuery):
 📈 Процент выполнения: {stats.get('completion_rate', 0):.1f}%
 📅 Последнее выполнение: {stats.get('last_completion', 'Никогда')}"""
     
-    await callback.message.edit_text(
+    await render_view(
+        callback.message,
         detail_text,
-        reply_markup=get_habit_detail_keyboard(habit_id, habit['is_active']),
-        parse_mode="Markdown"
+        get_habit_detail_keyboard(habit_id, habit['is_active'])
     )
     try:
         await callback.answer()
@@ -1640,6 +2005,9 @@ async def complete_habit(callback: types.CallbackQuery):
     success = db.log_habit_completion(habit_id, user_id, completed=True)
     
     if success:
+        habit_render_model.on_habit_logged(user_id, habit_id, completed=True)
+        habit_analytics.on_habit_logged(user_id, habit_id, completed=True)
+        
         # Останавливаем напоминания для этой привычки
         await stop_habit_reminders(user_id, habit_id)
         
@@ -1658,6 +2026,8 @@ async def skip_habit(callback: types.CallbackQuery):
     success = db.log_habit_completion(habit_id, user_id, completed=False)
     
     if success:
+        habit_render_model.on_habit_logged(user_id, habit_id, completed=False)
+        habit_analytics.on_habit_logged(user_id, habit_id, completed=False)
         await callback.answer("❌ Привычка отмечена как пропущенная")
         # Обновляем информацию о привычке
         await show_habit_detail(callback)
@@ -1673,6 +2043,8 @@ async def pause_habit(callback: types.CallbackQuery):
     success = db.toggle_habit_status(habit_id, user_id)
     
     if success:
+        habit_render_model.on_habit_status_changed(user_id, habit_id, is_active=False)
+        habit_analytics.invalidate(user_id)
         await callback.answer("⏸️ Привычка приостановлена")
         await show_habit_detail(callback)
     else:
@@ -1687,6 +2059,8 @@ async def resume_habit(callback: types.CallbackQuery):
     success = db.toggle_habit_status(habit_id, user_id)
     
     if success:
+        habit_render_model.on_habit_status_changed(user_id, habit_id, is_active=True)
+        habit_analytics.invalidate(user_id)
         await callback.answer("▶️ Привычка возобновлена")
         await show_habit_detail(callback)
     else:
@@ -1697,7 +2071,7 @@ async def show_habits_stats(callback: types.CallbackQuery):
     """Показ общей статистики по привычкам"""
     try:
         user_id = callback.from_user.id
-        habits = db.get_user_habits(user_id, active_only=True)
+        habits = habit_analytics.get_user_analytics(user_id, active_only=True)
         
         if not habits:
             await callback.message.edit_text(
@@ -1711,22 +2085,21 @@ async def show_habits_stats(callback: types.CallbackQuery):
         
         stats_text = "📊 **Статистика привычек**\n\n"
         
-        total_completion_rate = 0
         for habit in habits:
-            try:
-                stats = db.get_habit_stats(user_id, habit['habit_id'], days=7)
-                completion_rate = stats.get('completion_rate', 0)
-                total_completion_rate += completion_rate
-                
-                stats_text += f"📅 {habit['habit_name']}\n"
-                stats_text += f"   ✅ За неделю: {completion_rate:.1f}%\n\n"
-            except Exception as e:
-                logger.error(f"Error getting stats for habit {habit['habit_id']}: {e}")
-                stats_text += f"📅 {habit['habit_name']}\n"
-                stats_text += f"   ❌ Ошибка получения данных\n\n"
+            stats_text += f"📅 {habit['habit_name']}\n"
+            streak_unit = "нед." if habit['period'] == 'week' else "дн."
+            stats_text += f"   🔥 Серия: {habit['current_streak']} {streak_unit} (рекорд: {habit['best_streak']})\n"
+            stats_text += (
+                f"   ✅ 7 дней: {habit['rate_7']:.0f}% · 30 дней: {habit['rate_30']:.0f}% · "
+                f"90 дней: {habit['rate_90']:.0f}%\n"
+            )
+            if habit['trend_30'] is not None:
+                trend_icon = "📈" if habit['trend_30'] >= 0 else "📉"
+                stats_text += f"   {trend_icon} За 30 дней: {habit['trend_30']:+.0f}% к прошлым 30\n"
+            stats_text += f"   🗓 {format_weekday_heatmap(habit['weekday_rates'])}\n\n"
         
-        avg_completion = total_completion_rate / len(habits) if habits else 0
-        stats_text += f"📈 **Средний процент выполнения: {avg_completion:.1f}%**"
+        avg_completion = sum(habit['rate_7'] for habit in habits) / len(habits)
+        stats_text += f"📈 **Средний процент выполнения за неделю: {avg_completion:.1f}%**"
         
         await callback.message.edit_text(
             stats_text,
@@ -1758,11 +2131,11 @@ async def calendar_menu_callback(callback: types.CallbackQuery):
     today = date.today()
     tomorrow = today + timedelta(days=1)
     
-    today_events = db.get_user_events(user_id, start_date=today.isoformat(), end_date=today.isoformat())
-    upcoming_events = db.get_user_events(user_id, start_date=tomorrow.isoformat(), end_date=(today + timedelta(days=7)).isoformat())
+    today_count = db.count_event_occurrences(user_id, start_date=today.isoformat(), end_date=today.isoformat())
+    upcoming_count = db.count_event_occurrences(user_id, start_date=tomorrow.isoformat(), end_date=(today + timedelta(days=7)).isoformat())
     
-    stats_text = f"📊 События на сегодня: {len(today_events)}\n"
-    stats_text += f"📅 Предстоящие (7 дней): {len(upcoming_events)}"
+    stats_text = f"📊 События на сегодня: {today_count}\n"
+    stats_text += f"📅 Предстоящие (7 дней): {upcoming_count}"
     
     await callback.message.edit_text(
         f"📆 **Календарь и планировщик**\n\n{stats_text}",
@@ -1892,6 +2265,26 @@ async def process_reminder_time(callback: types.CallbackQuery, state: FSMContext
     reminder_minutes = reminder_map.get(callback.data)
     await state.update_data(reminder_minutes=reminder_minutes)
     
+    await callback.message.edit_text(
+        "🔁 Повторять событие?",
+        reply_markup=get_event_recurrence_keyboard()
+    )
+    await state.set_state(CalendarStates.waiting_for_event_recurrence)
+    await callback.answer()
+
+@dp.callback_query(StateFilter(CalendarStates.waiting_for_event_recurrence))
+async def process_event_recurrence(callback: types.CallbackQuery, state: FSMContext):
+    """Обработка правила повторения события"""
+    recurrence_map = {
+        "recurrence_daily": RULE_DAILY,
+        "recurrence_weekdays": RULE_WEEKDAYS,
+        "recurrence_weekly": RULE_WEEKLY,
+        "recurrence_monthly": RULE_MONTHLY,
+        "recurrence_none": None
+    }
+    
+    await state.update_data(recurrence_rule=recurrence_map.get(callback.data))
+    
     # Завершаем создание события
     await finish_event_creation(callback.message, state, callback.from_user.id)
     await callback.answer()
@@ -1909,16 +2302,19 @@ async def finish_event_creation(message, state: FSMContext, user_id: int):
             event_datetime = f"{data['event_date']} 00:00"
     
     # Создаем событие в базе данных
-    success = db.create_event(
+    event_id = db.create_event(
         user_id=user_id,
         event_title=data['event_title'],
         event_description=data.get('event_description'),
         event_type=data.get('event_type', 'custom'),
         start_datetime=event_datetime,
-        reminder_minutes=data.get('reminder_minutes')
+        reminder_minutes=data.get('reminder_minutes'),
+        recurrence_rule=data.get('recurrence_rule')
     )
     
-    if success:
+    if event_id:
+        event_reminder_engine.on_event_created(event_id)
+        
         # Форматируем информацию о событии
         type_names = {
             'task': 'Задача',
@@ -1939,6 +2335,10 @@ async def finish_event_creation(message, state: FSMContext, user_id: int):
             else:
                 reminder_text = f"\n⏰ Напоминание: за {data['reminder_minutes']} мин."
         
+        rule = parse_rule(data.get('recurrence_rule'))
+        if rule:
+            reminder_text += f"\n🔁 Повтор: {rule.describe()}"
+        
         await message.answer(
             f"✅ **Событие создано!**\n\n"
             f"📝 Название: {data['event_title']}\n"
@@ -1964,7 +2364,7 @@ async def show_events_today(callback: types.CallbackQuery):
     from datetime import date
     today = date.today()
     
-    events = db.get_user_events(user_id, start_date=today.isoformat(), end_date=today.isoformat())
+    events = db.get_event_occurrences(user_id, start_date=today.isoformat(), end_date=today.isoformat())
     
     if not events:
         await callback.message.edit_text(
@@ -1983,7 +2383,32 @@ async def show_events_today(callback: types.CallbackQuery):
     
     await callback.answer()
 
+EVENTS_PAGE_SIZE = 10
+# «Все события»: вхождения повторяющихся событий разворачиваются на год вперед
+ALL_EVENTS_DAYS = 365
+
+def get_occurrences_page(user_id: int, callback_data: str, view: str, start_date: str, end_date: str):
+    """Страница вхождений событий (с повторяющимися) после курсора <view>_after_<event_id>_<ГГГГММДДЧЧММ>"""
+    page_prefix = f"{view}_after_"
+    after = None
+    if callback_data.startswith(page_prefix):
+        # Одно событие может повторяться, поэтому курсор — событие и время его вхождения
+        event_id, stamp = callback_data[len(page_prefix):].split("_")
+        after = (datetime.strptime(stamp, "%Y%m%d%H%M").isoformat(sep=' '), int(event_id))
+    
+    events = db.get_event_occurrences(user_id, start_date, end_date, limit=EVENTS_PAGE_SIZE + 1, after=after)
+    navigation = []
+    if after is not None:
+        navigation.append(InlineKeyboardButton(text="⏮ В начало", callback_data=view))
+    if len(events) > EVENTS_PAGE_SIZE:
+        events = events[:EVENTS_PAGE_SIZE]
+        last = events[-1]
+        stamp = datetime.fromisoformat(last['start_datetime']).strftime("%Y%m%d%H%M")
+        navigation.append(InlineKeyboardButton(text="Далее ▶️", callback_data=f"{page_prefix}{last['event_id']}_{stamp}"))
+    return events, navigation
+
 @dp.callback_query(F.data == "events_week")
+@dp.callback_query(F.data.startswith("events_week_after_"))
 async def show_events_week(callback: types.CallbackQuery):
     """Показ событий на неделю"""
     user_id = callback.from_user.id
@@ -1991,7 +2416,8 @@ async def show_events_week(callback: types.CallbackQuery):
     today = date.today()
     week_end = today + timedelta(days=7)
     
-    events = db.get_user_events(user_id, start_date=today.isoformat(), end_date=week_end.isoformat())
+    events, navigation = get_occurrences_page(user_id, callback.data, "events_week",
+                                              start_date=today.isoformat(), end_date=week_end.isoformat())
     
     if not events:
         await callback.message.edit_text(
@@ -2001,20 +2427,26 @@ async def show_events_week(callback: types.CallbackQuery):
             parse_mode="Markdown"
         )
     else:
+        total = db.count_event_occurrences(user_id, start_date=today.isoformat(), end_date=week_end.isoformat())
         await callback.message.edit_text(
-            f"📆 **События на неделю** ({len(events)})\n\n"
+            f"📆 **События на неделю** ({total})\n\n"
             "Выберите событие для просмотра деталей:",
-            reply_markup=get_events_list_keyboard(events),
+            reply_markup=get_events_list_keyboard(events, navigation),
             parse_mode="Markdown"
         )
     
     await callback.answer()
 
 @dp.callback_query(F.data == "all_events")
+@dp.callback_query(F.data.startswith("all_events_after_"))
 async def show_all_events(callback: types.CallbackQuery):
-    """Показ всех событий"""
+    """Показ всех предстоящих событий (повторяющиеся — по вхождениям)"""
     user_id = callback.from_user.id
-    events = db.get_user_events(user_id)
+    from datetime import date, timedelta
+    today = date.today()
+    last_day = today + timedelta(days=ALL_EVENTS_DAYS)
+    events, navigation = get_occurrences_page(user_id, callback.data, "all_events",
+                                              start_date=today.isoformat(), end_date=last_day.isoformat())
     
     if not events:
         await callback.message.edit_text(
@@ -2025,9 +2457,9 @@ async def show_all_events(callback: types.CallbackQuery):
         )
     else:
         await callback.message.edit_text(
-            f"📋 **Все события** ({len(events)})\n\n"
+            f"📋 **Все события** ({db.count_event_occurrences(user_id, today.isoformat(), last_day.isoformat())})\n\n"
             "Выберите событие для просмотра деталей:",
-            reply_markup=get_events_list_keyboard(events),
+            reply_markup=get_events_list_keyboard(events, navigation),
             parse_mode="Markdown"
         )
     
@@ -2035,13 +2467,15 @@ async def show_all_events(callback: types.CallbackQuery):
 
 @dp.callback_query(F.data.startswith("event_detail_"))
 async def show_event_detail(callback: types.CallbackQuery):
-    """Показ детальной информации о событии"""
-    event_id = int(callback.data.split("_")[2])
+    """Показ детальной информации о событии или вхождении повторяющегося события"""
+    event_id, occurrence_start = parse_event_callback(callback.data)
     user_id = callback.from_user.id
     
-    # Получаем информацию о событии
-    events = db.get_user_events(user_id)
-    event = next((e for e in events if e['event_id'] == event_id), None)
+    # Получаем информацию о событии (для вхождения — с его датой и статусом)
+    if occurrence_start:
+        event = db.get_event_occurrence(event_id, user_id, occurrence_start)
+    else:
+        event = db.get_event_by_id(event_id, user_id)
     
     if not event:
         await callback.answer("❌ Событие не найдено")
@@ -2077,22 +2511,34 @@ async def show_event_detail(callback: types.CallbackQuery):
         else:
             detail_text += f"\n🔔 Напоминание: за {event['reminder_minutes']} мин."
     
+    rule = parse_rule(event['recurrence_rule'])
+    if rule:
+        detail_text += f"\n🔁 Повтор: {rule.describe()}"
+    
+    occurrence_suffix = event_callback_suffix(event) if occurrence_start else None
     await callback.message.edit_text(
         detail_text,
-        reply_markup=get_event_detail_keyboard(event_id),
+        reply_markup=get_event_detail_keyboard(event_id, occurrence_suffix, is_series=bool(rule)),
         parse_mode="Markdown"
     )
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("event_complete_"))
 async def complete_event(callback: types.CallbackQuery):
-    """Отметка события как выполненного"""
-    event_id = int(callback.data.split("_")[2])
+    """Отметка события (или одного вхождения повторяющегося) как выполненного"""
+    event_id, occurrence_start = parse_event_callback(callback.data)
     user_id = callback.from_user.id
     
-    success = db.complete_event(event_id, user_id)
+    if occurrence_start:
+        success = db.complete_event_occurrence(event_id, user_id, occurrence_start)
+    else:
+        success = db.complete_event(event_id, user_id)
     
     if success:
+        if occurrence_start:
+            event_reminder_engine.on_occurrence_removed(event_id, occurrence_start)
+        else:
+            event_reminder_engine.on_event_completed(event_id)
         await callback.answer("✅ Событие отмечено как выполненное!")
         # Обновляем информацию о событии
         await show_event_detail(callback)
@@ -2101,33 +2547,63 @@ async def complete_event(callback: types.CallbackQuery):
 
 @dp.callback_query(F.data.startswith("event_cancel_"))
 async def cancel_event(callback: types.CallbackQuery):
-    """Отмена события"""
-    event_id = int(callback.data.split("_")[2])
+    """Отмена события (или одного вхождения повторяющегося)"""
+    event_id, occurrence_start = parse_event_callback(callback.data)
     user_id = callback.from_user.id
     
-    success = db.delete_event(event_id, user_id)
+    if occurrence_start:
+        success = db.cancel_event_occurrence(event_id, user_id, occurrence_start)
+    else:
+        event = db.get_event_by_id(event_id, user_id)
+        # Серия целиком удаляется только через подтверждение series_delete_
+        success = bool(event) and not event['recurrence_rule'] and db.delete_event(event_id, user_id)
     
     if success:
+        if occurrence_start:
+            event_reminder_engine.on_occurrence_removed(event_id, occurrence_start)
+        else:
+            event_reminder_engine.on_event_deleted(event_id)
         await callback.answer("❌ Событие отменено")
         # Возвращаемся к списку событий
         await show_all_events(callback)
     else:
         await callback.answer("❌ Ошибка при удалении")
 
-# Запуск бота
-async def main():
-    """Главная функция запуска бота"""
-    global scheduler
-    
-    logger.info("Starting AlteriA bot...")
+@dp.callback_query(F.data.startswith("series_delete_"))
+async def confirm_series_delete(callback: types.CallbackQuery):
+    """Подтверждение удаления всей серии повторяющегося события"""
+    event_id = int(callback.data.split("_")[2])
+    event = db.get_event_by_id(event_id, callback.from_user.id)
     
-    # Инициализируем базу данных
-    db.init_database()
+    if not event:
+        await callback.answer("❌ Событие не найдено")
+        return
     
-    # Инициализируем планировщик
-    scheduler = ReportScheduler(bot)
-    scheduler.start()
+    rule = parse_rule(event['recurrence_rule'])
+    keyboard = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="🗑 Да, удалить все повторения", callback_data=f"series_confirmed_{event_id}")],
+            [InlineKeyboardButton(text="🔙 Нет, назад", callback_data="all_events")]
+        ]
+    )
+    await callback.message.edit_text(
+        f"🗑 Удалить серию «{event['event_title']}»"
+        f"{f' ({rule.describe()})' if rule else ''} вместе со всеми будущими повторениями?",
+        reply_markup=keyboard
+    )
+    await callback.answer()
+
+@dp.callback_query(F.data.startswith("series_confirmed_"))
+async def delete_series(callback: types.CallbackQuery):
+    """Удаление всей серии повторяющегося события после подтверждения"""
+    event_id = int(callback.data.split("_")[2])
     
+    if db.delete_event(event_id, callback.from_user.id):
+        event_reminder_engine.on_event_deleted(event_id)
+        await callback.answer("🗑 Серия удалена")
+        await show_all_events(callback)
+    else:
+        await callback.answer("❌ Ошибка при удалении")
 
 # Импорт системы напоминаний
 from reminder_system import (
@@ -2485,22 +2961,56 @@ async def reminder_settings_command(message: types.Message):
 
 async def main():
     """Главная функция запуска бота"""
+    global scheduler
+    metrics_runner = None
+    hourly_push = None
     try:
-        # Создаем таблицу настроек напоминаний
-        db.create_reminder_settings_table()
+        startup_profile.mark("handlers registration")
+        
+        # Таблица настроек напоминаний создается в Database.init_database
         
         # ОТКЛЮЧЕНО: Старая система напоминаний (заменена на hourly push)
         # asyncio.create_task(start_daily_reminder_check(bot, db))
         
+        # Ежедневные отчеты (21:00), напоминания о целях (20:00), отчет и сброс привычек в полночь
+        scheduler = ReportScheduler(bot, app_context)
+        scheduler.start()
+        
         # Запускаем систему почасовых push-уведомлений
-        hourly_push = HourlyPushSystem(bot)
+        hourly_push = HourlyPushSystem(bot, app_context)
         hourly_push.start()
         
+        # Запускаем воркеры очереди генерации визиток
+        llm_job_queue.start()
+        
+        # Запускаем напоминания о событиях календаря
+        event_reminder_engine.start()
+        
+        # Сторож event loop: задержка цикла и места блокирующих вызовов
+        loop_watchdog.start()
+        
+        # Локальный эндпоинт метрик для Prometheus
+        app_context.metrics.register_gauge('event_reminders_pending', lambda: event_reminder_engine.get_stats()['pending'])
+        app_context.metrics.register_gauge('app_cache_entries', lambda: len(app_context.cache))
+        metrics_runner = await start_metrics_server(app_context.metrics)
+        
+        startup_profile.mark("services start")
+        
         logger.info("Starting bot with hourly push notifications...")
         await dp.start_polling(bot)
     except Exception as e:
         logger.error(f"Error starting bot: {e}")
     finally:
+        loop_watchdog.stop()
+        # Фоновые задачи останавливаются до закрытия сессии бота, через которую они отправляют
+        await event_reminder_engine.stop()
+        await llm_job_queue.stop()
+        if hourly_push is not None:
+            hourly_push.stop()
+        if scheduler is not None:
+            await asyncio.to_thread(scheduler.stop)
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
         await bot.session.close()
 
 if __name__ == "__main__":
@@ -2674,6 +3184,8 @@ async def set_timezone_callback(callback: types.CallbackQuery):
     success = db.update_user_timezone_settings(user_id, timezone=timezone)
     
     if success:
+        # Напоминания о событиях считаются по часовому поясу пользователя
+        event_reminder_engine.on_user_timezone_changed(user_id)
         timezone_names = {
             "Europe/Moscow": "🇷🇺 Москва (UTC+3)",
             "Europe/Kiev": "🇺🇦 Киев (UTC+2)", 
@@ -2804,6 +3316,8 @@ async def quick_habit_complete(callback: types.CallbackQuery):
         success = db.log_habit_completion(habit_id, user_id, completed=True)
         
         if success:
+            habit_render_model.on_habit_logged(user_id, habit_id, completed=True)
+            habit_analytics.on_habit_logged(user_id, habit_id, completed=True)
             habit_name = habit['habit_name']
             
             # Проверяем, выполнены ли теперь все привычки
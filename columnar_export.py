@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+"""
+Выгрузка данных бота в колоночные файлы для офлайн-аналитики.
+
+Таблицы habit_logs, habits, users и referrals читаются из рабочей базы
+порциями по первичному ключу (WHERE key > ? ORDER BY key LIMIT ?) через
+соединение только для чтения. Каждая порция — отдельный короткий запрос:
+блокировка чтения снимается сразу после него, а между порциями есть пауза,
+чтобы бот успел записать свои изменения. В памяти одновременно не больше
+одной порции и нескольких открытых файлов.
+
+Файлы пишутся в Parquet или Arrow IPC с разбиением по месяцам:
+    export/habit_logs/month=2026-10/part-<запуск>-0.parquet
+
+habit_logs и referrals только дописываются, поэтому выгружаются
+инкрементально: последний выгруженный log_id / referral_id хранится в
+export/_export_state.json, и следующий запуск берет только новые строки.
+users и habits меняются (статус, пауза привычки), поэтому выгружаются
+целиком и заменяют предыдущий снимок. Личные данные пользователей (имя,
+username, bio, реферальный код) не выгружаются.
+
+Нужен pyarrow (pip install pyarrow); боту он не требуется.
+
+Запуск:
+    python3 columnar_export.py --db bot_database.db --output export
+    python3 columnar_export.py --format arrow --tables habit_logs,referrals --chunk-size 20000
+    python3 columnar_export.py --full   # выгрузить habit_logs и referrals заново
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import sqlite3
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as pa_ipc
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow нужен только для выгрузки
+    pa = None
+
+STATE_FILE = '_export_state.json'
+
+# Открытых файлов месяцев не больше: при перемешанных датах старый файл закрывается
+MAX_OPEN_WRITERS = 4
+
+# Таблица -> ключ порций, колонка месяца, инкрементальность и колонки (имя, тип)
+TABLES = OrderedDict([
+    ('habit_logs', {
+        'key': 'log_id',
+        'month': 'completion_date',
+        'incremental': True,
+        'columns': [
+            ('log_id', 'int64'),
+            ('habit_id', 'int64'),
+            ('user_id', 'int64'),
+            ('completion_date', 'date'),
+            ('completed', 'bool'),
+            ('notes', 'string'),
+            ('timestamp', 'timestamp'),
+        ],
+    }),
+    ('referrals', {
+        'key': 'referral_id',
+        'month': 'timestamp',
+        'incremental': True,
+        'columns': [
+            ('referral_id', 'int64'),
+            ('referrer_user_id', 'int64'),
+            ('referred_user_id', 'int64'),
+            ('timestamp', 'timestamp'),
+            ('earnings', 'float64'),
+        ],
+    }),
+    ('habits', {
+        'key': 'habit_id',
+        'month': 'created_date',
+        'incremental': False,
+        'columns': [
+            ('habit_id', 'int64'),
+            ('user_id', 'int64'),
+            ('habit_name', 'string'),
+            ('habit_type', 'string'),
+            ('recurrence_rule', 'string'),
+            ('target_frequency', 'int64'),
+            ('frequency_type', 'string'),
+            ('is_active', 'bool'),
+            ('created_date', 'date'),
+        ],
+    }),
+    ('users', {
+        'key': 'user_id',
+        'month': 'registration_date',
+        'incremental': False,
+        'columns': [
+            ('user_id', 'int64'),
+            ('registration_date', 'timestamp'),
+            ('is_active', 'bool'),
+            ('status', 'string'),
+            ('referred_by', 'int64'),
+            ('timezone', 'string'),
+            ('push_enabled', 'bool'),
+            ('last_active_date', 'date'),
+            ('converted_date', 'date'),
+        ],
+    }),
+])
+
+
+def _parse_date(value) -> Optional[date]:
+    if value is None:
+        return None
+    try:
+        return date.fromisoformat(str(value)[:10])
+    except ValueError:
+        return None
+
+
+def _parse_timestamp(value) -> Optional[datetime]:
+    if value is None:
+        return None
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+
+def _parse_bool(value) -> Optional[bool]:
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 't', 'yes')
+    return bool(value)
+
+
+# Тип колонки -> (тип Arrow, преобразование значения SQLite)
+COLUMN_TYPES = {
+    'int64': (lambda: pa.int64(), lambda value: int(value) if value is not None else None),
+    'float64': (lambda: pa.float64(), lambda value: float(value) if value is not None else None),
+    'string': (lambda: pa.string(), lambda value: str(value) if value is not None else None),
+    'bool': (lambda: pa.bool_(), _parse_bool),
+    'date': (lambda: pa.date32(), _parse_date),
+    'timestamp': (lambda: pa.timestamp('s'), _parse_timestamp),
+}
+
+
+def connect_readonly(db_path: str, busy_timeout_ms: int) -> sqlite3.Connection:
+    """Соединение только для чтения в режиме автокоммита: транзакция чтения живет один запрос"""
+    if not os.path.exists(db_path):
+        raise FileNotFoundError(db_path)
+    conn = sqlite3.connect(f"file:{os.path.abspath(db_path)}?mode=ro", uri=True, isolation_level=None)
+    conn.execute(f'PRAGMA busy_timeout = {int(busy_timeout_ms)}')
+    return conn
+
+
+def table_schema(name: str):
+    """Схема Arrow таблицы: одна на все порции и месяцы"""
+    return pa.schema([
+        pa.field(column, COLUMN_TYPES[kind][0]()) for column, kind in TABLES[name]['columns']
+    ])
+
+
+def month_of(value) -> str:
+    """Раздел месяца по дате или времени"""
+    if value is None or len(str(value)) < 7:
+        return 'unknown'
+    return str(value)[:7]
+
+
+class PartitionedWriter:
+    """Файлы по месяцам для одной таблицы; пишутся во временные имена до commit()"""
+
+    def __init__(self, directory: str, schema, file_format: str, run_id: str):
+        self.directory = directory
+        self.schema = schema
+        self.file_format = file_format
+        self.run_id = run_id
+        self.extension = 'parquet' if file_format == 'parquet' else 'arrow'
+        # month -> (writer, временный путь); LRU
+        self._open: "OrderedDict[str, tuple]" = OrderedDict()
+        self._parts: Dict[str, int] = {}
+        self.pending: List[str] = []
+        self.rows = 0
+
+    def _open_writer(self, month: str):
+        part = self._parts.get(month, 0)
+        self._parts[month] = part + 1
+        month_dir = os.path.join(self.directory, f"month={month}")
+        os.makedirs(month_dir, exist_ok=True)
+        path = os.path.join(month_dir, f"part-{self.run_id}-{part}.{self.extension}.tmp")
+        if self.file_format == 'parquet':
+            writer = pq.ParquetWriter(path, self.schema, compression='zstd')
+        else:
+            writer = pa_ipc.new_file(path, self.schema)
+        self.pending.append(path)
+        return writer, path
+
+    def write(self, month: str, batch):
+        """Запись части порции в файл месяца"""
+        entry = self._open.get(month)
+        if entry is None:
+            if len(self._open) >= MAX_OPEN_WRITERS:
+                _, (old_writer, _) = self._open.popitem(last=False)
+                old_writer.close()
+            entry = self._open_writer(month)
+            self._open[month] = entry
+        self._open.move_to_end(month)
+        if self.file_format == 'parquet':
+            entry[0].write_table(pa.Table.from_batches([batch]))
+        else:
+            entry[0].write_batch(batch)
+        self.rows += batch.num_rows
+
+    def close(self):
+        for writer, _ in self._open.values():
+            writer.close()
+        self._open.clear()
+
+    def commit(self) -> List[str]:
+        """Переименование временных файлов в окончательные"""
+        self.close()
+        final = []
+        for path in self.pending:
+            os.replace(path, path[:-len('.tmp')])
+            final.append(path[:-len('.tmp')])
+        self.pending = []
+        return final
+
+    def abort(self):
+        self.close()
+        for path in self.pending:
+            if os.path.exists(path):
+                os.remove(path)
+        self.pending = []
+
+
+def iter_chunks(conn: sqlite3.Connection, table: str, key: str, select: List[str],
+                after: int, upto: int, chunk_size: int, pause: float) -> Iterator[List[tuple]]:
+    """Порции строк с key в (after, upto]: каждая — отдельный короткий запрос"""
+    query = (
+        f"SELECT {', '.join(select)} FROM {table} "
+        f"WHERE {key} > ? AND {key} <= ? ORDER BY {key} LIMIT ?"
+    )
+    key_index = select.index(key)
+    while after < upto:
+        rows = conn.execute(query, (after, upto, chunk_size)).fetchall()
+        if not rows:
+            return
+        after = rows[-1][key_index]
+        yield rows
+        if pause:
+            time.sleep(pause)
+
+
+def rows_to_batches(name: str, schema, rows: List[tuple]) -> Dict[str, object]:
+    """Порция строк -> RecordBatch на каждый месяц"""
+    config = TABLES[name]
+    month_index = [column for column, _ in config['columns']].index(config['month'])
+    by_month: Dict[str, List[tuple]] = {}
+    for row in rows:
+        by_month.setdefault(month_of(row[month_index]), []).append(row)
+
+    batches = {}
+    for month, month_rows in by_month.items():
+        arrays = []
+        for index, (column, kind) in enumerate(config['columns']):
+            arrow_type, convert = COLUMN_TYPES[kind]
+            arrays.append(pa.array([convert(row[index]) for row in month_rows], type=arrow_type()))
+        batches[month] = pa.RecordBatch.from_arrays(arrays, schema=schema)
+    return batches
+
+
+def load_state(output_dir: str) -> Dict:
+    path = os.path.join(output_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return {'tables': {}, 'runs': []}
+    with open(path, encoding='utf-8') as state_file:
+        return json.load(state_file)
+
+
+def save_state(output_dir: str, state: Dict):
+    """Атомарная запись состояния: после всех файлов запуска"""
+    path = os.path.join(output_dir, STATE_FILE)
+    with open(path + '.tmp', 'w', encoding='utf-8') as state_file:
+        json.dump(state, state_file, ensure_ascii=False, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def export_table(conn: sqlite3.Connection, name: str, output_dir: str, state: Dict, file_format: str,
+                 run_id: str, chunk_size: int, pause: float, full: bool) -> Dict:
+    """Выгрузка одной таблицы; возвращает сводку"""
+    config = TABLES[name]
+    key = config['key']
+    schema = table_schema(name)
+    table_state = state['tables'].setdefault(name, {})
+
+    # Колонки, которых нет в старой схеме базы, выгружаются как NULL
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({name})")}
+    if not existing:
+        return {'table': name, 'rows': 0, 'files': [], 'skipped': 'no table'}
+    select = [column if column in existing else f"NULL AS {column}" for column, _ in config['columns']]
+
+    incremental = config['incremental'] and not full
+    after = table_state.get(f"last_{key}", 0) if incremental else 0
+    # Верхняя граница фиксируется в начале: строки, добавленные во время выгрузки, попадут в следующий запуск
+    upto = conn.execute(f"SELECT COALESCE(MAX({key}), 0) FROM {name}").fetchone()[0]
+
+    # Снимок (неинкрементальная таблица или --full) пишется рядом и заменяет
+    # предыдущий только после успешной выгрузки
+    snapshot = not incremental
+    final_dir = os.path.join(output_dir, name)
+    table_dir = os.path.join(output_dir, f".{name}.{run_id}") if snapshot else final_dir
+
+    writer = PartitionedWriter(table_dir, schema, file_format, run_id)
+    try:
+        for rows in iter_chunks(conn, name, key, select, after, upto, chunk_size, pause):
+            for month, batch in rows_to_batches(name, schema, rows).items():
+                writer.write(month, batch)
+        files = writer.commit()
+    except BaseException:
+        writer.abort()
+        if snapshot:
+            shutil.rmtree(table_dir, ignore_errors=True)
+        raise
+
+    if snapshot:
+        previous_dir = os.path.join(output_dir, f".{name}.previous")
+        shutil.rmtree(previous_dir, ignore_errors=True)
+        if os.path.isdir(final_dir):
+            os.replace(final_dir, previous_dir)
+        os.makedirs(table_dir, exist_ok=True)
+        os.replace(table_dir, final_dir)
+        shutil.rmtree(previous_dir, ignore_errors=True)
+        files = [path.replace(table_dir, final_dir, 1) for path in files]
+        table_state['snapshot_run'] = run_id
+        table_state['rows_total'] = writer.rows
+    else:
+        table_state['rows_total'] = table_state.get('rows_total', 0) + writer.rows
+    if config['incremental']:
+        table_state[f"last_{key}"] = max(after, upto)
+
+    return {'table': name, 'rows': writer.rows, 'files': files, 'range': (after, upto)}
+
+
+def cleanup_stale(output_dir: str):
+    """Файлы и снимки прерванных запусков"""
+    for path in glob.glob(os.path.join(output_dir, '*', 'month=*', '*.tmp')):
+        os.remove(path)
+    for path in glob.glob(os.path.join(output_dir, '.*.*')):
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def run_export(db_path: str, output_dir: str, tables: List[str], file_format: str = 'parquet',
+               chunk_size: int = 50000, pause_ms: float = 10, full: bool = False,
+               busy_timeout_ms: int = 5000) -> Tuple[List[Dict], Dict]:
+    """Выгрузка выбранных таблиц; состояние сохраняется после каждой таблицы"""
+    if pa is None:
+        raise RuntimeError("pyarrow is required for columnar export: pip install pyarrow")
+    unknown = [name for name in tables if name not in TABLES]
+    if unknown:
+        raise ValueError(f"Unknown tables: {', '.join(unknown)}")
+
+    os.makedirs(output_dir, exist_ok=True)
+    cleanup_stale(output_dir)
+    state = load_state(output_dir)
+    run_id = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+    started = time.perf_counter()
+
+    conn = connect_readonly(db_path, busy_timeout_ms)
+    results = []
+    try:
+        for name in tables:
+            result = export_table(conn, name, output_dir, state, file_format, run_id,
+                                  chunk_size, pause_ms / 1000, full)
+            results.append(result)
+            save_state(output_dir, state)
+    finally:
+        conn.close()
+
+    state['runs'] = (state.get('runs', []) + [{
+        'run_id': run_id,
+        'format': file_format,
+        'seconds': round(time.perf_counter() - started, 3),
+        'rows': {result['table']: result['rows'] for result in results},
+    }])[-50:]
+    save_state(output_dir, state)
+    return results, state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Выгрузка habit_logs, habits, users и referrals в Parquet/Arrow")
+    parser.add_argument('--db', default=os.getenv('DATABASE_PATH', 'bot_database.db'))
+    parser.add_argument('--output', default=os.getenv('EXPORT_DIR', 'export'))
+    parser.add_argument('--tables', default=','.join(TABLES), help="Таблицы через запятую")
+    parser.add_argument('--format', choices=('parquet', 'arrow'), default='parquet')
+    parser.add_argument('--chunk-size', type=int, default=50000, help="Строк в одной порции (одном запросе)")
+    parser.add_argument('--pause-ms', type=float, default=10, help="Пауза между порциями для записей бота")
+    parser.add_argument('--full', action='store_true', help="Выгрузить инкрементальные таблицы заново")
+    args = parser.parse_args()
+
+    if pa is None:
+        parser.error("pyarrow is not installed: pip install pyarrow")
+
+    tables = [name.strip() for name in args.tables.split(',') if name.strip()]
+    results, state = run_export(args.db, args.output, tables, args.format, args.chunk_size,
+                                args.pause_ms, args.full)
+    for result in results:
+        if result.get('skipped'):
+            print(f"{result['table']:12s} пропущена ({result['skipped']})")
+            continue
+        low, high = result['range']
+        print(f"{result['table']:12s} {result['rows']:9d} строк  ключи ({low}, {high}]  файлов: {len(result['files'])}")
+    print(f"Состояние: {os.path.join(args.output, STATE_FILE)}, запуск {state['runs'][-1]['run_id']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,61 @@
+import heapq
 import sqlite3
 import json
-from datetime import datetime, date
-from typing import Optional, List, Dict, Any
+import os
+import secrets
+from datetime import datetime, date, timedelta
+from itertools import groupby, islice
+from typing import Optional, List, Dict, Any, Tuple
 
+import pytz
+
+from referral_codes import (
+    encode_referral_code, decode_referral_code, has_referral_key, set_referral_key, referral_key_id
+)
+from recurrence import parse_rule, normalize_rule
+from metrics import instrument_methods
+from query_tracer import connect as connect_database
+from tracing import trace_methods
+
+# Служебные ключи бота в internal_settings (раньше лежали в settings)
+INTERNAL_SETTING_KEYS = ('referral_code_secret', 'referral_codes_version', 'referral_codes_key_id')
+
+# Самое большое смещение часового пояса от UTC (UTC+14 / UTC-12)
+MAX_UTC_OFFSET = timedelta(hours=14)
+
+
+def local_to_utc(value: datetime, timezone_name: Optional[str]) -> datetime:
+    """Перевод времени пользователя (naive) в naive UTC; неизвестный пояс считается UTC"""
+    try:
+        user_tz = pytz.timezone(timezone_name or 'UTC')
+    except pytz.UnknownTimeZoneError:
+        return value
+    return user_tz.localize(value).astimezone(pytz.UTC).replace(tzinfo=None)
+
+
+# Глубина реферального дерева, которая хранится в таблице замыканий
+REFERRAL_TREE_MAX_DEPTH = 3
+
+# Длительность каждого публичного метода — в db_query_seconds{method=...}, если передан реестр метрик
+# и спан db.<метод>, если вызов идет внутри трассы запроса
+@instrument_methods('db_query_seconds')
+@trace_methods('db')
 class Database:
-    def __init__(self, db_path: str = "bot_database.db"):
+    # Базы, схема которых уже создана в этом процессе: DDL выполняется один раз
+    _initialized_paths = set()
+    
+    def __init__(self, db_path: str = "bot_database.db", cache=None, metrics=None):
         self.db_path = db_path
-        self.init_database()
+        # Общий кэш приложения (TTLCache из app_context), если передан
+        self.cache = cache
+        # Реестр метрик (MetricsRegistry из app_context), если передан
+        self.metrics = metrics
+        if os.path.abspath(db_path) not in Database._initialized_paths:
+            self.init_database()
     
     def init_database(self):
         """Инициализация базы данных и создание таблиц"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             
             # Таблица пользователей
@@ -44,6 +89,52 @@ class Database:
                 )
             ''')
             
+            # Таблица целей пользователей
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS goals (
+                    goal_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    goal_text TEXT NOT NULL,
+                    goal_type TEXT CHECK(goal_type IN ('daily', 'monthly')) DEFAULT 'daily',
+                    status TEXT CHECK(status IN ('pending', 'in_progress', 'completed')) DEFAULT 'pending',
+                    progress_data TEXT,
+                    created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    due_date DATE,
+                    completed_date TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users (user_id)
+                )
+            ''')
+            
+            # Цели пользователя по типу и дате
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_goals_user_type_due_status
+                ON goals (user_id, goal_type, due_date, status)
+            ''')
+            
+            # Невыполненные ежедневные цели всех пользователей на дату (напоминания в 20:00)
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_goals_daily_incomplete
+                ON goals (due_date, user_id)
+                WHERE goal_type = 'daily' AND status != 'completed'
+            ''')
+            
+            # Настройки push-уведомлений и статус пользователя, которых нет в исходной схеме
+            self._ensure_columns(cursor, 'users', {
+                'timezone': "TEXT DEFAULT 'UTC'",
+                'push_start_hour': 'INTEGER DEFAULT 8',
+                'push_end_hour': 'INTEGER DEFAULT 22',
+                'push_enabled': 'BOOLEAN DEFAULT TRUE',
+                'status': "TEXT DEFAULT 'active'",
+                'last_active_date': 'DATE',
+                'converted_date': 'DATE',
+            })
+            
+            # Колонки привычек, которых нет в исходной схеме таблицы
+            self._ensure_columns(cursor, 'habits', {
+                'habit_type': "TEXT DEFAULT 'daily'",
+                'recurrence_rule': 'TEXT',
+            })
+            
             # Таблица логов привычек
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS habit_logs (
@@ -59,6 +150,12 @@ class Database:
                 )
             ''')
             
+            # Выполнения привычек пользователя по дням (аналитика, прогресс) — только по индексу
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_habit_logs_user_completed_date
+                ON habit_logs (user_id, completed, completion_date, habit_id)
+            ''')
+            
             # Таблица рефералов
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS referrals (
@@ -86,12 +183,288 @@ class Database:
                 )
             ''')
             
+            # Индекс для постраничного списка рефералов (keyset по referral_id)
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_referrals_referrer
+                ON referrals (referrer_user_id, referral_id)
+            ''')
+            
+            # Проверка «пользователь уже чей-то реферал» при записи реферала
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_referrals_referred
+                ON referrals (referred_user_id)
+            ''')
+            
+            # Агрегаты по рефереру, обновляются в одной транзакции с записью реферала
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS referral_stats (
+                    referrer_user_id INTEGER PRIMARY KEY,
+                    total_count INTEGER DEFAULT 0,
+                    total_earnings REAL DEFAULT 0.0,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Приглашения по дням: «за 30 дней» — сумма не более 30 строк по первичному ключу
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS referral_daily (
+                    referrer_user_id INTEGER,
+                    day DATE,
+                    referral_count INTEGER DEFAULT 0,
+                    PRIMARY KEY (referrer_user_id, day)
+                )
+            ''')
+            
+            # Таблица замыканий реферального дерева: предок -> потомок на глубине 1..3
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS referral_closure (
+                    ancestor_id INTEGER,
+                    descendant_id INTEGER,
+                    depth INTEGER,
+                    PRIMARY KEY (ancestor_id, depth, descendant_id)
+                )
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_referral_closure_descendant
+                ON referral_closure (descendant_id)
+            ''')
+            
+            # Заполняем агрегаты и дерево для рефералов, записанных до их появления
+            cursor.execute('SELECT EXISTS (SELECT 1 FROM referral_stats)')
+            if not cursor.fetchone()[0]:
+                self._rebuild_referral_stats(cursor)
+            cursor.execute('SELECT EXISTS (SELECT 1 FROM referral_closure)')
+            if not cursor.fetchone()[0]:
+                self._rebuild_referral_closure(cursor)
+            
+            # Таблица настроек (локальная копия настроек из Google Sheets)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS settings (
+                    setting_key TEXT PRIMARY KEY,
+                    setting_value TEXT,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Служебные значения бота (ключ реферальных кодов и т. п.) — отдельно от settings,
+            # которая зеркалит Google Sheets и может меняться любым редактором таблицы
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS internal_settings (
+                    setting_key TEXT PRIMARY KEY,
+                    setting_value TEXT,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Перенос служебных ключей, которые раньше хранились в settings
+            placeholders = ", ".join("?" for _ in INTERNAL_SETTING_KEYS)
+            cursor.execute(f'''
+                INSERT OR IGNORE INTO internal_settings (setting_key, setting_value)
+                SELECT setting_key, setting_value FROM settings WHERE setting_key IN ({placeholders})
+            ''', INTERNAL_SETTING_KEYS)
+            cursor.execute(f'DELETE FROM settings WHERE setting_key IN ({placeholders})', INTERNAL_SETTING_KEYS)
+            
+            # Ключ реферальных кодов без REFERRAL_CODE_SECRET: случайный, создается один раз
+            # (INSERT OR IGNORE — при одновременном первом запуске все процессы берут один ключ)
+            if not has_referral_key():
+                cursor.execute('''
+                    INSERT OR IGNORE INTO internal_settings (setting_key, setting_value)
+                    VALUES ('referral_code_secret', ?)
+                ''', (secrets.token_hex(32),))
+                cursor.execute("SELECT setting_value FROM internal_settings WHERE setting_key = 'referral_code_secret'")
+                set_referral_key(cursor.fetchone()[0])
+            
+            # Таблица календарных событий
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS calendar_events (
+                    event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    event_title TEXT NOT NULL,
+                    event_description TEXT,
+                    event_type TEXT CHECK(event_type IN ('task', 'habit', 'workout', 'meal', 'meeting', 'reminder', 'custom')) DEFAULT 'custom',
+                    start_datetime TIMESTAMP NOT NULL,
+                    end_datetime TIMESTAMP,
+                    is_all_day BOOLEAN DEFAULT FALSE,
+                    reminder_minutes INTEGER DEFAULT 15,
+                    recurrence_rule TEXT,
+                    status TEXT CHECK(status IN ('scheduled', 'completed', 'cancelled')) DEFAULT 'scheduled',
+                    created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users (user_id)
+                )
+            ''')
+            
+            # Диапазонные запросы и keyset-пагинация событий пользователя
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_calendar_events_user_start
+                ON calendar_events (user_id, start_datetime, event_id)
+            ''')
+            
+            # Выборка напоминаний по времени начала среди всех пользователей
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_calendar_events_reminders
+                ON calendar_events (start_datetime)
+                WHERE status = 'scheduled' AND reminder_minutes IS NOT NULL
+            ''')
+            
+            # Повторяющиеся события: их немного, вхождения вычисляются при чтении
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_calendar_events_recurring
+                ON calendar_events (user_id, start_datetime)
+                WHERE recurrence_rule IS NOT NULL
+            ''')
+            
+            # Отправленные напоминания: переживают перезапуск, по одному на вхождение события
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS event_reminders_sent (
+                    event_id INTEGER,
+                    occurrence_start TIMESTAMP,
+                    sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (event_id, occurrence_start)
+                ) WITHOUT ROWID
+            ''')
+            
+            # Исключения повторяющихся событий: выполненное или отмененное вхождение серии
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS event_occurrence_exceptions (
+                    event_id INTEGER,
+                    occurrence_start TIMESTAMP,
+                    status TEXT CHECK(status IN ('completed', 'cancelled')) NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (event_id, occurrence_start)
+                ) WITHOUT ROWID
+            ''')
+            
+            # Старые реферальные коды (случайные и REF_<id>_<дата>) -> пользователь
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS referral_code_aliases (
+                    code TEXT PRIMARY KEY,
+                    user_id INTEGER NOT NULL
+                ) WITHOUT ROWID
+            ''')
+            
+            # Счетчики админ-панели: обновляются в тех же транзакциях, что и исходные записи
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS stats_counters (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER DEFAULT 0
+                ) WITHOUT ROWID
+            ''')
+            
+            # Показатели по дням (UTC, как CURRENT_DATE в habit_logs)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS stats_daily (
+                    day DATE PRIMARY KEY,
+                    new_users INTEGER DEFAULT 0,
+                    active_users INTEGER DEFAULT 0,
+                    habit_completions INTEGER DEFAULT 0,
+                    referrals INTEGER DEFAULT 0,
+                    referral_conversions INTEGER DEFAULT 0
+                )
+            ''')
+            
+            # WAU/MAU — подсчет по диапазону индекса, без чтения таблицы
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_users_last_active
+                ON users (last_active_date)
+            ''')
+            
+            # Заполняем счетчики по уже накопленным данным
+            cursor.execute('SELECT EXISTS (SELECT 1 FROM stats_counters)')
+            if not cursor.fetchone()[0]:
+                self._rebuild_stats(cursor)
+            
+            # Перевыпуск кодов при первом запуске и при смене ключа (старые коды уходят в алиасы)
+            cursor.execute("SELECT setting_value FROM internal_settings WHERE setting_key = 'referral_codes_key_id'")
+            result = cursor.fetchone()
+            needs_codes_backfill = result is None or result[0] != referral_key_id()
+            
             conn.commit()
+        
+        # Перевод существующих пользователей на детерминированные коды текущего ключа
+        if needs_codes_backfill:
+            self.backfill_referral_codes()
+        
+        Database._initialized_paths.add(os.path.abspath(self.db_path))
+
+    def _ensure_columns(self, cursor, table: str, columns: Dict[str, str]):
+        """Добавление недостающих колонок в существующую таблицу"""
+        cursor.execute(f'PRAGMA table_info({table})')
+        existing = {row[1] for row in cursor.fetchall()}
+        for column, definition in columns.items():
+            if column not in existing:
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+    # Колонки stats_daily, которые увеличиваются на путях записи
+    STATS_DAILY_COLUMNS = ('new_users', 'active_users', 'habit_completions', 'referrals', 'referral_conversions')
+
+    def _bump_counters(self, cursor, counters: Dict[str, int]):
+        """Изменение счетчиков stats_counters в текущей транзакции"""
+        cursor.executemany('''
+            INSERT INTO stats_counters (name, value) VALUES (?, ?)
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value
+        ''', list(counters.items()))
+
+    def _bump_daily(self, cursor, column: str, amount: int = 1):
+        """Увеличение дневного показателя за сегодня в текущей транзакции"""
+        if column not in self.STATS_DAILY_COLUMNS:
+            raise ValueError(f"Unknown daily stat: {column}")
+        cursor.execute(f'''
+            INSERT INTO stats_daily (day, {column}) VALUES (date('now'), ?)
+            ON CONFLICT(day) DO UPDATE SET {column} = {column} + excluded.{column}
+        ''', (amount,))
+
+    def _rebuild_stats(self, cursor):
+        """Пересчет счетчиков и дневных показателей по исходным таблицам"""
+        cursor.execute('DELETE FROM stats_counters')
+        cursor.execute('DELETE FROM stats_daily')
+        
+        # Активность и конверсию до появления колонок восстанавливаем по логам привычек
+        cursor.execute('''
+            UPDATE users SET last_active_date = (
+                SELECT MAX(date(completion_date)) FROM habit_logs l WHERE l.user_id = users.user_id
+            )
+            WHERE last_active_date IS NULL
+        ''')
+        cursor.execute('''
+            UPDATE users SET converted_date = (
+                SELECT MIN(date(completion_date)) FROM habit_logs l WHERE l.user_id = users.user_id AND l.completed = 1
+            )
+            WHERE referred_by IS NOT NULL AND converted_date IS NULL
+        ''')
+        
+        cursor.execute('''
+            INSERT INTO stats_counters (name, value)
+            SELECT 'users_total', COUNT(*) FROM users
+            UNION ALL
+            SELECT 'users_' || COALESCE(status, 'active'), COUNT(*) FROM users GROUP BY COALESCE(status, 'active')
+            UNION ALL
+            SELECT 'referrals_total', COUNT(*) FROM referrals
+            UNION ALL
+            SELECT 'referral_conversions_total', COUNT(*) FROM users
+            WHERE referred_by IS NOT NULL AND converted_date IS NOT NULL
+        ''')
+        
+        daily_sources = {
+            'new_users': "SELECT date(registration_date), COUNT(*) FROM users WHERE registration_date IS NOT NULL GROUP BY 1",
+            'active_users': "SELECT date(completion_date), COUNT(DISTINCT user_id) FROM habit_logs WHERE 1 GROUP BY 1",
+            'habit_completions': "SELECT date(completion_date), COUNT(*) FROM habit_logs WHERE completed = 1 GROUP BY 1",
+            'referrals': "SELECT date(timestamp), COUNT(*) FROM referrals WHERE timestamp IS NOT NULL GROUP BY 1",
+            'referral_conversions': "SELECT converted_date, COUNT(*) FROM users WHERE converted_date IS NOT NULL GROUP BY 1",
+        }
+        for column, source in daily_sources.items():
+            cursor.execute(f'''
+                INSERT INTO stats_daily (day, {column}) {source}
+                ON CONFLICT(day) DO UPDATE SET {column} = excluded.{column}
+            ''')
+
+    def _connect(self) -> sqlite3.Connection:
+        """Соединение с базой (с трассировкой запросов при DB_TRACE=1)"""
+        return connect_database(self.db_path)
 
     @property
     def conn(self):
         """Получение соединения с базой данных"""
-        return sqlite3.connect(self.db_path)
+        return self._connect()
 
     def get_reminder_settings(self, user_id: int) -> dict:
         """Получение настроек напоминаний пользователя"""
@@ -195,14 +568,21 @@ class Database:
                  last_name: str = None, referral_code: str = None, referred_by: int = None) -> bool:
         """Добавление нового пользователя"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
-                    INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, referral_code, referred_by)
-                    VALUES (?, ?, ?, ?, ?, ?)
+                    INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, referral_code, referred_by,
+                                                 last_active_date)
+                    VALUES (?, ?, ?, ?, ?, ?, date('now'))
                 ''', (user_id, username, first_name, last_name, referral_code, referred_by))
+                created = cursor.rowcount > 0
+                if created:
+                    self._bump_counters(cursor, {'users_total': 1, 'users_active': 1})
+                    self._bump_daily(cursor, 'new_users')
+                    # Middleware отметил активность до создания строки — новый пользователь активен сегодня
+                    self._bump_daily(cursor, 'active_users')
                 conn.commit()
-                return cursor.rowcount > 0
+                return created
         except Exception as e:
             print(f"Error adding user: {e}")
             return False
@@ -210,7 +590,7 @@ class Database:
     def get_user(self, user_id: int) -> Optional[Dict]:
         """Получение информации о пользователе"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT user_id, username, first_name, last_name, bio, registration_date, 
@@ -236,66 +616,437 @@ class Database:
             print(f"Error getting user: {e}")
             return None
 
-    def get_referral_stats(self, user_id: int) -> Dict:
-        """Получение статистики рефералов"""
+    def get_all_active_users(self) -> List[int]:
+        """Идентификаторы активных пользователей"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT user_id FROM users WHERE is_active = 1')
+                return [row[0] for row in cursor.fetchall()]
+        except Exception as e:
+            print(f"Error getting active users: {e}")
+            return []
+
+    def record_user_activity(self, user_id: int) -> bool:
+        """Отметка активности за сегодня (DAU/WAU/MAU); запись — не чаще раза в день на пользователя"""
+        # Дата в UTC, как date('now') в запросе
+        today = datetime.utcnow().date().isoformat()
+        cache_key = ('user_active', user_id)
+        if self.cache is not None and self.cache.get(cache_key) == today:
+            return False
+        try:
+            with self._connect() as conn:
                 cursor = conn.cursor()
-                
-                # Получаем реферальный код пользователя
-                cursor.execute('SELECT referral_code FROM users WHERE user_id = ?', (user_id,))
-                result = cursor.fetchone()
-                referral_code = result[0] if result else f"ref_{user_id}"
-                
-                # Считаем количество рефералов из таблицы users (основной источник)
                 cursor.execute('''
-                    SELECT COUNT(*) FROM users WHERE referrer_id = ?
+                    UPDATE users SET last_active_date = date('now')
+                    WHERE user_id = ? AND (last_active_date IS NULL OR last_active_date < date('now'))
                 ''', (user_id,))
+                marked = cursor.rowcount > 0
+                if marked:
+                    self._bump_daily(cursor, 'active_users')
                 
-                users_result = cursor.fetchone()
-                users_count = users_result[0] if users_result else 0
-                
-                # Считаем заработок из таблицы referrals
+                # Входящее обновление от пользователя, заблокировавшего бота, — он снова доступен
                 cursor.execute('''
-                    SELECT COALESCE(SUM(earnings), 0) FROM referrals WHERE referrer_user_id = ?
+                    UPDATE users SET status = 'active', is_active = 1
+                    WHERE user_id = ? AND status = 'blocked'
                 ''', (user_id,))
+                if cursor.rowcount > 0:
+                    self._bump_counters(cursor, {'users_blocked': -1, 'users_active': 1})
+                
+                # Строки еще нет (первый /start до create_user) — не кэшируем, иначе день не отметится
+                exists = marked
+                if not exists:
+                    cursor.execute('SELECT 1 FROM users WHERE user_id = ?', (user_id,))
+                    exists = cursor.fetchone() is not None
+                conn.commit()
+            if self.cache is not None and exists:
+                self.cache.set(cache_key, today, ttl=3600)
+            return marked
+        except Exception as e:
+            print(f"Error recording user activity: {e}")
+            return False
+
+    def get_admin_stats(self) -> Dict:
+        """Статистика для админ-панели из счетчиков и дневных показателей"""
+        stats = {
+            'total_users': 0, 'active_users': 0, 'blocked_users': 0,
+            'dau': 0, 'wau': 0, 'mau': 0,
+            'new_users_today': 0, 'completions_today': 0, 'completions_7_days': 0,
+            'referrals_total': 0, 'referral_conversions': 0, 'referral_conversion_rate': 0.0
+        }
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT name, value FROM stats_counters')
+                counters = dict(cursor.fetchall())
+                stats['total_users'] = counters.get('users_total', 0)
+                stats['active_users'] = counters.get('users_active', 0)
+                stats['blocked_users'] = counters.get('users_blocked', 0)
+                stats['referrals_total'] = counters.get('referrals_total', 0)
+                stats['referral_conversions'] = counters.get('referral_conversions_total', 0)
+                if stats['referrals_total']:
+                    stats['referral_conversion_rate'] = stats['referral_conversions'] / stats['referrals_total']
                 
-                earnings_result = cursor.fetchone()
-                total_earnings = earnings_result[0] if earnings_result else 0.0
+                # Поиск по диапазону idx_users_last_active
+                for key, days in (('dau', 0), ('wau', 6), ('mau', 29)):
+                    cursor.execute('''
+                        SELECT COUNT(*) FROM users WHERE last_active_date >= date('now', ?)
+                    ''', (f"-{days} days",))
+                    stats[key] = cursor.fetchone()[0]
                 
-                # Также проверяем количество в таблице referrals для сравнения
                 cursor.execute('''
-                    SELECT COUNT(*) FROM referrals WHERE referrer_user_id = ?
-                ''', (user_id,))
+                    SELECT
+                        COALESCE(SUM(CASE WHEN day = date('now') THEN new_users END), 0),
+                        COALESCE(SUM(CASE WHEN day = date('now') THEN habit_completions END), 0),
+                        COALESCE(SUM(habit_completions), 0)
+                    FROM stats_daily WHERE day >= date('now', '-6 days')
+                ''')
+                stats['new_users_today'], stats['completions_today'], stats['completions_7_days'] = cursor.fetchone()
+        except Exception as e:
+            print(f"Error getting admin stats: {e}")
+        return stats
+
+    def update_user_status(self, user_id: int, status: str) -> bool:
+        """Смена статуса пользователя ('active' или 'blocked' — бот заблокирован)"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT COALESCE(status, 'active') FROM users WHERE user_id = ?", (user_id,))
+                row = cursor.fetchone()
+                if row is None:
+                    return False
+                cursor.execute('UPDATE users SET status = ?, is_active = ? WHERE user_id = ?',
+                               (status, status == 'active', user_id))
+                # Счетчики по статусам меняются только при смене статуса
+                if row[0] != status:
+                    self._bump_counters(cursor, {f"users_{row[0]}": -1, f"users_{status}": 1})
+                conn.commit()
+            # Следующее входящее обновление снова проверит статус в record_user_activity
+            if self.cache is not None:
+                self.cache.delete(('user_active', user_id))
+            return True
+        except Exception as e:
+            print(f"Error updating user status: {e}")
+            return False
+
+    def get_referral_stats(self, user_id: int) -> Dict:
+        """Получение статистики рефералов из предрасчитанных агрегатов"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
                 
-                referrals_result = cursor.fetchone()
-                referrals_count = referrals_result[0] if referrals_result else 0
+                # Агрегаты — поиск по первичному ключу; код вычисляется без запроса
+                cursor.execute('''
+                    SELECT total_count, total_earnings FROM referral_stats WHERE referrer_user_id = ?
+                ''', (user_id,))
+                result = cursor.fetchone()
                 
-                # Используем максимальное значение из двух таблиц
-                referral_count = max(users_count, referrals_count)
+                # Приглашенные за последние 30 дней
+                cursor.execute('''
+                    SELECT COALESCE(SUM(referral_count), 0) FROM referral_daily
+                    WHERE referrer_user_id = ? AND day > date('now', '-30 days')
+                ''', (user_id,))
+                last_30_days = cursor.fetchone()[0]
                 
                 return {
-                    'referral_code': referral_code,
-                    'referral_count': referral_count,
-                    'total_earnings': total_earnings
+                    'referral_code': encode_referral_code(user_id),
+                    'referral_count': result[0] if result else 0,
+                    'referrals_last_30_days': last_30_days,
+                    'total_earnings': result[1] if result else 0.0
                 }
         except Exception as e:
             print(f"Error getting referral stats: {e}")
             return {
-                'referral_code': f"ref_{user_id}",
+                'referral_code': encode_referral_code(user_id),
                 'referral_count': 0,
+                'referrals_last_30_days': 0,
                 'total_earnings': 0.0
             }
 
+    def _record_referral(self, cursor, referrer_user_id: int, referred_user_id: int,
+                         earnings: float = 0.0) -> List[int]:
+        """Запись реферала и обновление агрегатов в текущей транзакции.
+        
+        Возвращает предков нового реферала (чьи деревья изменились); пустой
+        список — реферал уже был записан.
+        """
+        cursor.execute('''
+            INSERT INTO referrals (referrer_user_id, referred_user_id, earnings)
+            SELECT ?, ?, ?
+            WHERE NOT EXISTS (SELECT 1 FROM referrals WHERE referred_user_id = ?)
+        ''', (referrer_user_id, referred_user_id, earnings, referred_user_id))
+        if cursor.rowcount == 0:
+            return []
+        
+        self._bump_counters(cursor, {'referrals_total': 1})
+        self._bump_daily(cursor, 'referrals')
+        cursor.execute('''
+            INSERT INTO referral_stats (referrer_user_id, total_count, total_earnings)
+            VALUES (?, 1, ?)
+            ON CONFLICT(referrer_user_id) DO UPDATE SET
+                total_count = total_count + 1,
+                total_earnings = total_earnings + excluded.total_earnings,
+                updated_at = CURRENT_TIMESTAMP
+        ''', (referrer_user_id, earnings))
+        cursor.execute('''
+            INSERT INTO referral_daily (referrer_user_id, day, referral_count)
+            VALUES (?, date('now'), 1)
+            ON CONFLICT(referrer_user_id, day) DO UPDATE SET referral_count = referral_count + 1
+        ''', (referrer_user_id,))
+        
+        # Новый лист дерева: реферер на глубине 1 и его предки на глубине +1
+        cursor.execute('''
+            INSERT OR IGNORE INTO referral_closure (ancestor_id, descendant_id, depth)
+            SELECT ?, ?, 1
+            UNION ALL
+            SELECT ancestor_id, ?, depth + 1
+            FROM referral_closure
+            WHERE descendant_id = ? AND depth < ?
+        ''', (referrer_user_id, referred_user_id, referred_user_id, referrer_user_id,
+              REFERRAL_TREE_MAX_DEPTH))
+        
+        cursor.execute('''
+            SELECT ancestor_id FROM referral_closure WHERE descendant_id = ?
+        ''', (referred_user_id,))
+        return [row[0] for row in cursor.fetchall()]
+
+    def add_referral(self, referrer_user_id: int, referred_user_id: int, earnings: float = 0.0) -> bool:
+        """Добавление записи о реферале"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                ancestors = self._record_referral(cursor, referrer_user_id, referred_user_id, earnings)
+                conn.commit()
+            self._invalidate_referral_tree(ancestors)
+            return bool(ancestors)
+        except Exception as e:
+            print(f"Error adding referral: {e}")
+            return False
+
+    def add_referral_earnings(self, referrer_user_id: int, referred_user_id: int, amount: float) -> bool:
+        """Начисление заработка с реферала вместе с агрегатом реферера"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    UPDATE referrals SET earnings = earnings + ?
+                    WHERE referrer_user_id = ? AND referred_user_id = ?
+                ''', (amount, referrer_user_id, referred_user_id))
+                if cursor.rowcount == 0:
+                    return False
+                cursor.execute('''
+                    UPDATE referral_stats
+                    SET total_earnings = total_earnings + ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE referrer_user_id = ?
+                ''', (amount, referrer_user_id))
+                cursor.execute('''
+                    SELECT ancestor_id FROM referral_closure WHERE descendant_id = ?
+                ''', (referred_user_id,))
+                ancestors = [row[0] for row in cursor.fetchall()]
+                conn.commit()
+            self._invalidate_referral_tree(ancestors)
+            return True
+        except Exception as e:
+            print(f"Error adding referral earnings: {e}")
+            return False
+
+    def _rebuild_referral_stats(self, cursor):
+        """Пересчет агрегатов рефералов по таблице referrals"""
+        cursor.execute('DELETE FROM referral_stats')
+        cursor.execute('DELETE FROM referral_daily')
+        cursor.execute('''
+            INSERT INTO referral_stats (referrer_user_id, total_count, total_earnings)
+            SELECT referrer_user_id, COUNT(*), COALESCE(SUM(earnings), 0)
+            FROM referrals
+            WHERE referrer_user_id IS NOT NULL
+            GROUP BY referrer_user_id
+        ''')
+        cursor.execute('''
+            INSERT INTO referral_daily (referrer_user_id, day, referral_count)
+            SELECT referrer_user_id, date(timestamp), COUNT(*)
+            FROM referrals
+            WHERE referrer_user_id IS NOT NULL
+            GROUP BY referrer_user_id, date(timestamp)
+        ''')
+
+    def _rebuild_referral_closure(self, cursor):
+        """Построение таблицы замыканий по таблице referrals рекурсивным CTE"""
+        cursor.execute('DELETE FROM referral_closure')
+        cursor.execute('''
+            WITH RECURSIVE tree (ancestor_id, descendant_id, depth) AS (
+                SELECT referrer_user_id, referred_user_id, 1
+                FROM referrals
+                WHERE referrer_user_id IS NOT NULL
+                UNION
+                SELECT tree.ancestor_id, r.referred_user_id, tree.depth + 1
+                FROM tree
+                JOIN referrals r ON r.referrer_user_id = tree.descendant_id
+                WHERE tree.depth < ?
+            )
+            INSERT OR IGNORE INTO referral_closure (ancestor_id, descendant_id, depth)
+            SELECT ancestor_id, descendant_id, depth FROM tree
+        ''', (REFERRAL_TREE_MAX_DEPTH,))
+
+    def _invalidate_referral_tree(self, ancestors: List[int]):
+        """Сброс кэша деревьев, затронутых новым рефералом или начислением"""
+        if self.cache is None or not ancestors:
+            return
+        for ancestor_id in ancestors:
+            self.cache.delete(('referral_tree', ancestor_id))
+        self.cache.delete(('referral_leaderboard',))
+
+    def get_referral_tree(self, user_id: int) -> Dict[int, Dict]:
+        """Нижестоящая сеть по уровням: {уровень: {'count', 'earnings', 'network_earnings'}}"""
+        cache_key = ('referral_tree', user_id)
+        if self.cache is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                # earnings — заработок самого пользователя на участниках уровня (начисление
+                # идет только прямому пригласившему, глубже первого уровня оно нулевое);
+                # network_earnings — сколько на участниках уровня заработали их пригласившие
+                cursor.execute('''
+                    SELECT c.depth, COUNT(*),
+                           COALESCE(SUM(CASE WHEN r.referrer_user_id = c.ancestor_id THEN r.earnings END), 0.0),
+                           COALESCE(SUM(r.earnings), 0)
+                    FROM referral_closure c
+                    LEFT JOIN referrals r ON r.referred_user_id = c.descendant_id
+                    WHERE c.ancestor_id = ?
+                    GROUP BY c.depth
+                ''', (user_id,))
+                
+                tree = {depth: {'count': 0, 'earnings': 0.0, 'network_earnings': 0.0} for depth in range(1, REFERRAL_TREE_MAX_DEPTH + 1)}
+                for depth, count, earnings, network_earnings in cursor.fetchall():
+                    tree[depth] = {'count': count, 'earnings': earnings, 'network_earnings': network_earnings}
+        except Exception as e:
+            print(f"Error getting referral tree: {e}")
+            return {depth: {'count': 0, 'earnings': 0.0, 'network_earnings': 0.0} for depth in range(1, REFERRAL_TREE_MAX_DEPTH + 1)}
+        
+        if self.cache is not None:
+            self.cache.set(cache_key, tree, ttl=3600)
+        return tree
+
+    def get_referral_leaderboard(self, limit: int = 10, max_depth: int = REFERRAL_TREE_MAX_DEPTH) -> List[Dict]:
+        """Рейтинг партнеров по размеру сети до max_depth уровней"""
+        cache_key = ('referral_leaderboard',)
+        cached = self.cache.get(cache_key) if self.cache is not None else None
+        if cached is not None and cached['limit'] >= limit and cached['max_depth'] == max_depth:
+            return cached['rows'][:limit]
+        
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT c.ancestor_id, u.username, u.first_name,
+                           COUNT(*) AS network_size,
+                           SUM(c.depth = 1) AS direct_count
+                    FROM referral_closure c
+                    LEFT JOIN users u ON u.user_id = c.ancestor_id
+                    WHERE c.depth <= ?
+                    GROUP BY c.ancestor_id
+                    ORDER BY network_size DESC, direct_count DESC
+                    LIMIT ?
+                ''', (max_depth, limit))
+                
+                rows = [{
+                    'user_id': row[0],
+                    'username': row[1],
+                    'first_name': row[2],
+                    'network_size': row[3],
+                    'direct_count': row[4]
+                } for row in cursor.fetchall()]
+        except Exception as e:
+            print(f"Error getting referral leaderboard: {e}")
+            return []
+        
+        if self.cache is not None:
+            self.cache.set(cache_key, {'limit': limit, 'max_depth': max_depth, 'rows': rows}, ttl=300)
+        return rows
+
+    def resolve_referral_code(self, referral_code: str) -> Optional[int]:
+        """user_id по реферальному коду: новые коды декодируются без запроса к базе"""
+        user_id = decode_referral_code(referral_code)
+        if user_id is not None:
+            return user_id
+        
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                # Старые коды — поиск по первичному ключу таблицы алиасов
+                cursor.execute('SELECT user_id FROM referral_code_aliases WHERE code = ?', (referral_code,))
+                result = cursor.fetchone()
+                if result is None:
+                    # Коды, проставленные вручную в users (fix_referral.py)
+                    cursor.execute('SELECT user_id FROM users WHERE referral_code = ?', (referral_code,))
+                    result = cursor.fetchone()
+                return result[0] if result else None
+        except Exception as e:
+            print(f"Error resolving referral code: {e}")
+            return None
+
+    def backfill_referral_codes(self, batch_size: int = 1000) -> int:
+        """Перевод пользователей на детерминированные коды пачками; старые коды уходят в алиасы"""
+        migrated = 0
+        last_user_id = -2 ** 63
+        try:
+            while True:
+                # Короткая транзакция на каждую пачку
+                with self._connect() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute('''
+                        SELECT user_id, referral_code FROM users
+                        WHERE user_id > ?
+                        ORDER BY user_id
+                        LIMIT ?
+                    ''', (last_user_id, batch_size))
+                    rows = cursor.fetchall()
+                    if not rows:
+                        break
+                    
+                    aliases = []
+                    updates = []
+                    for user_id, code in rows:
+                        if user_id < 0:
+                            continue
+                        new_code = encode_referral_code(user_id)
+                        if code == new_code:
+                            continue
+                        if code:
+                            aliases.append((code, user_id))
+                        updates.append((new_code, user_id))
+                    
+                    cursor.executemany('''
+                        INSERT OR IGNORE INTO referral_code_aliases (code, user_id) VALUES (?, ?)
+                    ''', aliases)
+                    cursor.executemany('UPDATE users SET referral_code = ? WHERE user_id = ?', updates)
+                    conn.commit()
+                
+                migrated += len(updates)
+                last_user_id = rows[-1][0]
+            
+            self.set_internal_settings({'referral_codes_version': '1', 'referral_codes_key_id': referral_key_id()})
+            return migrated
+        except Exception as e:
+            print(f"Error backfilling referral codes: {e}")
+            return migrated
+
     def get_user_by_referral_code(self, referral_code: str) -> Optional[Dict]:
         """Получение пользователя по реферальному коду"""
+        user_id = self.resolve_referral_code(referral_code)
+        if user_id is None:
+            return None
+        
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT user_id, username, first_name, last_name, referral_code 
-                    FROM users WHERE referral_code = ?
-                ''', (referral_code,))
+                    FROM users WHERE user_id = ?
+                ''', (user_id,))
                 
                 result = cursor.fetchone()
                 if result:
@@ -311,10 +1062,14 @@ class Database:
             print(f"Error getting user by referral code: {e}")
             return None
 
-    def get_user_referrals(self, user_id: int) -> List[Dict]:
-        """Получение списка рефералов пользователя с их данными"""
+    def get_user_referrals(self, user_id: int, limit: int = None, before_id: int = None) -> List[Dict]:
+        """Получение списка рефералов пользователя с их данными.
+        
+        Постранично: limit записей с referral_id меньше before_id (keyset по индексу
+        idx_referrals_referrer), от новых к старым.
+        """
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT 
@@ -327,9 +1082,11 @@ class Database:
                         u.last_name
                     FROM referrals r
                     JOIN users u ON r.referred_user_id = u.user_id
-                    WHERE r.referrer_user_id = ?
-                    ORDER BY r.timestamp DESC
-                ''', (user_id,))
+                    WHERE r.referrer_user_id = ? AND r.referral_id < ?
+                    ORDER BY r.referral_id DESC
+                    LIMIT ?
+                ''', (user_id, before_id if before_id is not None else 2 ** 63 - 1,
+                      limit if limit is not None else -1))
                 
                 results = cursor.fetchall()
                 referrals = []
@@ -354,7 +1111,7 @@ class Database:
     def get_all_users_with_habits(self) -> List[int]:
         """Получение всех пользователей, у которых есть активные привычки"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT DISTINCT user_id 
@@ -369,15 +1126,18 @@ class Database:
             return []
 
     def add_habit(self, user_id: int, habit_name: str, habit_description: str = None, 
-                  target_frequency: int = 1, frequency_type: str = 'daily') -> bool:
-        """Добавление новой привычки"""
+                  target_frequency: int = 1, frequency_type: str = 'daily',
+                  recurrence_rule: str = None) -> bool:
+        """Добавление новой привычки (recurrence_rule — расписание в формате recurrence)"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
-                    INSERT INTO habits (user_id, habit_name, habit_description, habit_type, target_frequency)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (user_id, habit_name, habit_description, frequency_type, target_frequency))
+                    INSERT INTO habits (user_id, habit_name, habit_description, habit_type, target_frequency,
+                                        recurrence_rule)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (user_id, habit_name, habit_description, frequency_type, target_frequency,
+                      normalize_rule(recurrence_rule)))
                 conn.commit()
                 return True
         except Exception as e:
@@ -387,12 +1147,12 @@ class Database:
     def get_user_habits(self, user_id: int, active_only: bool = True) -> List[Dict]:
         """Получение привычек пользователя"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 
                 query = '''
                     SELECT habit_id, habit_name, habit_description, habit_type, 
-                           target_frequency, is_active, created_date
+                           target_frequency, is_active, created_date, recurrence_rule
                     FROM habits WHERE user_id = ?
                 '''
                 params = [user_id]
@@ -413,6 +1173,7 @@ class Database:
                         'target_frequency': result[4],
                         'is_active': result[5],
                         'created_date': result[6],
+                        'recurrence_rule': result[7],
                         'user_id': user_id
                     })
                 
@@ -421,15 +1182,53 @@ class Database:
             print(f"Error getting user habits: {e}")
             return []
 
+    def get_habit_by_id(self, habit_id: int) -> Optional[Dict]:
+        """Получение привычки по ID"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT habit_id, user_id, habit_name, habit_description, habit_type,
+                           target_frequency, is_active, created_date, recurrence_rule
+                    FROM habits WHERE habit_id = ?
+                ''', (habit_id,))
+                result = cursor.fetchone()
+                if not result:
+                    return None
+                return {
+                    'habit_id': result[0],
+                    'user_id': result[1],
+                    'habit_name': result[2],
+                    'habit_description': result[3],
+                    'habit_type': result[4],
+                    'target_frequency': result[5],
+                    'is_active': result[6],
+                    'created_date': result[7],
+                    'recurrence_rule': result[8]
+                }
+        except Exception as e:
+            print(f"Error getting habit: {e}")
+            return None
+
     def log_habit_completion(self, habit_id: int, user_id: int, completed: bool = True, notes: str = None) -> bool:
         """Логирование выполнения привычки"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     INSERT INTO habit_logs (habit_id, user_id, completed, notes)
                     VALUES (?, ?, ?, ?)
                 ''', (habit_id, user_id, completed, notes))
+                if completed:
+                    self._bump_daily(cursor, 'habit_completions')
+                    # Конверсия реферала — первое выполнение привычки приглашенным пользователем
+                    cursor.execute('''
+                        UPDATE users SET converted_date = date('now')
+                        WHERE user_id = ? AND referred_by IS NOT NULL AND converted_date IS NULL
+                    ''', (user_id,))
+                    if cursor.rowcount:
+                        self._bump_counters(cursor, {'referral_conversions_total': 1})
+                        self._bump_daily(cursor, 'referral_conversions')
                 conn.commit()
                 return True
         except Exception as e:
@@ -441,7 +1240,7 @@ class Database:
         try:
             from datetime import date, timedelta
             
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 
                 # Получаем информацию о привычке
@@ -504,29 +1303,77 @@ class Database:
     def create_user(self, user_id: int, first_name: str = None, last_name: str = None, 
                    username: str = None, referrer_id: int = None) -> bool:
         """Создание нового пользователя (алиас для add_user)"""
-        import secrets
-        import string
+        # Реферальный код детерминирован и однозначно декодируется в user_id
+        referral_code = encode_referral_code(user_id)
         
-        # Генерируем реферальный код
-        referral_code = ''.join(secrets.choice(string.ascii_letters + string.digits) for _ in range(8))
-        
-        return self.add_user(user_id, username, first_name, last_name, referral_code, referrer_id)
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, referral_code, referred_by,
+                                                 last_active_date)
+                    VALUES (?, ?, ?, ?, ?, ?, date('now'))
+                ''', (user_id, username, first_name, last_name, referral_code, referrer_id))
+                created = cursor.rowcount > 0
+                if created:
+                    self._bump_counters(cursor, {'users_total': 1, 'users_active': 1})
+                    self._bump_daily(cursor, 'new_users')
+                    # Middleware отметил активность до создания строки — новый пользователь активен сегодня
+                    self._bump_daily(cursor, 'active_users')
+                
+                # Реферал, агрегаты и дерево — в той же транзакции, что и пользователь
+                ancestors = []
+                if created and referrer_id and referrer_id != user_id:
+                    ancestors = self._record_referral(cursor, referrer_id, user_id)
+                
+                conn.commit()
+            self._invalidate_referral_tree(ancestors)
+            return created
+        except Exception as e:
+            print(f"Error creating user: {e}")
+            return False
 
     def get_profile(self, user_id: int) -> Optional[Dict]:
         """Получение профиля пользователя (алиас для get_user)"""
         return self.get_user(user_id)
 
     def create_habit(self, user_id: int, habit_name: str, habit_description: str = None, 
-                    habit_type: str = 'daily', target_frequency: int = 1) -> bool:
+                    habit_type: str = 'daily', target_frequency: int = 1,
+                    recurrence_rule: str = None) -> bool:
         """Создание новой привычки (алиас для add_habit)"""
         return self.add_habit(
             user_id=user_id,
             habit_name=habit_name, 
             habit_description=habit_description,
             target_frequency=target_frequency,
-            frequency_type=habit_type
+            frequency_type=habit_type,
+            recurrence_rule=recurrence_rule
         )
 
+    def iter_habit_due_dates(self, habit: Dict, start_date: date, end_date: date):
+        """Дни в [start_date, end_date], когда привычку нужно выполнять (лениво).
+        
+        Без расписания ежедневная привычка ждет выполнения каждый день, остальные — ни в какой
+        конкретный день; с расписанием дни вычисляются правилом от даты создания привычки.
+        """
+        rule = parse_rule(habit.get('recurrence_rule'))
+        if rule is None:
+            if habit.get('habit_type') == 'daily':
+                for offset in range((end_date - start_date).days + 1):
+                    yield start_date + timedelta(days=offset)
+            return
+        
+        created = habit.get('created_date')
+        dtstart = datetime.fromisoformat(str(created)[:10]) if created else datetime.combine(start_date, datetime.min.time())
+        window_start = datetime.combine(start_date, datetime.min.time())
+        for occurrence in rule.occurrences(dtstart, window_start, window_start + timedelta(days=(end_date - start_date).days + 1)):
+            yield occurrence.date()
+
+    def is_habit_due(self, habit: Dict, day: date = None) -> bool:
+        """Нужно ли выполнять привычку в этот день (по умолчанию сегодня)"""
+        day = day or date.today()
+        return next(self.iter_habit_due_dates(habit, day, day), None) is not None
+
     def reset_daily_habits_counters(self, user_id: int) -> bool:
         """Сброс ежедневных счетчиков привычек для пользователя"""
         try:
@@ -542,7 +1389,7 @@ class Database:
     def get_setting(self, key: str) -> str:
         """Получение настройки из базы данных"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('SELECT setting_value FROM settings WHERE setting_key = ?', (key,))
                 result = cursor.fetchone()
@@ -551,6 +1398,77 @@ class Database:
             print(f"Error getting setting {key}: {e}")
             return None
 
+    def set_settings(self, settings: Dict[str, str]) -> bool:
+        """Сохранение нескольких настроек одной транзакцией"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.executemany('''
+                    INSERT INTO settings (setting_key, setting_value, updated_at)
+                    VALUES (?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(setting_key) DO UPDATE SET
+                        setting_value = excluded.setting_value,
+                        updated_at = excluded.updated_at
+                ''', list(settings.items()))
+                conn.commit()
+                return True
+        except Exception as e:
+            print(f"Error saving settings: {e}")
+            return False
+
+    def get_settings(self) -> Dict[str, str]:
+        """Все настройки (локальная копия листа Google Sheets)"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT setting_key, setting_value FROM settings')
+                return dict(cursor.fetchall())
+        except Exception as e:
+            print(f"Error getting settings: {e}")
+            return {}
+
+    def delete_settings(self, keys: List[str]) -> bool:
+        """Удаление настроек, убранных из листа Google Sheets"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.executemany('DELETE FROM settings WHERE setting_key = ?', [(key,) for key in keys])
+                conn.commit()
+                return True
+        except Exception as e:
+            print(f"Error deleting settings: {e}")
+            return False
+
+    def get_internal_setting(self, key: str) -> Optional[str]:
+        """Служебное значение бота (не зеркалится в Google Sheets)"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT setting_value FROM internal_settings WHERE setting_key = ?', (key,))
+                result = cursor.fetchone()
+                return result[0] if result else None
+        except Exception as e:
+            print(f"Error getting internal setting {key}: {e}")
+            return None
+
+    def set_internal_settings(self, settings: Dict[str, str]) -> bool:
+        """Сохранение служебных значений бота одной транзакцией"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.executemany('''
+                    INSERT INTO internal_settings (setting_key, setting_value, updated_at)
+                    VALUES (?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(setting_key) DO UPDATE SET
+                        setting_value = excluded.setting_value,
+                        updated_at = excluded.updated_at
+                ''', list(settings.items()))
+                conn.commit()
+                return True
+        except Exception as e:
+            print(f"Error saving internal settings: {e}")
+            return False
+
     def get_users_with_active_habits(self) -> List[int]:
         """Получение списка пользователей с активными привычками"""
         try:
@@ -587,10 +1505,54 @@ class Database:
             logger.error(f"Error getting habit progress: {e}")
             return 0
 
+    def get_habits_progress(self, user_id: int, days: int = 30) -> Dict[int, Dict[str, int]]:
+        """Прогресс всех привычек пользователя одним запросом: сегодня и за период"""
+        try:
+            from datetime import timedelta
+
+            today = date.today()
+            start_date = today - timedelta(days=days-1)
+
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT habit_id,
+                           SUM(CASE WHEN completion_date = ? THEN 1 ELSE 0 END),
+                           COUNT(*)
+                    FROM habit_logs
+                    WHERE user_id = ? AND completed = 1
+                    AND completion_date >= ? AND completion_date <= ?
+                    GROUP BY habit_id
+                ''', (today.isoformat(), user_id, start_date.isoformat(), today.isoformat()))
+
+                return {
+                    row[0]: {'today_count': row[1] or 0, 'period_count': row[2] or 0}
+                    for row in cursor.fetchall()
+                }
+        except Exception as e:
+            print(f"Error getting habits progress: {e}")
+            return {}
+
+    def get_habit_daily_counts(self, user_id: int, start_date: date) -> List[Tuple[int, str, int]]:
+        """Число выполнений каждой привычки пользователя по дням начиная с start_date"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT habit_id, completion_date, COUNT(*)
+                    FROM habit_logs
+                    WHERE user_id = ? AND completed = 1 AND completion_date >= ?
+                    GROUP BY habit_id, completion_date
+                ''', (user_id, start_date.isoformat()))
+                return cursor.fetchall()
+        except Exception as e:
+            print(f"Error getting habit daily counts: {e}")
+            return []
+
     def get_user_timezone_settings(self, user_id: int) -> dict:
         """Получение настроек часового пояса и времени push-уведомлений пользователя"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT timezone, push_start_hour, push_end_hour, push_enabled
@@ -628,7 +1590,7 @@ class Database:
                                     push_enabled: bool = None) -> bool:
         """Обновление настроек часового пояса и времени push-уведомлений"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 
                 updates = []
@@ -661,7 +1623,7 @@ class Database:
     def get_all_users_with_timezone_settings(self) -> List[Dict]:
         """Получение всех пользователей с их настройками часового пояса"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT user_id, first_name, timezone, push_start_hour, push_end_hour, push_enabled
@@ -685,5 +1647,523 @@ class Database:
             print(f"Error getting users with timezone settings: {e}")
             return []
 
-# Создаем глобальный экземпляр базы данных для обратной совместимости
-db = Database()
+    # Цели
+    GOAL_COLUMNS = ('goal_id', 'user_id', 'goal_text', 'goal_type', 'status', 'progress_data',
+                    'created_date', 'due_date', 'completed_date')
+
+    def add_goal(self, user_id: int, goal_text: str, goal_type: str = 'daily', due_date=None) -> Optional[int]:
+        """Добавление цели; возвращает goal_id"""
+        goal_ids = self.add_goals(user_id, [goal_text], goal_type, due_date)
+        return goal_ids[0] if goal_ids else None
+
+    def add_goals(self, user_id: int, goal_texts: List[str], goal_type: str = 'daily', due_date=None) -> List[int]:
+        """Добавление нескольких целей одной транзакцией; возвращает их goal_id"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                goal_ids = []
+                for goal_text in goal_texts:
+                    cursor.execute('''
+                        INSERT INTO goals (user_id, goal_text, goal_type, due_date)
+                        VALUES (?, ?, ?, ?)
+                    ''', (user_id, goal_text, goal_type, due_date.isoformat() if due_date else None))
+                    goal_ids.append(cursor.lastrowid)
+                conn.commit()
+                return goal_ids
+        except Exception as e:
+            print(f"Error adding goals: {e}")
+            return []
+
+    def get_user_goals(self, user_id: int, goal_type: str = None, date_filter=None,
+                       status: str = None) -> List[Dict]:
+        """Цели пользователя (по индексу idx_goals_user_type_due_status)"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                query = f'SELECT {", ".join(self.GOAL_COLUMNS)} FROM goals WHERE user_id = ?'
+                params = [user_id]
+                if goal_type:
+                    query += ' AND goal_type = ?'
+                    params.append(goal_type)
+                if date_filter:
+                    query += ' AND due_date = ?'
+                    params.append(date_filter.isoformat())
+                if status:
+                    query += ' AND status = ?'
+                    params.append(status)
+                query += ' ORDER BY goal_id'
+                
+                cursor.execute(query, params)
+                return [dict(zip(self.GOAL_COLUMNS, row)) for row in cursor.fetchall()]
+        except Exception as e:
+            print(f"Error getting user goals: {e}")
+            return []
+
+    def update_goal_status(self, goal_id: int, status: str, user_id: int = None) -> bool:
+        """Смена статуса цели (с проверкой владельца, если указан user_id)"""
+        return self.update_goals_status([goal_id], status, user_id) > 0
+
+    def update_goals_status(self, goal_ids: List[int], status: str, user_id: int = None) -> int:
+        """Смена статуса нескольких целей одним запросом; возвращает число обновленных"""
+        if not goal_ids:
+            return 0
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                query = f'''
+                    UPDATE goals
+                    SET status = ?,
+                        completed_date = CASE WHEN ? = 'completed' THEN CURRENT_TIMESTAMP END
+                    WHERE goal_id IN ({", ".join("?" * len(goal_ids))})
+                '''
+                params = [status, status] + list(goal_ids)
+                if user_id is not None:
+                    query += ' AND user_id = ?'
+                    params.append(user_id)
+                cursor.execute(query, params)
+                conn.commit()
+                return cursor.rowcount
+        except Exception as e:
+            print(f"Error updating goals status: {e}")
+            return 0
+
+    def iter_report_goals(self, target_date):
+        """Цели для ежедневных отчетов одним упорядоченным запросом.
+        
+        Лениво отдает (user_id, daily_goals, monthly_goals) для активных пользователей, у которых
+        есть ежедневные цели на target_date или месячные цели; остальные пользователи не читаются.
+        """
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                columns = ", ".join(f"g.{column}" for column in self.GOAL_COLUMNS)
+                cursor.execute(f'''
+                    SELECT {columns}
+                    FROM goals g
+                    JOIN users u ON u.user_id = g.user_id
+                    WHERE u.is_active = 1
+                      AND ((g.goal_type = 'daily' AND g.due_date = ?) OR g.goal_type = 'monthly')
+                    ORDER BY g.user_id, g.goal_id
+                ''', (target_date.isoformat(),))
+                
+                rows = (dict(zip(self.GOAL_COLUMNS, row)) for row in cursor)
+                for user_id, user_goals in groupby(rows, key=lambda goal: goal['user_id']):
+                    daily_goals, monthly_goals = [], []
+                    for goal in user_goals:
+                        (daily_goals if goal['goal_type'] == 'daily' else monthly_goals).append(goal)
+                    yield user_id, daily_goals, monthly_goals
+        except Exception as e:
+            print(f"Error iterating report goals: {e}")
+
+    def get_incomplete_daily_goals(self, target_date) -> Dict[int, Dict]:
+        """Невыполненные ежедневные цели на дату по всем пользователям одним запросом.
+        
+        {user_id: {'first_name': ..., 'goals': [goal_text, ...]}} — по частичному индексу
+        idx_goals_daily_incomplete; как и в отчетах, только активные пользователи
+        (заблокировавшие бота получают is_active = 0).
+        """
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT g.user_id, u.first_name, g.goal_text
+                    FROM goals g
+                    JOIN users u ON u.user_id = g.user_id
+                    WHERE u.is_active = 1
+                      AND g.goal_type = 'daily' AND g.status != 'completed' AND g.due_date = ?
+                    ORDER BY g.user_id, g.goal_id
+                ''', (target_date.isoformat(),))
+                
+                users = {}
+                for user_id, first_name, goal_text in cursor.fetchall():
+                    users.setdefault(user_id, {'first_name': first_name, 'goals': []})['goals'].append(goal_text)
+                return users
+        except Exception as e:
+            print(f"Error getting incomplete daily goals: {e}")
+            return {}
+
+    def get_users_with_incomplete_goals(self, target_date) -> List[int]:
+        """Пользователи с невыполненными ежедневными целями на дату"""
+        return list(self.get_incomplete_daily_goals(target_date))
+
+    # Календарь событий
+    EVENT_COLUMNS = ('event_id', 'user_id', 'event_title', 'event_description', 'event_type',
+                     'start_datetime', 'end_datetime', 'is_all_day', 'reminder_minutes',
+                     'recurrence_rule', 'status', 'created_date')
+
+    def _event_from_row(self, row) -> Dict:
+        """Словарь события из строки calendar_events"""
+        return dict(zip(self.EVENT_COLUMNS, row))
+
+    def _events_range_filter(self, start_date: str = None, end_date: str = None):
+        """Условия на start_datetime без функций над столбцом, чтобы работал индекс"""
+        conditions = []
+        params = []
+        if start_date:
+            # 'YYYY-MM-DD' <= 'YYYY-MM-DD HH:MM' — строки ISO сравниваются как даты
+            conditions.append('start_datetime >= ?')
+            params.append(start_date)
+        if end_date:
+            next_day = date.fromordinal(date.fromisoformat(end_date[:10]).toordinal() + 1)
+            conditions.append('start_datetime < ?')
+            params.append(next_day.isoformat())
+        return conditions, params
+
+    def create_event(self, user_id: int, event_title: str, event_description: str = None,
+                     event_type: str = 'custom', start_datetime: str = None,
+                     reminder_minutes: int = None, end_datetime: str = None,
+                     is_all_day: bool = False, recurrence_rule: str = None) -> Optional[int]:
+        """Создание события; возвращает event_id (recurrence_rule — правило повторения)"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT INTO calendar_events 
+                    (user_id, event_title, event_description, event_type, start_datetime,
+                     end_datetime, is_all_day, reminder_minutes, recurrence_rule)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (user_id, event_title, event_description, event_type, start_datetime,
+                      end_datetime, is_all_day, reminder_minutes, normalize_rule(recurrence_rule)))
+                conn.commit()
+                return cursor.lastrowid
+        except Exception as e:
+            print(f"Error creating calendar event: {e}")
+            return None
+
+    def get_event_by_id(self, event_id: int, user_id: int = None) -> Optional[Dict]:
+        """Получение события по первичному ключу (с проверкой владельца, если указан user_id)"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                query = f'SELECT {", ".join(self.EVENT_COLUMNS)} FROM calendar_events WHERE event_id = ?'
+                params = [event_id]
+                if user_id is not None:
+                    query += ' AND user_id = ?'
+                    params.append(user_id)
+                cursor.execute(query, params)
+                row = cursor.fetchone()
+                return self._event_from_row(row) if row else None
+        except Exception as e:
+            print(f"Error getting event {event_id}: {e}")
+            return None
+
+    def get_user_events(self, user_id: int, start_date: str = None, end_date: str = None,
+                        limit: int = None, after: tuple = None) -> List[Dict]:
+        """Получение событий пользователя.
+        
+        start_date/end_date — даты 'YYYY-MM-DD' включительно. Постранично: limit событий
+        после курсора after = (start_datetime, event_id) в порядке индекса
+        idx_calendar_events_user_start.
+        """
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                conditions, params = self._events_range_filter(start_date, end_date)
+                if after is not None:
+                    conditions.append('(start_datetime, event_id) > (?, ?)')
+                    params.extend(after)
+                
+                query = f'SELECT {", ".join(self.EVENT_COLUMNS)} FROM calendar_events WHERE user_id = ?'
+                for condition in conditions:
+                    query += f' AND {condition}'
+                query += ' ORDER BY start_datetime, event_id'
+                if limit is not None:
+                    query += ' LIMIT ?'
+                    params.append(limit)
+                
+                cursor.execute(query, [user_id] + params)
+                return [self._event_from_row(row) for row in cursor.fetchall()]
+        except Exception as e:
+            print(f"Error getting user events: {e}")
+            return []
+
+    def count_user_events(self, user_id: int, start_date: str = None, end_date: str = None) -> int:
+        """Количество событий пользователя в диапазоне дат (по индексу)"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                conditions, params = self._events_range_filter(start_date, end_date)
+                query = 'SELECT COUNT(*) FROM calendar_events WHERE user_id = ?'
+                for condition in conditions:
+                    query += f' AND {condition}'
+                cursor.execute(query, [user_id] + params)
+                return cursor.fetchone()[0]
+        except Exception as e:
+            print(f"Error counting user events: {e}")
+            return 0
+
+    def _expand_event(self, event: Dict, window_start: datetime, window_end: datetime,
+                      exceptions: Dict[tuple, str] = None):
+        """Вхождения повторяющегося события в окне: копии события с start_datetime вхождения"""
+        rule = parse_rule(event['recurrence_rule'])
+        for occurrence in rule.occurrences(datetime.fromisoformat(event['start_datetime']), window_start, window_end):
+            start = occurrence.isoformat(sep=' ')
+            status = (exceptions or {}).get((event['event_id'], start))
+            # Отмененное вхождение пропускается, выполненное — со своим статусом
+            if status == 'cancelled':
+                continue
+            yield dict(event, start_datetime=start, status=status or event['status'])
+
+    def iter_event_occurrences(self, user_id: int, window_start: datetime, window_end: datetime,
+                               after: tuple = None):
+        """Вхождения событий пользователя в [window_start, window_end) по (start_datetime, event_id).
+        
+        Разовые события читаются по индексу idx_calendar_events_user_start, повторяющиеся —
+        по idx_calendar_events_recurring и разворачиваются лениво, без записи вхождений
+        в таблицу. after = (start_datetime, event_id) — курсор предыдущей страницы.
+        """
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                columns = ", ".join(self.EVENT_COLUMNS)
+                cursor.execute(f'''
+                    SELECT {columns} FROM calendar_events
+                    WHERE user_id = ? AND recurrence_rule IS NOT NULL AND start_datetime < ?
+                ''', (user_id, window_end.isoformat(sep=' ')))
+                series = [self._event_from_row(row) for row in cursor.fetchall()]
+                
+                exceptions = {}
+                if series:
+                    cursor.execute('''
+                        SELECT x.event_id, x.occurrence_start, x.status
+                        FROM event_occurrence_exceptions x
+                        JOIN calendar_events e ON e.event_id = x.event_id
+                        WHERE e.user_id = ? AND x.occurrence_start >= ? AND x.occurrence_start < ?
+                    ''', (user_id, window_start.isoformat(sep=' '), window_end.isoformat(sep=' ')))
+                    exceptions = {(event_id, start): status for event_id, start, status in cursor.fetchall()}
+                
+                cursor.execute(f'''
+                    SELECT {columns} FROM calendar_events
+                    WHERE user_id = ? AND start_datetime >= ? AND start_datetime < ?
+                      AND recurrence_rule IS NULL
+                    ORDER BY start_datetime, event_id
+                ''', (user_id, window_start.isoformat(sep=' '), window_end.isoformat(sep=' ')))
+                single = (self._event_from_row(row) for row in cursor)
+                
+                streams = [single] + [self._expand_event(event, window_start, window_end, exceptions)
+                                      for event in series]
+                key = lambda event: (datetime.fromisoformat(event['start_datetime']), event['event_id'])
+                cursor_key = (datetime.fromisoformat(after[0]), after[1]) if after else None
+                for event in heapq.merge(*streams, key=key):
+                    if cursor_key is None or key(event) > cursor_key:
+                        yield event
+        except Exception as e:
+            print(f"Error iterating event occurrences: {e}")
+
+    def get_event_occurrences(self, user_id: int, start_date: str, end_date: str,
+                              limit: int = None, after: tuple = None) -> List[Dict]:
+        """Вхождения событий за даты 'YYYY-MM-DD' включительно (постранично, как get_user_events)"""
+        window_start = datetime.fromisoformat(start_date[:10])
+        window_end = datetime.fromisoformat(end_date[:10]) + timedelta(days=1)
+        return list(islice(self.iter_event_occurrences(user_id, window_start, window_end, after), limit))
+
+    def count_event_occurrences(self, user_id: int, start_date: str, end_date: str) -> int:
+        """Количество вхождений событий за даты 'YYYY-MM-DD' включительно"""
+        window_start = datetime.fromisoformat(start_date[:10])
+        window_end = datetime.fromisoformat(end_date[:10]) + timedelta(days=1)
+        return sum(1 for _ in self.iter_event_occurrences(user_id, window_start, window_end))
+
+    def get_upcoming_event_reminders(self, window_start: datetime, window_end: datetime,
+                                     max_reminder_minutes: int = 1440, event_id: int = None,
+                                     user_id: int = None) -> List[Dict]:
+        """Неотправленные напоминания, время срабатывания которых (UTC) попадает в [window_start, window_end).
+        
+        Начало события хранится во времени пользователя: 'start' — по его часам,
+        'start_at' и 'fire_at' — в UTC по users.timezone. Повторяющиеся события дают
+        по напоминанию на каждое вхождение в окне; отправленные отмечены в
+        event_reminders_sent по (event_id, occurrence_start). event_id и user_id —
+        только для одного события или пользователя (изменения в движке напоминаний).
+        """
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                filters, filter_params = '', ()
+                if event_id is not None:
+                    filters, filter_params = filters + ' AND e.event_id = ?', filter_params + (event_id,)
+                if user_id is not None:
+                    filters, filter_params = filters + ' AND e.user_id = ?', filter_params + (user_id,)
+                # Окно в UTC расширяется до любого часового пояса, точный отбор — после перевода в UTC
+                local_start = window_start - MAX_UTC_OFFSET
+                local_end = window_end + MAX_UTC_OFFSET
+                latest_start = (local_end + timedelta(minutes=max_reminder_minutes)).isoformat(sep=' ')
+                
+                # Разовые события: диапазон по началу — по частичному индексу idx_calendar_events_reminders
+                cursor.execute(f'''
+                    SELECT e.event_id, e.user_id, u.timezone, e.event_title, e.start_datetime, e.reminder_minutes
+                    FROM calendar_events e
+                    LEFT JOIN users u ON u.user_id = e.user_id
+                    WHERE e.status = 'scheduled' AND e.reminder_minutes IS NOT NULL
+                      AND e.start_datetime >= ? AND e.start_datetime < ?
+                      AND e.recurrence_rule IS NULL{filters}
+                      AND NOT EXISTS (
+                          SELECT 1 FROM event_reminders_sent s
+                          WHERE s.event_id = e.event_id AND s.occurrence_start = e.start_datetime
+                      )
+                ''', (local_start.isoformat(sep=' '), latest_start) + filter_params)
+                occurrences = [
+                    (event_id_, user_id_, timezone_name, title, start_datetime, datetime.fromisoformat(start_datetime),
+                     reminder_minutes)
+                    for event_id_, user_id_, timezone_name, title, start_datetime, reminder_minutes in cursor.fetchall()
+                ]
+                
+                # Повторяющиеся: серии по idx_calendar_events_recurring, вхождения — правилом
+                cursor.execute(f'''
+                    SELECT e.event_id, e.user_id, u.timezone, e.event_title, e.start_datetime, e.reminder_minutes,
+                           e.recurrence_rule
+                    FROM calendar_events e
+                    LEFT JOIN users u ON u.user_id = e.user_id
+                    WHERE e.recurrence_rule IS NOT NULL AND e.start_datetime < ?
+                      AND e.status = 'scheduled' AND e.reminder_minutes IS NOT NULL{filters}
+                ''', (latest_start,) + filter_params)
+                for event_id_, user_id_, timezone_name, title, start_datetime, reminder_minutes, rule_text in cursor.fetchall():
+                    offset = timedelta(minutes=reminder_minutes)
+                    series = parse_rule(rule_text).occurrences(
+                        datetime.fromisoformat(start_datetime), local_start + offset, local_end + offset)
+                    starts = [occurrence.isoformat(sep=' ') for occurrence in series]
+                    if not starts:
+                        continue
+                    # Отправленные, а также выполненные или отмененные вхождения
+                    cursor.execute('''
+                        SELECT occurrence_start FROM event_reminders_sent
+                        WHERE event_id = ? AND occurrence_start >= ? AND occurrence_start <= ?
+                        UNION
+                        SELECT occurrence_start FROM event_occurrence_exceptions
+                        WHERE event_id = ? AND occurrence_start >= ? AND occurrence_start <= ?
+                    ''', (event_id_, starts[0], starts[-1]) * 2)
+                    sent = {row[0] for row in cursor.fetchall()}
+                    occurrences.extend(
+                        (event_id_, user_id_, timezone_name, title, start, datetime.fromisoformat(start), reminder_minutes)
+                        for start in starts if start not in sent
+                    )
+                
+                reminders = []
+                for event_id_, user_id_, timezone_name, title, occurrence_start, start, reminder_minutes in occurrences:
+                    start_at = local_to_utc(start, timezone_name)
+                    fire_at = start_at - timedelta(minutes=reminder_minutes)
+                    if window_start <= fire_at < window_end:
+                        reminders.append({
+                            'event_id': event_id_,
+                            'user_id': user_id_,
+                            'event_title': title,
+                            'occurrence_start': occurrence_start,
+                            'start': start,
+                            'start_at': start_at,
+                            'fire_at': fire_at
+                        })
+                return reminders
+        except Exception as e:
+            print(f"Error getting upcoming event reminders: {e}")
+            return []
+
+    def mark_event_reminders_sent(self, occurrences: List[tuple]) -> bool:
+        """Отметка отправленных напоминаний: [(event_id, occurrence_start)] одной транзакцией"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.executemany('''
+                    INSERT OR IGNORE INTO event_reminders_sent (event_id, occurrence_start) VALUES (?, ?)
+                ''', occurrences)
+                conn.commit()
+                return True
+        except Exception as e:
+            print(f"Error marking event reminders sent: {e}")
+            return False
+
+    def complete_event(self, event_id: int, user_id: int) -> bool:
+        """Отметка события как выполненного"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    UPDATE calendar_events 
+                    SET status = 'completed' 
+                    WHERE event_id = ? AND user_id = ?
+                ''', (event_id, user_id))
+                conn.commit()
+                return cursor.rowcount > 0
+        except Exception as e:
+            print(f"Error completing event: {e}")
+            return False
+
+    def delete_event(self, event_id: int, user_id: int) -> bool:
+        """Удаление события (для повторяющегося — всей серии)"""
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    DELETE FROM calendar_events 
+                    WHERE event_id = ? AND user_id = ?
+                ''', (event_id, user_id))
+                deleted = cursor.rowcount > 0
+                if deleted:
+                    cursor.execute('DELETE FROM event_occurrence_exceptions WHERE event_id = ?', (event_id,))
+                conn.commit()
+                return deleted
+        except Exception as e:
+            print(f"Error deleting event: {e}")
+            return False
+
+    def get_event_occurrence(self, event_id: int, user_id: int, occurrence_start: str) -> Optional[Dict]:
+        """Вхождение повторяющегося события с его статусом; None, если такого вхождения нет или оно отменено"""
+        event = self.get_event_by_id(event_id, user_id)
+        if not event or not event['recurrence_rule']:
+            return None
+        start = datetime.fromisoformat(occurrence_start)
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT status FROM event_occurrence_exceptions
+                    WHERE event_id = ? AND occurrence_start = ?
+                ''', (event_id, start.isoformat(sep=' ')))
+                row = cursor.fetchone()
+        except Exception as e:
+            print(f"Error getting event occurrence: {e}")
+            return None
+        exceptions = {(event_id, start.isoformat(sep=' ')): row[0]} if row else None
+        return next(self._expand_event(event, start, start + timedelta(minutes=1), exceptions), None)
+
+    def _set_occurrence_status(self, event_id: int, user_id: int, occurrence_start: str, status: str) -> bool:
+        """Исключение для одного вхождения серии: остальные вхождения не меняются"""
+        event = self.get_event_by_id(event_id, user_id)
+        if not event or not event['recurrence_rule']:
+            return False
+        start = datetime.fromisoformat(occurrence_start)
+        # Только настоящее вхождение правила, а не произвольное время
+        if next(self._expand_event(event, start, start + timedelta(minutes=1)), None) is None:
+            return False
+        try:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT INTO event_occurrence_exceptions (event_id, occurrence_start, status)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(event_id, occurrence_start) DO UPDATE SET
+                        status = excluded.status,
+                        updated_at = CURRENT_TIMESTAMP
+                ''', (event_id, start.isoformat(sep=' '), status))
+                conn.commit()
+                return True
+        except Exception as e:
+            print(f"Error saving event occurrence: {e}")
+            return False
+
+    def complete_event_occurrence(self, event_id: int, user_id: int, occurrence_start: str) -> bool:
+        """Отметка одного вхождения повторяющегося события как выполненного"""
+        return self._set_occurrence_status(event_id, user_id, occurrence_start, 'completed')
+
+    def cancel_event_occurrence(self, event_id: int, user_id: int, occurrence_start: str) -> bool:
+        """Отмена одного вхождения повторяющегося события"""
+        return self._set_occurrence_status(event_id, user_id, occurrence_start, 'cancelled')
+
+# Глобальный экземпляр базы данных для обратной совместимости — база из контекста приложения
+def get_db() -> Database:
+    """Глобальный экземпляр базы данных"""
+    from app_context import app_context
+    return app_context.db
+
+def __getattr__(name):
+    # Ленивый атрибут модуля: `from database import db`
+    if name == 'db':
+        return get_db()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
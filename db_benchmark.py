@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк горячих путей Database на синтетических данных.
+
+Генератор с фиксированным seed создает N пользователей, M привычек на
+пользователя, K дней habit_logs, рефералов и событий календаря; затем
+каждый метод вызывается на случайных пользователях и привычках, и
+печатаются p50/p95/p99. Результаты сохраняются в JSON для сравнения
+между прогонами.
+
+Запуск:
+    python3 db_benchmark.py --scales 100x3x30,1000x3x30 --iterations 300 --output bench/after.json
+    python3 db_benchmark.py --compare bench/before.json --output bench/after.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, List, Tuple
+
+from database import Database
+from referral_codes import encode_referral_code
+
+# Масштабы по умолчанию: пользователи x привычек на пользователя x дней логов
+DEFAULT_SCALES = "100x3x30,1000x3x30"
+
+TIMEZONES = ('UTC', 'Europe/Moscow', 'Asia/Yekaterinburg', 'Asia/Novosibirsk', 'Europe/Berlin')
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль q (0..100) методом ближайшего ранга"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(round(q / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def parse_scale(text: str) -> Tuple[int, int, int]:
+    """'1000x3x30' -> (пользователи, привычек на пользователя, дней)"""
+    users, habits, days = (int(part) for part in text.lower().split('x'))
+    return users, habits, days
+
+
+def generate_dataset(db_path: str, users: int, habits_per_user: int, days: int, seed: int = 42) -> Database:
+    """Синтетическая база: схема из Database, данные — пакетными вставками"""
+    rng = random.Random(seed)
+    db = Database(db_path)
+    today = date.today()
+
+    with sqlite3.connect(db_path) as conn:
+        cursor = conn.cursor()
+
+        cursor.executemany('''
+            INSERT INTO users (user_id, username, first_name, referral_code, referred_by, timezone,
+                               push_start_hour, push_end_hour, push_enabled, status, is_active)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [
+            (user_id, f"user{user_id}", f"User {user_id}", encode_referral_code(user_id),
+             None, rng.choice(TIMEZONES), rng.randint(6, 10), rng.randint(20, 23),
+             rng.random() > 0.1, 'active' if rng.random() > 0.05 else 'blocked', True)
+            for user_id in range(1, users + 1)
+        ])
+
+        # Рефералы: примерно треть пользователей приглашена кем-то из зарегистрированных раньше
+        referrals = [
+            (rng.randint(1, user_id - 1), user_id, round(rng.random() * 10, 2))
+            for user_id in range(2, users + 1) if rng.random() < 0.3
+        ]
+        cursor.executemany('''
+            INSERT INTO referrals (referrer_user_id, referred_user_id, earnings) VALUES (?, ?, ?)
+        ''', referrals)
+        cursor.executemany('UPDATE users SET referred_by = ? WHERE user_id = ?',
+                           [(referrer, referred) for referrer, referred, _ in referrals])
+
+        habit_rows = []
+        for user_id in range(1, users + 1):
+            for index in range(habits_per_user):
+                habit_rows.append((user_id, f"Habit {index + 1}", rng.choice(('daily', 'weekly')),
+                                   rng.randint(1, 3), (today - timedelta(days=days)).isoformat()))
+        cursor.executemany('''
+            INSERT INTO habits (user_id, habit_name, habit_type, target_frequency, created_date)
+            VALUES (?, ?, ?, ?, ?)
+        ''', habit_rows)
+
+        cursor.execute('SELECT habit_id, user_id, target_frequency FROM habits')
+        habits = cursor.fetchall()
+        log_rows = []
+        for habit_id, user_id, target_frequency in habits:
+            for offset in range(days):
+                day = (today - timedelta(days=offset)).isoformat()
+                for _ in range(rng.randint(0, target_frequency)):
+                    log_rows.append((habit_id, user_id, day, True, f"{day} {rng.randint(6, 23):02d}:00:00"))
+        cursor.executemany('''
+            INSERT INTO habit_logs (habit_id, user_id, completion_date, completed, timestamp)
+            VALUES (?, ?, ?, ?, ?)
+        ''', log_rows)
+
+        now = datetime.now().replace(second=0, microsecond=0)
+        event_rows = []
+        for user_id in range(1, users + 1):
+            for _ in range(rng.randint(0, 5)):
+                start = now + timedelta(days=rng.randint(-days, days), hours=rng.randint(0, 23))
+                event_rows.append((user_id, f"Event {len(event_rows)}", rng.choice(('task', 'meeting', 'workout')),
+                                   start.isoformat(sep=' '), rng.choice((None, 15, 60)),
+                                   'FREQ=WEEKLY' if rng.random() < 0.1 else None))
+        cursor.executemany('''
+            INSERT INTO calendar_events (user_id, event_title, event_type, start_datetime, reminder_minutes,
+                                         recurrence_rule)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', event_rows)
+
+        # Агрегаты, дерево рефералов и счетчики — как после миграции существующей базы
+        db._rebuild_referral_stats(cursor)
+        db._rebuild_referral_closure(cursor)
+        db._rebuild_stats(cursor)
+        conn.commit()
+
+    return db
+
+
+def time_operation(operation: Callable[[], object], iterations: int) -> List[float]:
+    """Длительности вызовов в миллисекундах"""
+    durations = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        operation()
+        durations.append((time.perf_counter() - started) * 1000)
+    return durations
+
+
+def run_scale(users: int, habits_per_user: int, days: int, iterations: int, seed: int,
+              work_dir: str) -> List[Dict]:
+    """Прогон всех операций на одном масштабе"""
+    db_path = os.path.join(work_dir, f"bench_{users}x{habits_per_user}x{days}.db")
+    started = time.perf_counter()
+    db = generate_dataset(db_path, users, habits_per_user, days, seed)
+    generation_seconds = time.perf_counter() - started
+
+    with sqlite3.connect(db_path) as conn:
+        habits = conn.execute('SELECT user_id, habit_id FROM habits').fetchall()
+        log_count = conn.execute('SELECT COUNT(*) FROM habit_logs').fetchone()[0]
+    print(f"\n=== {users} пользователей x {habits_per_user} привычек x {days} дней "
+          f"({log_count} логов, генерация {generation_seconds:.1f} с) ===")
+
+    rng = random.Random(seed)
+
+    def random_habit():
+        return habits[rng.randrange(len(habits))]
+
+    def random_user():
+        return rng.randint(1, users)
+
+    # Запись идет последней: она меняет данные для остальных операций
+    operations = [
+        ('get_habit_stats', lambda: db.get_habit_stats(*random_habit())),
+        ('get_habit_progress_today', lambda: db.get_habit_progress_today(*random_habit())),
+        ('get_user_habits', lambda: db.get_user_habits(random_user())),
+        ('get_referral_stats', lambda: db.get_referral_stats(random_user())),
+        ('get_all_users_with_timezone_settings', lambda: db.get_all_users_with_timezone_settings()),
+        ('log_habit_completion', lambda: db.log_habit_completion(*reversed(random_habit()))),
+    ]
+
+    results = []
+    for name, operation in operations:
+        # Полный список пользователей дорогой — для него меньше повторов
+        count = max(iterations // 10, 5) if name == 'get_all_users_with_timezone_settings' else iterations
+        durations = time_operation(operation, count)
+        result = {
+            'scale': {'users': users, 'habits_per_user': habits_per_user, 'days': days},
+            'operation': name,
+            'iterations': count,
+            'p50_ms': percentile(durations, 50),
+            'p95_ms': percentile(durations, 95),
+            'p99_ms': percentile(durations, 99),
+            'mean_ms': sum(durations) / len(durations),
+        }
+        results.append(result)
+        print(f"{name:40s} p50 {result['p50_ms']:8.3f} мс  p95 {result['p95_ms']:8.3f} мс  "
+              f"p99 {result['p99_ms']:8.3f} мс")
+    return results
+
+
+def result_key(result: Dict) -> tuple:
+    """Ключ для сопоставления результатов разных прогонов"""
+    scale = result['scale']
+    return scale['users'], scale['habits_per_user'], scale['days'], result['operation']
+
+
+def compare(baseline_path: str, results: List[Dict]):
+    """Сравнение с сохраненным прогоном: отношение p50 и p95 (меньше 1 — быстрее)"""
+    with open(baseline_path, encoding='utf-8') as baseline_file:
+        baseline = {result_key(result): result for result in json.load(baseline_file)['results']}
+
+    print(f"\n=== Сравнение с {baseline_path} ===")
+    for result in results:
+        before = baseline.get(result_key(result))
+        if before is None:
+            continue
+        users, habits_per_user, days, name = result_key(result)
+        p50_ratio = result['p50_ms'] / before['p50_ms'] if before['p50_ms'] else float('nan')
+        p95_ratio = result['p95_ms'] / before['p95_ms'] if before['p95_ms'] else float('nan')
+        print(f"{users}x{habits_per_user}x{days} {name:40s} p50 x{p50_ratio:.2f}  p95 x{p95_ratio:.2f}")
+
+
+def git_revision() -> str:
+    """Текущий коммит, если запуск из git-репозитория"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк методов Database")
+    parser.add_argument('--scales', default=DEFAULT_SCALES,
+                        help="Масштабы через запятую: пользователи x привычки x дни")
+    parser.add_argument('--iterations', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default=f"bench_results_{datetime.now():%Y%m%d_%H%M%S}.json")
+    parser.add_argument('--compare', help="JSON предыдущего прогона для сравнения")
+    parser.add_argument('--keep-db', action='store_true', help="Не удалять сгенерированные базы")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='db_bench_')
+    try:
+        results = []
+        for scale in args.scales.split(','):
+            results.extend(run_scale(*parse_scale(scale), args.iterations, args.seed, work_dir))
+    finally:
+        if args.keep_db:
+            print(f"\nБазы сохранены в {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'seed': args.seed,
+            'iterations': args.iterations,
+        },
+        'results': results,
+    }
+    output_dir = os.path.dirname(args.output)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as output_file:
+        json.dump(report, output_file, ensure_ascii=False, indent=2)
+    print(f"\nРезультаты сохранены в {args.output}")
+
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
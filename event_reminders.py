@@ -0,0 +1,266 @@
+"""
+Напоминания о событиях календаря по reminder_minutes.
+
+Одна задача asyncio и одна куча на все события: в куче лежат напоминания,
+срабатывающие в ближайшие EVENT_REMINDER_HORIZON_HOURS часов (по умолчанию 24).
+Горизонт сдвигается порциями, а создание, выполнение и удаление события
+меняют кучу точечно, без повторного сканирования таблицы. Сработавшие
+напоминания группируются по пользователю и отправляются пачкой через
+исходящий диспетчер; отправленные отмечаются в event_reminders_sent, поэтому
+после перезапуска они не повторяются, а пропущенные за время простоя
+(в пределах grace) досылаются. Неудачная отправка повторяется с растущей
+паузой, пока событие не началось. Повторяющиеся события дают по напоминанию
+на каждое вхождение, попавшее в горизонт.
+
+Время начала события хранится по часам пользователя (users.timezone);
+куча и цикл работают в UTC.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Set, Tuple
+
+from aiogram.exceptions import TelegramForbiddenError
+
+from app_context import app_context
+
+logger = logging.getLogger(__name__)
+
+# Повторы неудачной отправки: пауза RETRY_BASE_SECONDS, удваивается до RETRY_MAX_SECONDS
+RETRY_BASE_SECONDS = 30
+RETRY_MAX_SECONDS = 600
+MAX_SEND_ATTEMPTS = 5
+
+
+def _utcnow() -> datetime:
+    """Текущее время UTC без tzinfo (как fire_at в напоминаниях)"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class EventReminderEngine:
+    def __init__(self, context=None, horizon_hours: int = None, grace_minutes: int = 60,
+                 refresh_minutes: int = 10, batch_size: int = 100):
+        self.context = context or app_context
+        self.horizon = timedelta(hours=horizon_hours or int(os.getenv('EVENT_REMINDER_HORIZON_HOURS', '24')))
+        # Насколько в прошлое досылаются напоминания, пропущенные за время простоя
+        self.grace = timedelta(minutes=grace_minutes)
+        self.refresh_step = timedelta(minutes=refresh_minutes)
+        self.batch_size = batch_size
+
+        # (время срабатывания, порядковый номер, ключ); удаление ленивое через _pending
+        self._heap: List[Tuple[datetime, int, tuple]] = []
+        self._seq = itertools.count()
+        # (event_id, occurrence_start) -> напоминание; отправляемое остается здесь до результата
+        self._pending: Dict[tuple, Dict] = {}
+        self._by_event: Dict[int, Set[tuple]] = {}
+        self._loaded_until: Optional[datetime] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Загрузка горизонта и запуск цикла (нужен работающий event loop)"""
+        if self._task is not None:
+            return
+        now = _utcnow()
+        self._wakeup = asyncio.Event()
+        self._load_window(now - self.grace, now + self.horizon)
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Event reminder engine started with {len(self._pending)} reminders in horizon")
+
+    async def stop(self):
+        """Остановка цикла"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def _load_window(self, start: datetime, end: datetime):
+        """Загрузка напоминаний, срабатывающих в [start, end)"""
+        for reminder in self.context.db.get_upcoming_event_reminders(start, end):
+            self._push(reminder)
+        self._loaded_until = end
+
+    def _push(self, reminder: Dict) -> bool:
+        """Добавление напоминания в кучу; True, если оно стало ближайшим"""
+        key = (reminder['event_id'], reminder['occurrence_start'])
+        if key in self._pending:
+            return False
+        self._pending[key] = reminder
+        self._by_event.setdefault(reminder['event_id'], set()).add(key)
+        return self._schedule(key, reminder['fire_at'])
+
+    def _schedule(self, key: tuple, when: datetime) -> bool:
+        """Запись в куче для напоминания из _pending; True, если она стала ближайшей"""
+        is_earliest = not self._heap or when < self._heap[0][0]
+        heapq.heappush(self._heap, (when, next(self._seq), key))
+        return is_earliest
+
+    def _discard(self, key: tuple):
+        """Удаление напоминания (запись в куче будет пропущена)"""
+        reminder = self._pending.pop(key, None)
+        if reminder is None:
+            return
+        keys = self._by_event.get(reminder['event_id'])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_event[reminder['event_id']]
+
+    def on_event_created(self, event_id: int):
+        """Новое событие: его вхождения из загруженного горизонта — в кучу"""
+        if self._loaded_until is None:
+            return
+        # Дальние вхождения подхватит сдвиг горизонта; запрос — по первичному ключу
+        self._add_upcoming(event_id=event_id)
+
+    def on_user_timezone_changed(self, user_id: int):
+        """Смена часового пояса: напоминания пользователя пересчитываются"""
+        if self._loaded_until is None:
+            return
+        for key in [key for key, reminder in self._pending.items() if reminder['user_id'] == user_id]:
+            self._discard(key)
+        self._add_upcoming(user_id=user_id)
+
+    def _add_upcoming(self, **filters):
+        """Напоминания события или пользователя из загруженного горизонта — в кучу"""
+        now = _utcnow()
+        reminders = self.context.db.get_upcoming_event_reminders(now - self.grace, self._loaded_until, **filters)
+        woke = False
+        for reminder in reminders:
+            # Если время напоминания уже прошло, а событие еще впереди — напоминаем сразу
+            if reminder['start_at'] > now:
+                woke = self._push(reminder) or woke
+        if woke and self._wakeup is not None:
+            self._wakeup.set()
+
+    def on_event_removed(self, event_id: int):
+        """Событие выполнено, отменено или удалено: его напоминания больше не нужны"""
+        for key in list(self._by_event.get(event_id, ())):
+            self._discard(key)
+
+    on_event_completed = on_event_removed
+    on_event_deleted = on_event_removed
+
+    def on_occurrence_removed(self, event_id: int, occurrence_start: str):
+        """Выполнено или отменено одно вхождение повторяющегося события"""
+        self._discard((event_id, occurrence_start))
+
+    def _pop_due(self, now: datetime) -> List[Dict]:
+        """Сработавшие напоминания (не больше batch_size); из _pending их убирает результат отправки"""
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+            _, _, key = heapq.heappop(self._heap)
+            reminder = self._pending.get(key)
+            if reminder is None:
+                continue
+            due.append(reminder)
+        return due
+
+    def _retry(self, reminder: Dict, now: datetime) -> bool:
+        """Повтор неудачной отправки с растущей паузой; False — больше не пытаться"""
+        key = (reminder['event_id'], reminder['occurrence_start'])
+        if key not in self._pending:
+            # Событие выполнили или удалили, пока шла отправка
+            return False
+        attempts = reminder['attempts'] = reminder.get('attempts', 0) + 1
+        retry_at = now + timedelta(seconds=min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS))
+        if attempts >= MAX_SEND_ATTEMPTS or retry_at >= reminder['start_at']:
+            self._discard(key)
+            return False
+        self._schedule(key, retry_at)
+        return True
+
+    async def _run(self):
+        """Основной цикл: сдвиг горизонта, отправка сработавших, ожидание ближайшего"""
+        while True:
+            try:
+                now = _utcnow()
+                if now + self.horizon - self._loaded_until >= self.refresh_step:
+                    self._load_window(self._loaded_until, now + self.horizon)
+
+                due = self._pop_due(now)
+                if due:
+                    await self._send_batch(due)
+                    continue
+
+                # Спим до ближайшего напоминания, следующего сдвига горизонта или нового события
+                timeout = self.refresh_step.total_seconds()
+                if self._heap:
+                    timeout = min(timeout, max((self._heap[0][0] - now).total_seconds(), 0))
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error in event reminder loop: {e}")
+                await asyncio.sleep(60)
+
+    async def _send_batch(self, reminders: List[Dict]):
+        """Отправка пачки: одно сообщение на пользователя, отметка об отправке одной транзакцией"""
+        now = _utcnow()
+        by_user: Dict[int, List[Dict]] = {}
+        for reminder in reminders:
+            by_user.setdefault(reminder['user_id'], []).append(reminder)
+            # Задержка относительно запланированного времени напоминания (повторы не считаются)
+            if not reminder.get('attempts'):
+                self.context.metrics.observe('event_reminder_lag_seconds', (now - reminder['fire_at']).total_seconds())
+
+        results = await asyncio.gather(*(
+            self._send_user_reminders(user_id, user_reminders)
+            for user_id, user_reminders in by_user.items()
+        ))
+
+        delivered, retried = [], 0
+        now = _utcnow()
+        for user_reminders, handled in zip(by_user.values(), results):
+            for reminder in user_reminders:
+                key = (reminder['event_id'], reminder['occurrence_start'])
+                if handled:
+                    self._discard(key)
+                    delivered.append(key)
+                elif self._retry(reminder, now):
+                    retried += 1
+        if delivered:
+            self.context.db.mark_event_reminders_sent(delivered)
+        self.context.metrics.inc('event_reminders_total', len(delivered), status='sent')
+        self.context.metrics.inc('event_reminders_total', retried, status='retried')
+        self.context.metrics.inc('event_reminders_total', len(reminders) - len(delivered) - retried, status='failed')
+
+    async def _send_user_reminders(self, user_id: int, reminders: List[Dict]) -> bool:
+        """Напоминание пользователю; True — больше не отправлять (доставлено или бот заблокирован)"""
+        now = _utcnow()
+        # Без parse_mode: названия событий вводят пользователи, разметка в них ломала бы отправку
+        lines = ["🔔 Напоминание о событиях\n"] if len(reminders) > 1 else ["🔔 Напоминание о событии\n"]
+        for reminder in sorted(reminders, key=lambda item: item['start_at']):
+            minutes_left = max(int((reminder['start_at'] - now).total_seconds() // 60), 0)
+            lines.append(f"📝 {reminder['event_title']}")
+            lines.append(f"⏰ {reminder['start'].strftime('%d.%m %H:%M')} (через {minutes_left} мин.)\n")
+
+        try:
+            await self.context.outbound.send_message(user_id, "\n".join(lines))
+            return True
+        except TelegramForbiddenError:
+            return True
+        except Exception as e:
+            logger.error(f"Failed to send event reminders to user {user_id}: {e}")
+            return False
+
+    def get_stats(self) -> Dict:
+        """Состояние очереди напоминаний"""
+        return {
+            'pending': len(self._pending),
+            'heap_size': len(self._heap),
+            'loaded_until': self._loaded_until.isoformat(sep=' ') if self._loaded_until else None,
+        }
+
+
+# Глобальный экземпляр движка напоминаний (запускается в main)
+event_reminder_engine = EventReminderEngine()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Локальный fake-сервер Telegram Bot API для нагрузочного тестирования.
+
+Принимает запросы бота вида POST /bot<token>/<method>, отвечает правдоподобными
+объектами (sendMessage, editMessageText, answerCallbackQuery и др.) и считает
+вызовы по методам. Задержка ответа и доля ответов 429 с retry_after задаются
+параметрами.
+
+Запуск:
+    python3 fake_telegram_server.py --port 8081 --latency 0.05 --jitter 0.02 --rate-limit 0.01
+
+Бот направляется на сервер переменной окружения:
+    TELEGRAM_API_URL=http://127.0.0.1:8081
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+from typing import Dict
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+FAKE_BOT_USER = {'id': 100000, 'is_bot': True, 'first_name': 'AlteriA', 'username': 'Alteria_8_bot'}
+
+
+def _chat_id(value) -> int:
+    """chat_id из параметров запроса (в форме приходит строкой)"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+class FakeTelegramServer:
+    def __init__(self, latency: float = 0.05, jitter: float = 0.0, rate_limit: float = 0.0,
+                 retry_after: int = 1, seed: int = None):
+        self.latency = latency
+        self.jitter = jitter
+        # Доля запросов, на которые отвечаем 429 Too Many Requests
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._message_ids = 0
+        self.reset()
+
+    def reset(self):
+        """Обнуление счетчиков"""
+        # метод -> количество успешных ответов
+        self.calls: Dict[str, int] = {}
+        # метод -> количество ответов 429
+        self.rate_limited: Dict[str, int] = {}
+        # chat_id -> количество сообщений (sendMessage и sendPhoto)
+        self.messages_by_chat: Dict[int, int] = {}
+
+    def create_app(self) -> web.Application:
+        """Создание aiohttp-приложения"""
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle_method)
+        app.router.add_get('/stats', self.stats)
+        app.router.add_post('/reset', self.handle_reset)
+        return app
+
+    def get_stats(self) -> Dict:
+        """Счетчики вызовов"""
+        return {
+            'calls': dict(self.calls),
+            'rate_limited': dict(self.rate_limited),
+            'chats': len(self.messages_by_chat),
+        }
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.get_stats())
+
+    async def handle_reset(self, request: web.Request) -> web.Response:
+        self.reset()
+        return web.json_response({'ok': True})
+
+    async def _read_params(self, request: web.Request) -> Dict:
+        """Параметры метода: aiogram шлет форму, другие клиенты — JSON"""
+        if request.content_type == 'application/json':
+            return await request.json()
+        form = await request.post()
+        return {name: value for name, value in form.items() if isinstance(value, str)}
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        """Эмуляция вызова метода Bot API"""
+        method = request.match_info['method']
+        params = await self._read_params(request)
+
+        delay = self.latency + (self._random.uniform(-self.jitter, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if self.rate_limit and self._random.random() < self.rate_limit:
+            self.rate_limited[method] = self.rate_limited.get(method, 0) + 1
+            return web.json_response({
+                'ok': False,
+                'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.retry_after}",
+                'parameters': {'retry_after': self.retry_after}
+            }, status=429)
+
+        self.calls[method] = self.calls.get(method, 0) + 1
+        return web.json_response({'ok': True, 'result': self._result(method, params)})
+
+    def _message(self, params: Dict, message_id: int = None) -> Dict:
+        """Объект Message, как его вернул бы Telegram"""
+        if message_id is None:
+            self._message_ids += 1
+            message_id = self._message_ids
+        chat_id = _chat_id(params.get('chat_id'))
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': FAKE_BOT_USER,
+        }
+        if 'text' in params:
+            message['text'] = params['text']
+        if 'caption' in params:
+            message['caption'] = params['caption']
+        if params.get('reply_markup'):
+            markup = params['reply_markup']
+            markup = json.loads(markup) if isinstance(markup, str) else markup
+            # В ответе Telegram бывает только инлайн-клавиатура
+            if 'inline_keyboard' in markup:
+                message['reply_markup'] = markup
+        return message
+
+    def _result(self, method: str, params: Dict):
+        """Поле result ответа для метода"""
+        if method == 'getMe':
+            return FAKE_BOT_USER
+        if method in ('sendMessage', 'sendPhoto'):
+            chat_id = _chat_id(params.get('chat_id'))
+            self.messages_by_chat[chat_id] = self.messages_by_chat.get(chat_id, 0) + 1
+            message = self._message(params)
+            if method == 'sendPhoto':
+                message['photo'] = [{'file_id': 'fake-photo', 'file_unique_id': 'fake', 'width': 1, 'height': 1}]
+            return message
+        if method in ('editMessageText', 'editMessageReplyMarkup'):
+            if 'inline_message_id' in params:
+                return True
+            return self._message(params, message_id=int(params.get('message_id', 0)))
+        if method == 'getUpdates':
+            return []
+        # answerCallbackQuery, deleteMessage, setMyCommands, deleteWebhook и прочие
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake-сервер Telegram Bot API для нагрузочных тестов")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.05, help="Задержка ответа в секундах")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Разброс задержки в секундах")
+    parser.add_argument('--rate-limit', type=float, default=0.0, help="Доля ответов 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after в ответах 429")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = FakeTelegramServer(latency=args.latency, jitter=args.jitter, rate_limit=args.rate_limit,
+                                retry_after=args.retry_after)
+    web.run_app(server.create_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,43 @@
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 import os
-from typing import Dict, Optional
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
 import logging
 
 class GoogleSheetsManager:
-    def __init__(self):
+    """Настройки из Google Sheets с локальным снимком в памяти.
+    
+    Подключение к таблице откладывается до первого обращения, чтение идет
+    из снимка, который фоновый поток обновляет по интервалу (лист перечитывается
+    только если изменилась версия таблицы), а записи копятся и уходят одним
+    batch_update. Вместо настоящего листа можно передать fake worksheet
+    с методами get_all_values/batch_update.
+    """
+    
+    def __init__(self, worksheet=None, fallback_db=None, refresh_interval: int = None):
         self.credentials_path = os.getenv('GOOGLE_SHEETS_CREDS')
         self.spreadsheet_id = os.getenv('SPREADSHEET_ID')
+        self.refresh_interval = refresh_interval or int(os.getenv('GOOGLE_SHEETS_REFRESH_SECONDS', '300'))
         self.client = None
-        self.worksheet = None
-        self.init_connection()
+        self.worksheet = worksheet
+        # База данных с таблицей settings для fallback
+        self.fallback_db = fallback_db
+        self._connect_attempted = worksheet is not None
+        
+        self._lock = threading.RLock()
+        self._snapshot: Dict[str, str] = {}
+        # setting_key -> номер строки на листе
+        self._rows: Dict[str, int] = {}
+        self._row_count = 0
+        self._version = None
+        self._values_hash = None
+        self._loaded = False
+        # Записи, еще не отправленные в таблицу
+        self._pending: "OrderedDict[str, str]" = OrderedDict()
+        self._listeners: List[Callable[[Dict[str, Optional[str]]], None]] = []
+        self._refresh_thread = None
+        self._stop_event = threading.Event()
     
     def init_connection(self):
         """Инициализация подключения к Google Sheets"""
@@ -19,6 +46,10 @@ class GoogleSheetsManager:
                 logging.warning("Google Sheets credentials file not found")
                 return False
             
+            # gspread и oauth2client импортируются только при реальном подключении
+            import gspread
+            from oauth2client.service_account import ServiceAccountCredentials
+            
             scope = [
                 'https://spreadsheets.google.com/feeds',
                 'https://www.googleapis.com/auth/drive'
@@ -41,11 +72,21 @@ class GoogleSheetsManager:
                 self._init_settings_sheet()
             
             return True
-            
+        
         except Exception as e:
             logging.error(f"Failed to initialize Google Sheets connection: {e}")
             return False
     
+    def _ensure_connection(self) -> bool:
+        """Ленивое подключение: одна попытка при первом обращении"""
+        if self.worksheet is not None:
+            return True
+        with self._lock:
+            if self._connect_attempted:
+                return self.worksheet is not None
+            self._connect_attempted = True
+            return self.init_connection()
+    
     def _init_settings_sheet(self):
         """Инициализация листа настроек с базовыми значениями"""
         try:
@@ -62,78 +103,213 @@ class GoogleSheetsManager:
             ]
             
             self.worksheet.update('A2:B6', settings_data)
-            
+        
         except Exception as e:
             logging.error(f"Failed to initialize settings sheet: {e}")
     
-    def get_setting(self, setting_key: str) -> Optional[str]:
-        """Получение значения настройки из Google Sheets"""
+    def _remote_version(self) -> Optional[str]:
+        """Версия таблицы (время последнего изменения из Drive API), если доступна"""
+        spreadsheet = getattr(self.worksheet, 'spreadsheet', None)
+        get_version = getattr(spreadsheet, 'get_lastUpdateTime', None)
+        if get_version is None:
+            return None
         try:
-            if not self.worksheet:
-                return None
+            return get_version()
+        except Exception as e:
+            logging.warning(f"Failed to get Google Sheets version: {e}")
+            return None
+    
+    def _apply_values(self, all_values: List[List[str]], version: Optional[str]):
+        """Замена снимка значениями листа и уведомление подписчиков об изменениях"""
+        values_hash = hashlib.sha256(repr(all_values).encode('utf-8')).hexdigest()
+        
+        with self._lock:
+            self._version = version
+            if self._loaded and values_hash == self._values_hash:
+                return
             
-            # Получаем все данные из листа
-            all_values = self.worksheet.get_all_values()
+            snapshot = {}
+            rows = {}
+            for i, row in enumerate(all_values[1:], start=2):  # Пропускаем заголовок
+                if len(row) >= 2 and row[0]:
+                    snapshot[row[0]] = row[1]
+                    rows[row[0]] = i
             
-            # Ищем настройку
-            for row in all_values[1:]:  # Пропускаем заголовок
-                if len(row) >= 2 and row[0] == setting_key:
-                    return row[1]
+            # Еще не отправленные записи важнее прочитанных значений
+            snapshot.update(self._pending)
             
-            return None
+            # При первой загрузке сравниваем с локальной копией: ключи могли удалить, пока бот был выключен
+            previous = self._snapshot
+            if not self._loaded and self.fallback_db is not None:
+                previous = self.fallback_db.get_settings()
             
-        except Exception as e:
-            logging.error(f"Failed to get setting {setting_key}: {e}")
-            return None
+            changed = {key: value for key, value in snapshot.items() if previous.get(key) != value}
+            # Удаленные из листа ключи передаются со значением None
+            changed.update({key: None for key in previous if key not in snapshot})
+            
+            self._snapshot = snapshot
+            self._rows = rows
+            self._row_count = max(len(all_values), 1)
+            self._values_hash = values_hash
+            self._loaded = True
+            listeners = list(self._listeners)
+        
+        if not changed:
+            return
+        
+        # Копия настроек в локальной базе — на случай недоступности таблицы
+        if self.fallback_db is not None:
+            updated = {key: value for key, value in changed.items() if value}
+            # Пустое значение в листе тоже не должно возвращать старое из базы
+            deleted = [key for key, value in changed.items() if not value]
+            if updated:
+                self.fallback_db.set_settings(updated)
+            if deleted:
+                self.fallback_db.delete_settings(deleted)
+        
+        for listener in listeners:
+            try:
+                listener(changed)
+            except Exception as e:
+                logging.error(f"Settings change listener failed: {e}")
     
-    def set_setting(self, setting_key: str, value: str) -> bool:
-        """Установка значения настройки в Google Sheets"""
+    def refresh(self, force: bool = False) -> bool:
+        """Обновление снимка: лист перечитывается, только если изменилась версия"""
+        if not self._ensure_connection():
+            return False
+        
         try:
-            if not self.worksheet:
-                return False
+            self.flush()
             
-            # Получаем все данные из листа
-            all_values = self.worksheet.get_all_values()
+            version = self._remote_version()
+            if not force and self._loaded and version is not None and version == self._version:
+                return True
             
-            # Ищем существующую настройку
-            for i, row in enumerate(all_values[1:], start=2):  # Пропускаем заголовок
-                if len(row) >= 2 and row[0] == setting_key:
-                    # Обновляем существующую настройку
-                    self.worksheet.update(f'B{i}', value)
-                    return True
-            
-            # Если настройка не найдена, добавляем новую
-            next_row = len(all_values) + 1
-            self.worksheet.update(f'A{next_row}:B{next_row}', [[setting_key, value]])
+            self._apply_values(self.worksheet.get_all_values(), version)
             return True
-            
+        
         except Exception as e:
-            logging.error(f"Failed to set setting {setting_key}: {e}")
+            logging.error(f"Failed to refresh settings snapshot: {e}")
             return False
     
-    def get_all_settings(self) -> Dict[str, str]:
-        """Получение всех настроек из Google Sheets"""
+    def flush(self) -> bool:
+        """Отправка накопленных записей одним batch_update"""
+        with self._lock:
+            if not self._pending:
+                return True
+            pending = self._pending
+            self._pending = OrderedDict()
+        
         try:
-            if not self.worksheet:
-                return {}
-            
-            all_values = self.worksheet.get_all_values()
-            settings = {}
+            if not self._ensure_connection():
+                raise RuntimeError("Google Sheets is not connected")
             
-            for row in all_values[1:]:  # Пропускаем заголовок
-                if len(row) >= 2 and row[0] and row[1]:
-                    settings[row[0]] = row[1]
+            # Номера строк нужны для адресов ячеек
+            if not self._loaded:
+                self._apply_values(self.worksheet.get_all_values(), self._remote_version())
             
-            return settings
+            data = []
+            with self._lock:
+                for key, value in pending.items():
+                    row = self._rows.get(key)
+                    if row:
+                        data.append({'range': f'B{row}', 'values': [[value]]})
+                    else:
+                        # Новая настройка добавляется в конец листа
+                        self._row_count += 1
+                        row = self._row_count
+                        self._rows[key] = row
+                        data.append({'range': f'A{row}:B{row}', 'values': [[key, value]]})
             
+            self.worksheet.batch_update(data)
+            return True
+        
         except Exception as e:
-            logging.error(f"Failed to get all settings: {e}")
-            return {}
+            logging.error(f"Failed to flush {len(pending)} settings: {e}")
+            # Возвращаем записи в очередь, не затирая более новые значения
+            with self._lock:
+                for key, value in pending.items():
+                    self._pending.setdefault(key, value)
+            return False
+    
+    def get_setting(self, setting_key: str, fallback_db=None) -> Optional[str]:
+        """Получение значения настройки из снимка Google Sheets с fallback на таблицу settings"""
+        # Без фонового обновления первый запрос загружает снимок синхронно;
+        # с фоновым — до первой загрузки отвечает база
+        if not self._loaded and not self.is_refreshing():
+            self.refresh()
+        
+        with self._lock:
+            value = self._snapshot.get(setting_key)
+        
+        if value:
+            return value
+        
+        fallback_db = fallback_db or self.fallback_db
+        if fallback_db is not None:
+            return fallback_db.get_setting(setting_key)
+        
+        return value
+    
+    def set_setting(self, setting_key: str, value: str) -> bool:
+        """Установка значения настройки в Google Sheets"""
+        with self._lock:
+            self._pending[setting_key] = value
+            self._snapshot[setting_key] = value
+        
+        if self.fallback_db is not None:
+            self.fallback_db.set_settings({setting_key: value})
+        
+        # Фоновый поток отправит запись вместе с остальными при ближайшем обновлении
+        if self.is_refreshing():
+            return True
+        
+        return self.flush()
+    
+    def get_all_settings(self) -> Dict[str, str]:
+        """Получение всех настроек из Google Sheets"""
+        if not self._loaded and not self.is_refreshing():
+            self.refresh()
+        
+        with self._lock:
+            return {key: value for key, value in self._snapshot.items() if value}
+    
+    def add_listener(self, listener: Callable[[Dict[str, Optional[str]]], None]):
+        """Подписка на изменения настроек (вызывается из фонового потока; удаленный ключ — None)"""
+        with self._lock:
+            self._listeners.append(listener)
+    
+    def start_background_refresh(self):
+        """Запуск фонового обновления снимка"""
+        if self.is_refreshing():
+            return
+        
+        self._stop_event.clear()
+        self._refresh_thread = threading.Thread(target=self._refresh_loop, daemon=True)
+        self._refresh_thread.start()
+        logging.info(f"Google Sheets settings refresh started (every {self.refresh_interval}s)")
+    
+    def stop_background_refresh(self):
+        """Остановка фонового обновления с отправкой накопленных записей"""
+        self._stop_event.set()
+        if self._refresh_thread:
+            self._refresh_thread.join(timeout=5)
+            self._refresh_thread = None
+        self.flush()
+    
+    def is_refreshing(self) -> bool:
+        """Работает ли фоновое обновление"""
+        return self._refresh_thread is not None and self._refresh_thread.is_alive()
+    
+    def _refresh_loop(self):
+        """Цикл фонового обновления"""
+        while not self._stop_event.is_set():
+            self.refresh()
+            self._stop_event.wait(self.refresh_interval)
     
     def is_connected(self) -> bool:
         """Проверка подключения к Google Sheets"""
-        return self.client is not None and self.worksheet is not None
+        return self.worksheet is not None
 
-# Создаем глобальный экземпляр менеджера Google Sheets
+# Создаем глобальный экземпляр менеджера Google Sheets (подключение при первом обращении)
 sheets_manager = GoogleSheetsManager()
-
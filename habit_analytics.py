@@ -0,0 +1,334 @@
+"""
+Аналитика привычек: серии, процент выполнения, тепловая карта по дням недели.
+
+Выполнения пользователя за HABIT_ANALYTICS_DAYS дней (по умолчанию 371)
+загружаются одним запросом и хранятся как компактный массив счетчиков по
+дням на каждую привычку: numpy.ndarray, если установлен NumPy, иначе
+array('H') из стандартной библиотеки. Серии, скользящие проценты и
+тепловая карта считаются по массиву целиком (маски, cumsum, bincount),
+без запросов на каждый день или привычку.
+
+Учитываются только дни, когда привычку нужно выполнять: по расписанию
+recurrence_rule (будни, через день, раз в неделю) через
+Database.iter_habit_due_dates, а еженедельная привычка без расписания —
+периодами по 7 дней от даты создания. Каждый такой день открывает период
+до следующего, поэтому выполнение в выходной у привычки по будням идет в
+период пятницы. Серии и проценты считаются по периодам.
+
+Результаты кэшируются до следующей отметки привычки: событие
+on_habit_logged увеличивает счетчик сегодняшнего дня в массиве и
+сбрасывает только сводку этой привычки.
+"""
+
+import logging
+import os
+from array import array
+from collections import OrderedDict
+from datetime import date, timedelta
+from itertools import accumulate
+from typing import Dict, List, Optional
+
+try:
+    import numpy as np
+except ImportError:  # NumPy необязателен: используется array из стандартной библиотеки
+    np = None
+
+logger = logging.getLogger(__name__)
+
+RATE_WINDOWS = (7, 30, 90)
+ROLLING_WINDOW = 7
+# Тепловая карта — по последним 12 неделям
+HEATMAP_DAYS = 84
+WEEKDAY_NAMES = ("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс")
+
+
+def _new_counts(days: int):
+    """Нулевой массив счетчиков по дням"""
+    if np is not None:
+        return np.zeros(days, dtype=np.uint16)
+    return array('H', bytes(2 * days))
+
+
+def _new_mask(days: int, offsets):
+    """Маска дней, открывающих период выполнения"""
+    if np is not None:
+        mask = np.zeros(days, dtype=bool)
+        mask[list(offsets)] = True
+        return mask
+    mask = bytearray(days)
+    for offset in offsets:
+        mask[offset] = 1
+    return mask
+
+
+def _parse_day(value) -> Optional[date]:
+    """Дата из DATE/TIMESTAMP SQLite"""
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(str(value)[:10])
+    except ValueError:
+        return None
+
+
+class HabitAnalytics:
+    def __init__(self, db, max_users: int = 10000, history_days: int = None):
+        self.db = db
+        self.max_users = max_users
+        # Не меньше двух окон по 90 дней (тренд) и кратно неделе
+        self.history_days = max(history_days or int(os.getenv('HABIT_ANALYTICS_DAYS', '371')), 2 * max(RATE_WINDOWS))
+        # user_id -> {'date': date, 'habits': {habit_id: info}, 'counts': {habit_id: массив}, 'summaries': {...}}
+        self._users: "OrderedDict[int, Dict]" = OrderedDict()
+
+    @property
+    def backend(self) -> str:
+        return 'numpy' if np is not None else 'array'
+
+    def _load(self, user_id: int) -> Dict:
+        """Загрузка привычек и счетчиков выполнений: два запроса на пользователя"""
+        today = date.today()
+        start = today - timedelta(days=self.history_days - 1)
+        habits = {habit['habit_id']: habit for habit in self.db.get_user_habits(user_id, active_only=False)}
+        counts = {habit_id: _new_counts(self.history_days) for habit_id in habits}
+
+        for habit_id, completion_date, count in self.db.get_habit_daily_counts(user_id, start):
+            day = _parse_day(completion_date)
+            if habit_id not in counts or day is None or day > today:
+                continue
+            counts[habit_id][(day - start).days] = min(count, 0xFFFF)
+
+        entry = {'date': today, 'start': start, 'habits': habits, 'counts': counts, 'summaries': {}}
+        self._users[user_id] = entry
+        self._users.move_to_end(user_id)
+
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+
+        return entry
+
+    def _entry(self, user_id: int) -> Dict:
+        """Запись пользователя; при смене дня массивы перечитываются"""
+        entry = self._users.get(user_id)
+        if entry is None or entry['date'] != date.today():
+            return self._load(user_id)
+        self._users.move_to_end(user_id)
+        return entry
+
+    def get_habit_analytics(self, user_id: int, habit_id: int) -> Optional[Dict]:
+        """Сводка по одной привычке"""
+        entry = self._entry(user_id)
+        if habit_id not in entry['habits']:
+            return None
+        summary = entry['summaries'].get(habit_id)
+        if summary is None:
+            summary = self._summarize(entry, habit_id)
+            entry['summaries'][habit_id] = summary
+        return summary
+
+    def get_user_analytics(self, user_id: int, active_only: bool = True) -> List[Dict]:
+        """Сводки по привычкам пользователя в порядке создания"""
+        entry = self._entry(user_id)
+        return [
+            self.get_habit_analytics(user_id, habit_id)
+            for habit_id, habit in entry['habits'].items()
+            if not active_only or habit.get('is_active')
+        ]
+
+    def on_habit_logged(self, user_id: int, habit_id: int, completed: bool = True):
+        """Событие отметки привычки: пересчитывается только сводка этой привычки"""
+        entry = self._users.get(user_id)
+        if entry is None or entry['date'] != date.today() or not completed:
+            return
+        counts = entry['counts'].get(habit_id)
+        if counts is None:
+            self.invalidate(user_id)
+            return
+        if counts[-1] < 0xFFFF:
+            counts[-1] += 1
+        entry['summaries'].pop(habit_id, None)
+
+    def invalidate(self, user_id: int):
+        """Сброс данных пользователя (создание/удаление, приостановка/возобновление привычек)"""
+        self._users.pop(user_id, None)
+
+    def _due_offsets(self, habit: Dict, first_day: date, today: date, created: Optional[date]):
+        """Номера дней от first_day, открывающих период выполнения привычки"""
+        if habit.get('recurrence_rule') or habit.get('habit_type') == 'daily':
+            return ((day - first_day).days for day in self.db.iter_habit_due_dates(habit, first_day, today))
+        tracked = (today - first_day).days + 1
+        if habit.get('habit_type') == 'weekly':
+            # Цель на неделю: периоды по 7 дней от даты создания
+            return range(((created or first_day) - first_day).days % 7, tracked, 7)
+        # Прочие привычки без расписания — цель на каждый день
+        return range(tracked)
+
+    def _summarize(self, entry: Dict, habit_id: int) -> Dict:
+        """Серии, проценты выполнения, тренды и тепловая карта привычки"""
+        habit = entry['habits'][habit_id]
+        target = max(habit.get('target_frequency') or 1, 1)
+        days = self.history_days
+
+        # Дни до создания привычки не учитываются; выполнения из них (импорт) — тоже
+        created = _parse_day(habit.get('created_date'))
+        first = min(max((created - entry['start']).days, 0), days - 1) if created else 0
+        counts = entry['counts'][habit_id][first:]
+        tracked = days - first
+        first_day = entry['start'] + timedelta(days=first)
+        due = _new_mask(tracked, self._due_offsets(habit, first_day, entry['date'], created))
+        heat_days = min(HEATMAP_DAYS, tracked)
+
+        if np is not None:
+            kernel = _numpy_summary(counts, due, target, heat_days)
+        else:
+            kernel = _array_summary(counts, due, target, heat_days)
+        value_cumsum, due_cumsum = kernel.pop('value_cumsum'), kernel.pop('due_cumsum')
+        weekday_sums, weekday_days = kernel.pop('weekday_sums'), kernel.pop('weekday_days')
+
+        def window_rate(window: int, offset: int = 0) -> Optional[float]:
+            # Доля выполнения периодов, открытых за window дней, закончившихся offset дней назад
+            end = tracked - offset
+            begin = end - window
+            if begin < 0:
+                if offset:
+                    return None
+                begin = 0
+            periods = due_cumsum[end] - due_cumsum[begin]
+            total = value_cumsum[end] - value_cumsum[begin]
+            return total / (target * periods) * 100 if periods else 0.0
+
+        rates = {f"rate_{window}": window_rate(window) for window in RATE_WINDOWS}
+        trends = {}
+        for window in (30, 90):
+            previous = window_rate(window, offset=window)
+            trends[f"trend_{window}"] = None if previous is None else rates[f"rate_{window}"] - previous
+
+        # Суммы тепловой карты идут по смещению от первого дня окна; переводим в дни недели
+        heat_weekday = (entry['date'] - timedelta(days=heat_days - 1)).weekday()
+        weekday_rates = [None] * 7
+        for offset in range(7):
+            weekday = (heat_weekday + offset) % 7
+            if weekday_days[offset]:
+                weekday_rates[weekday] = weekday_sums[offset] / (target * weekday_days[offset]) * 100
+
+        return dict(
+            habit_id=habit_id,
+            habit_name=habit['habit_name'],
+            target_frequency=target,
+            # Единица серии: день (по расписанию) или неделя
+            period='week' if habit.get('habit_type') == 'weekly' and not habit.get('recurrence_rule') else 'day',
+            tracked_days=tracked,
+            weekday_rates=weekday_rates,
+            **kernel,
+            **rates,
+            **trends,
+        )
+
+
+def _numpy_summary(counts, due, target: int, heat_days: int) -> Dict:
+    """Векторные вычисления на NumPy"""
+    # Номер периода каждого дня; дни до первого дня по расписанию — вне периодов
+    period = np.cumsum(due) - 1
+    inside = period >= 0
+    totals = np.bincount(period[inside], weights=counts[inside], minlength=int(due.sum()))
+    done = totals >= target
+    clipped = np.minimum(totals, target)
+
+    # Серии — отрезки подряд выполненных периодов: границы по разности маски
+    edges = np.diff(np.concatenate(([0], done.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    best_streak = int((ends - starts).max()) if starts.size else 0
+    # Последний период еще идет: невыполненный, он не прерывает серию
+    done_current = bool(done.size and done[-1])
+    closed = len(done) if done_current else max(len(done) - 1, 0)
+    missed = np.flatnonzero(~done[:closed])
+    current_streak = closed - (int(missed[-1]) + 1 if missed.size else 0)
+
+    # Выполнение периода приписывается дню, который его открывает
+    day_values = np.zeros(len(counts))
+    day_values[due] = clipped
+    value_cumsum = np.concatenate(([0], np.cumsum(day_values)))
+    due_cumsum = np.concatenate(([0], np.cumsum(due, dtype=np.int64)))
+
+    values = value_cumsum[ROLLING_WINDOW:] - value_cumsum[:-ROLLING_WINDOW]
+    periods = (due_cumsum[ROLLING_WINDOW:] - due_cumsum[:-ROLLING_WINDOW]) * target
+    rolling = np.divide(values * 100, periods, out=np.zeros(len(values)), where=periods > 0)
+
+    # Смещение от начала окна тепловой карты по модулю 7
+    positions = np.arange(heat_days) % 7
+    weekday_sums = np.bincount(positions, weights=day_values[len(day_values) - heat_days:], minlength=7)
+    weekday_days = np.bincount(positions, weights=due[len(due) - heat_days:], minlength=7)
+
+    return {
+        'current_streak': current_streak,
+        'best_streak': best_streak,
+        'done_today': done_current,
+        'total_completions': int(counts.sum()),
+        'rolling_7': [float(value) for value in rolling[-30:]],
+        'value_cumsum': value_cumsum.tolist(),
+        'due_cumsum': due_cumsum.tolist(),
+        'weekday_sums': weekday_sums.tolist(),
+        'weekday_days': [int(value) for value in weekday_days],
+    }
+
+
+def _array_summary(counts, due, target: int, heat_days: int) -> Dict:
+    """Те же вычисления без NumPy: один проход по массиву на показатель"""
+    totals = []
+    for count, is_due in zip(counts, due):
+        if is_due:
+            totals.append(count)
+        elif totals:
+            totals[-1] += count
+
+    best_streak = run = 0
+    for total in totals:
+        run = run + 1 if total >= target else 0
+        best_streak = max(best_streak, run)
+    done_current = bool(totals) and totals[-1] >= target
+    closed = len(totals) if done_current else max(len(totals) - 1, 0)
+    current_streak = 0
+    for index in range(closed - 1, -1, -1):
+        if totals[index] < target:
+            break
+        current_streak += 1
+
+    clipped = iter([min(total, target) for total in totals])
+    day_values = [next(clipped) if is_due else 0 for is_due in due]
+    value_cumsum = [0] + list(accumulate(day_values))
+    due_cumsum = [0] + list(accumulate(due))
+
+    rolling = []
+    for index in range(max(ROLLING_WINDOW, len(value_cumsum) - 30), len(value_cumsum)):
+        periods = due_cumsum[index] - due_cumsum[index - ROLLING_WINDOW]
+        value = value_cumsum[index] - value_cumsum[index - ROLLING_WINDOW]
+        rolling.append(value / (target * periods) * 100 if periods else 0.0)
+
+    weekday_sums, weekday_days = [0] * 7, [0] * 7
+    for position, index in enumerate(range(len(due) - heat_days, len(due))):
+        weekday_sums[position % 7] += day_values[index]
+        weekday_days[position % 7] += due[index]
+
+    return {
+        'current_streak': current_streak,
+        'best_streak': best_streak,
+        'done_today': done_current,
+        'total_completions': sum(counts),
+        'rolling_7': rolling,
+        'value_cumsum': value_cumsum,
+        'due_cumsum': due_cumsum,
+        'weekday_sums': weekday_sums,
+        'weekday_days': weekday_days,
+    }
+
+
+def format_weekday_heatmap(weekday_rates: List[Optional[float]]) -> str:
+    """Строка тепловой карты: день недели и уровень выполнения"""
+    levels = "▁▃▅▇"
+    cells = []
+    for name, rate in zip(WEEKDAY_NAMES, weekday_rates):
+        if rate is None:
+            cells.append(f"{name}·")
+        else:
+            cells.append(f"{name}{levels[min(int(rate / 100 * len(levels)), len(levels) - 1)]}")
+    return " ".join(cells)
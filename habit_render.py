@@ -0,0 +1,132 @@
+"""
+Модель отображения привычек в памяти.
+
+Хранит для каждого пользователя строки списка привычек (название, цель,
+выполнено сегодня, активность), чтобы список и карточка привычки
+рендерились без запросов к базе. Модель обновляется событиями
+выполнения привычки, а не перечитыванием всех привычек.
+"""
+
+import logging
+from collections import OrderedDict
+from datetime import date
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class HabitRenderModel:
+    def __init__(self, db, max_users: int = 10000, period_days: int = 30):
+        self.db = db
+        self.max_users = max_users
+        self.period_days = period_days
+        # user_id -> {'date': date, 'habits': OrderedDict(habit_id -> row)}
+        self._users: "OrderedDict[int, Dict]" = OrderedDict()
+        # (chat_id, message_id) -> последний отрисованный экран
+        self._views: OrderedDict = OrderedDict()
+
+    def _load(self, user_id: int) -> Dict:
+        """Загрузка привычек пользователя: два запроса вместо одного на привычку"""
+        habits = self.db.get_user_habits(user_id, active_only=False)
+        progress = self.db.get_habits_progress(user_id, days=self.period_days)
+
+        rows = OrderedDict()
+        for habit in habits:
+            counts = progress.get(habit['habit_id'], {})
+            rows[habit['habit_id']] = {
+                'habit_id': habit['habit_id'],
+                'user_id': user_id,
+                'habit_name': habit['habit_name'],
+                'habit_description': habit.get('habit_description'),
+                'habit_type': habit.get('habit_type'),
+                'recurrence_rule': habit.get('recurrence_rule'),
+                'created_date': habit.get('created_date'),
+                'target_frequency': habit.get('target_frequency', 1) or 1,
+                'is_active': bool(habit.get('is_active')),
+                'today_count': counts.get('today_count', 0),
+                'period_count': counts.get('period_count', 0),
+            }
+
+        entry = {'date': date.today(), 'habits': rows}
+        self._users[user_id] = entry
+        self._users.move_to_end(user_id)
+
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+
+        return entry
+
+    def _entry(self, user_id: int) -> Dict:
+        """Запись пользователя; при смене дня счетчики перечитываются"""
+        entry = self._users.get(user_id)
+        if entry is None or entry['date'] != date.today():
+            return self._load(user_id)
+        self._users.move_to_end(user_id)
+        return entry
+
+    def get_rows(self, user_id: int, active_only: bool = False) -> List[Dict]:
+        """Строки списка привычек пользователя"""
+        rows = list(self._entry(user_id)['habits'].values())
+        if active_only:
+            rows = [row for row in rows if row['is_active']]
+        return rows
+
+    def get_row(self, user_id: int, habit_id: int) -> Optional[Dict]:
+        """Строка одной привычки"""
+        return self._entry(user_id)['habits'].get(habit_id)
+
+    def on_habit_logged(self, user_id: int, habit_id: int, completed: bool = True) -> Optional[Dict]:
+        """Событие отметки привычки: меняется только строка этой привычки"""
+        entry = self._users.get(user_id)
+        if entry is None or entry['date'] != date.today():
+            # Модель еще не загружена — она подтянет актуальные данные при первом рендере
+            return None
+
+        row = entry['habits'].get(habit_id)
+        if row is None:
+            self.invalidate(user_id)
+            return None
+
+        if completed:
+            row['today_count'] += 1
+            row['period_count'] += 1
+        return row
+
+    def on_habit_status_changed(self, user_id: int, habit_id: int, is_active: bool):
+        """Событие паузы/возобновления привычки"""
+        entry = self._users.get(user_id)
+        if entry is None:
+            return
+        row = entry['habits'].get(habit_id)
+        if row is None:
+            self.invalidate(user_id)
+            return
+        row['is_active'] = is_active
+
+    def invalidate(self, user_id: int):
+        """Сброс модели пользователя (создание/удаление привычек)"""
+        self._users.pop(user_id, None)
+
+    def diff_view(self, view_key, text: str, markup_signature, current) -> str:
+        """Вид изменения сообщения: 'none', 'markup' или 'full'.
+
+        current — фактическое состояние сообщения (текст, клавиатура), пришедшее
+        с callback; если оно не совпадает с запомненным, сообщение меняли в обход
+        модели и его нужно перерисовать целиком.
+        """
+        view = self._views.get(view_key)
+        if view is None or view['observed'] != current or view['text'] != text:
+            return 'full'
+        if view['markup'] != markup_signature:
+            return 'markup'
+        return 'none'
+
+    def remember_view(self, view_key, text: str, markup_signature, observed):
+        """Запоминание отрисованного экрана"""
+        if observed is None:
+            self._views.pop(view_key, None)
+            return
+        self._views[view_key] = {'text': text, 'markup': markup_signature, 'observed': observed}
+        self._views.move_to_end(view_key)
+        while len(self._views) > self.max_users:
+            self._views.popitem(last=False)
@@ -5,20 +5,26 @@
 
 import asyncio
 import logging
+import os
 from datetime import datetime, time
 from typing import List, Dict, Any
 import pytz
 from aiogram import Bot
-from database import Database
+from app_context import app_context
+from tracing import tracer
 
 logger = logging.getLogger(__name__)
 
 class HourlyPushSystem:
-    def __init__(self, bot: Bot):
+    def __init__(self, bot: Bot, context=None):
         self.bot = bot
-        self.db = Database()
+        # База и исходящий диспетчер общие для всего приложения
+        self.context = context or app_context
+        self.db = self.context.db
+        self.outbound = self.context.outbound
         self.is_running = False
         self.push_task = None
+        self.startup_delay = int(os.getenv('HOURLY_PUSH_STARTUP_DELAY', '30'))
     
     def start(self):
         """Запуск системы почасовых push-уведомлений"""
@@ -65,6 +71,9 @@ class HourlyPushSystem:
     
     async def _hourly_push_loop(self):
         """Основной цикл почасовых уведомлений"""
+        # Первая рассылка после паузы, чтобы не конкурировать с первыми апдейтами после рестарта
+        await asyncio.sleep(self.startup_delay)
+        
         while self.is_running:
             try:
                 await self._send_hourly_push_notifications()
@@ -97,29 +106,28 @@ class HourlyPushSystem:
             try:
                 user_id = user_data['user_id']
                 
-                # Проверяем, находится ли пользователь в своем дневном времени
-                if not self._is_in_push_time(user_data):
-                    continue
-                
-                # Проверяем, есть ли у пользователя активные привычки
-                if not self.db.get_user_habits(user_id):
-                    continue
-                
-                # Проверяем статус пользователя на сегодня
-                if self._is_user_goals_completed(user_id):
-                    logger.info(f"User {user_id} has completed all goals, skipping")
-                    continue
-                
-                # Получаем незавершенные привычки
-                incomplete_habits = self._get_incomplete_habits(user_id)
-                
-                if incomplete_habits:
-                    await self._send_push_notification(user_id, incomplete_habits)
-                    sent_count += 1
+                # Трасса на пользователя: проверки в базе, ожидание лимита и отправка
+                with tracer.trace('hourly_push.user', user_id=user_id):
+                    # Проверяем, находится ли пользователь в своем дневном времени
+                    if not self._is_in_push_time(user_data):
+                        continue
+                    
+                    # Проверяем, есть ли у пользователя активные привычки
+                    if not self.db.get_user_habits(user_id):
+                        continue
+                    
+                    # Проверяем статус пользователя на сегодня
+                    if self._is_user_goals_completed(user_id):
+                        logger.info(f"User {user_id} has completed all goals, skipping")
+                        continue
+                    
+                    # Получаем незавершенные привычки
+                    incomplete_habits = self._get_incomplete_habits(user_id)
+                    
+                    if incomplete_habits:
+                        await self._send_push_notification(user_id, incomplete_habits)
+                        sent_count += 1
                     
-                    # Небольшая задержка между отправками
-                    await asyncio.sleep(0.5)
-                
             except Exception as e:
                 logger.error(f"Error sending push to user {user_id}: {e}")
         
@@ -224,7 +232,7 @@ class HourlyPushSystem:
             keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
             
             # Отправляем уведомление с кнопками
-            await self.bot.send_message(
+            await self.outbound.send_message(
                 chat_id=user_id,
                 text=message,
                 parse_mode="Markdown",
@@ -0,0 +1,166 @@
+"""
+Фоновая очередь задач для генерации через OpenAI.
+
+Обработчики не ждут генерацию: они ставят задачу в очередь и сразу
+отвечают пользователю сообщением «генерирую…», которое потом
+редактирует воркер.
+
+- один пользователь — одна задача: новая заявка вытесняет ожидающую
+  или выполняющуюся;
+- первичная генерация визитки обслуживается раньше перегенерации;
+- число одновременно выполняемых задач ограничено числом воркеров.
+"""
+
+import asyncio
+import itertools
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты: меньше — раньше
+PRIORITY_GENERATE = 0
+PRIORITY_REGENERATE = 1
+
+
+class LLMJob:
+    def __init__(self, user_id: int, kind: str, priority: int,
+                 run: Callable[[], Awaitable], on_cancel: Optional[Callable[[], Awaitable]] = None):
+        self.user_id = user_id
+        self.kind = kind
+        self.priority = priority
+        self.run = run
+        self.on_cancel = on_cancel
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.cancelled = False
+        self.task: Optional[asyncio.Task] = None
+
+
+class LLMJobQueue:
+    def __init__(self, workers: int = None, max_queue: int = 1000):
+        self.workers_count = workers or int(os.getenv('LLM_QUEUE_WORKERS', '4'))
+        self.max_queue = max_queue
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._workers = []
+        self._seq = itertools.count()
+        # user_id -> последняя задача пользователя (ожидающая или выполняющаяся)
+        self._user_jobs: Dict[int, LLMJob] = {}
+        self._running = 0
+        self.metrics = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'superseded': 0,
+            'rejected': 0,
+            'wait_seconds_total': 0.0,
+            'run_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+        }
+
+    def start(self):
+        """Запуск воркеров (нужен работающий event loop)"""
+        if self._workers:
+            return
+        self._queue = asyncio.PriorityQueue(maxsize=self.max_queue)
+        for index in range(self.workers_count):
+            self._workers.append(asyncio.create_task(self._worker(index)))
+        logger.info(f"LLM job queue started with {self.workers_count} workers")
+
+    async def stop(self):
+        """Остановка воркеров и отмена задач"""
+        for job in list(self._user_jobs.values()):
+            self._cancel(job)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        logger.info("LLM job queue stopped")
+
+    def submit(self, user_id: int, kind: str, run: Callable[[], Awaitable],
+               priority: int = PRIORITY_REGENERATE,
+               on_cancel: Optional[Callable[[], Awaitable]] = None) -> bool:
+        """Постановка задачи в очередь; прежняя задача пользователя отменяется"""
+        if self._queue is None:
+            self.start()
+
+        # Место проверяется до отмены прежней задачи: при отказе она остается в очереди
+        if self._queue.full():
+            self.metrics['rejected'] += 1
+            logger.warning(f"LLM queue is full, job {kind} for user {user_id} rejected")
+            return False
+
+        previous = self._user_jobs.get(user_id)
+        if previous is not None:
+            self._cancel(previous)
+            self.metrics['superseded'] += 1
+
+        job = LLMJob(user_id, kind, priority, run, on_cancel)
+        self._queue.put_nowait((priority, next(self._seq), job))
+
+        self._user_jobs[user_id] = job
+        self.metrics['submitted'] += 1
+        return True
+
+    def _cancel(self, job: LLMJob):
+        """Отмена задачи: ожидающая будет пропущена воркером, выполняющаяся прервана"""
+        job.cancelled = True
+        if job.task is not None and not job.task.done():
+            job.task.cancel()
+
+    async def _worker(self, index: int):
+        """Воркер: берет задачи по приоритету и выполняет их по одной"""
+        while True:
+            _, _, job = await self._queue.get()
+            try:
+                if job.cancelled:
+                    continue
+                await self._execute(job)
+            finally:
+                self._queue.task_done()
+
+    async def _execute(self, job: LLMJob):
+        """Выполнение задачи с учетом метрик и отмены"""
+        job.started_at = time.monotonic()
+        waited = job.started_at - job.enqueued_at
+        self.metrics['wait_seconds_total'] += waited
+        self.metrics['wait_seconds_max'] = max(self.metrics['wait_seconds_max'], waited)
+
+        self._running += 1
+        job.task = asyncio.create_task(job.run())
+        try:
+            await job.task
+            self.metrics['completed'] += 1
+        except asyncio.CancelledError:
+            # Отменена новой заявкой пользователя; сам воркер продолжает работу
+            if job.on_cancel is not None:
+                try:
+                    await job.on_cancel()
+                except Exception as e:
+                    logger.warning(f"LLM job cancel callback failed: {e}")
+            if not job.cancelled:
+                raise
+        except Exception as e:
+            self.metrics['failed'] += 1
+            logger.error(f"LLM job {job.kind} for user {job.user_id} failed: {e}")
+        finally:
+            self._running -= 1
+            self.metrics['run_seconds_total'] += time.monotonic() - job.started_at
+            if self._user_jobs.get(job.user_id) is job:
+                del self._user_jobs[job.user_id]
+
+    def get_metrics(self) -> Dict:
+        """Метрики очереди"""
+        metrics = dict(self.metrics)
+        metrics['queue_depth'] = self._queue.qsize() if self._queue else 0
+        metrics['running'] = self._running
+        metrics['workers'] = self.workers_count
+        started = metrics['completed'] + metrics['failed']
+        metrics['wait_seconds_avg'] = metrics['wait_seconds_total'] / started if started else 0.0
+        return metrics
+
+
+# Глобальный экземпляр очереди (воркеры запускаются в main)
+llm_job_queue = LLMJobQueue()
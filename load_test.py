@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест бота целиком: диспетчер dp, база, почасовой push и ночные отчеты.
+
+Поднимает fake-сервер Bot API (fake_telegram_server.py) в том же процессе,
+направляет на него бота через TELEGRAM_API_URL и временную базу через
+DATABASE_PATH, затем прогоняет синтетические апдейты через dp.feed_update:
+/start, добавление привычки, нажатия quick_habit и статистика привычек.
+После этого замеряются почасовой push и ночные отчеты (по целям и по
+привычкам). Для каждой фазы печатаются пропускная способность, перцентили
+задержек и доля ошибок.
+
+Запуск:
+    python3 load_test.py --users 200 --concurrency 50 --taps 3 --latency 0.05 --rate-limit 0.01
+    python3 load_test.py --users 1000 --outbound-rate 100 --output load_results.json
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+from datetime import date, datetime
+from typing import Dict, List
+
+from aiohttp import web
+
+from db_benchmark import percentile
+from fake_telegram_server import FakeTelegramServer
+
+logger = logging.getLogger(__name__)
+
+# Токен формата Telegram: aiogram проверяет его при создании Bot
+FAKE_BOT_TOKEN = "123456:ABCdefGhIJKlmnoPQRstuVWxyz0123456789"
+
+# Первый идентификатор синтетических пользователей
+FIRST_USER_ID = 10_000_000
+
+
+def summarize_latencies(durations: List[float]) -> Dict:
+    """Перцентили задержек в миллисекундах"""
+    return {
+        'count': len(durations),
+        'p50_ms': percentile(durations, 50) * 1000,
+        'p95_ms': percentile(durations, 95) * 1000,
+        'p99_ms': percentile(durations, 99) * 1000,
+        'max_ms': max(durations) * 1000 if durations else 0.0,
+    }
+
+
+class LoadRecorder:
+    """Замеры текущей фазы: апдейты диспетчера и вызовы Bot API"""
+
+    def __init__(self):
+        self.phase = None
+        # фаза -> шаг сценария -> длительности обработки апдейтов, секунды
+        self.updates: Dict[str, Dict[str, List[float]]] = {}
+        self.update_errors: Dict[str, Dict[str, int]] = {}
+        # фаза -> метод Bot API -> длительности вызовов
+        self.api_calls: Dict[str, Dict[str, List[float]]] = {}
+        # фаза -> тип ошибки -> количество
+        self.api_errors: Dict[str, Dict[str, int]] = {}
+        self.wall: Dict[str, float] = {}
+
+    async def request_middleware(self, make_request, bot, method):
+        """Middleware сессии бота: длительность и ошибки каждого вызова Bot API"""
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            errors = self.api_errors.setdefault(self.phase, {})
+            errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            raise
+        finally:
+            self.api_calls.setdefault(self.phase, {}).setdefault(name, []).append(time.perf_counter() - started)
+
+    def record_update(self, step: str, seconds: float, error: bool):
+        self.updates.setdefault(self.phase, {}).setdefault(step, []).append(seconds)
+        if error:
+            errors = self.update_errors.setdefault(self.phase, {})
+            errors[step] = errors.get(step, 0) + 1
+
+    def report(self) -> Dict:
+        """Итоги по фазам"""
+        result = {}
+        for phase, wall in self.wall.items():
+            updates = self.updates.get(phase, {})
+            api_calls = self.api_calls.get(phase, {})
+            total_updates = sum(len(durations) for durations in updates.values())
+            total_calls = sum(len(durations) for durations in api_calls.values())
+            update_errors = sum(self.update_errors.get(phase, {}).values())
+            api_errors = sum(self.api_errors.get(phase, {}).values())
+            result[phase] = {
+                'wall_seconds': wall,
+                'updates': total_updates,
+                'updates_per_second': total_updates / wall if wall else 0.0,
+                'update_error_rate': update_errors / total_updates if total_updates else 0.0,
+                'steps': {step: summarize_latencies(durations) for step, durations in updates.items()},
+                'api_calls': total_calls,
+                'api_calls_per_second': total_calls / wall if wall else 0.0,
+                'api_error_rate': api_errors / total_calls if total_calls else 0.0,
+                'api_errors': dict(self.api_errors.get(phase, {})),
+                'methods': {method: summarize_latencies(durations) for method, durations in api_calls.items()},
+            }
+        return result
+
+
+class UpdateFactory:
+    """Синтетические апдейты Telegram от имени пользователя"""
+
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._callback_ids = itertools.count(1)
+
+    def _user(self, user_id: int) -> Dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f"Load{user_id}", 'username': f"load{user_id}"}
+
+    def message(self, user_id: int, text: str) -> Dict:
+        entities = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}] if text.startswith('/') else None
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            'text': text,
+        }
+        if entities:
+            message['entities'] = entities
+        return {'update_id': next(self._update_ids), 'message': message}
+
+    def callback(self, user_id: int, data: str) -> Dict:
+        return {
+            'update_id': next(self._update_ids),
+            'callback_query': {
+                'id': str(next(self._callback_ids)),
+                'from': self._user(user_id),
+                'chat_instance': str(user_id),
+                'data': data,
+                'message': {
+                    'message_id': next(self._message_ids),
+                    'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'from': {'id': 100000, 'is_bot': True, 'first_name': 'AlteriA'},
+                    'text': "…",
+                },
+            },
+        }
+
+
+class LoadTest:
+    def __init__(self, bot_module, recorder: LoadRecorder, users: int, concurrency: int, taps: int,
+                 seed: int = 42):
+        self.bot_module = bot_module
+        self.recorder = recorder
+        self.user_ids = list(range(FIRST_USER_ID, FIRST_USER_ID + users))
+        self.concurrency = concurrency
+        self.taps = taps
+        self.random = random.Random(seed)
+        self.factory = UpdateFactory()
+
+    async def _feed(self, step: str, raw_update: Dict):
+        """Обработка апдейта диспетчером с замером"""
+        from aiogram.types import Update
+
+        bot = self.bot_module.bot
+        update = Update.model_validate(raw_update, context={'bot': bot})
+        started = time.perf_counter()
+        error = False
+        try:
+            await self.bot_module.dp.feed_update(bot, update)
+        except Exception as e:
+            error = True
+            logger.debug(f"Update {step} failed: {e}")
+        self.recorder.record_update(step, time.perf_counter() - started, error)
+
+    async def _user_scenario(self, user_id: int, semaphore: asyncio.Semaphore):
+        """Сценарий пользователя: /start, новая привычка, отметки из push, статистика"""
+        async with semaphore:
+            factory = self.factory
+            await self._feed('start', factory.message(user_id, '/start'))
+            await self._feed('skip_onboarding', factory.callback(user_id, 'no'))
+            await self._feed('habits_menu', factory.callback(user_id, 'habits_menu'))
+            await self._feed('add_habit', factory.callback(user_id, 'add_habit'))
+            await self._feed('habit_name', factory.message(user_id, f"Привычка {user_id % 97}"))
+            await self._feed('habit_description', factory.message(user_id, '-'))
+            await self._feed('habit_type', factory.callback(user_id, 'habit_type_daily'))
+            await self._feed('habit_frequency', factory.callback(user_id, f"freq_{self.random.randint(1, 3)}"))
+
+            habits = self.bot_module.db.get_user_habits(user_id)
+            for _ in range(self.taps if habits else 0):
+                habit = self.random.choice(habits)
+                await self._feed('quick_habit', factory.callback(user_id, f"quick_habit_{habit['habit_id']}"))
+
+            await self._feed('habits_stats', factory.callback(user_id, 'habits_stats'))
+
+    async def run_bot_phase(self):
+        """Фаза апдейтов: пользователи параллельно, не больше concurrency одновременно"""
+        self.recorder.phase = 'bot'
+        semaphore = asyncio.Semaphore(self.concurrency)
+        started = time.perf_counter()
+        await asyncio.gather(*(self._user_scenario(user_id, semaphore) for user_id in self.user_ids))
+        self.recorder.wall['bot'] = time.perf_counter() - started
+
+    def prepare_background_data(self):
+        """Цели на сегодня и окно push, включающее текущий час"""
+        db = self.bot_module.db
+        hour = datetime.utcnow().hour
+        # 0 в настройках читается как «не задано», поэтому полночь — окно 23..1 через полночь
+        start_hour, end_hour = (23, 1) if hour == 0 else (hour, hour + 1)
+        for user_id in self.user_ids:
+            db.update_user_timezone_settings(user_id, timezone='UTC', push_start_hour=start_hour,
+                                             push_end_hour=end_hour, push_enabled=True)
+            db.add_goals(user_id, [f"Цель {index + 1}" for index in range(self.random.randint(1, 3))],
+                         'daily', date.today())
+
+    async def run_background_phase(self, phase: str, job):
+        """Фаза фоновой рассылки"""
+        self.recorder.phase = phase
+        started = time.perf_counter()
+        await job()
+        self.recorder.wall[phase] = time.perf_counter() - started
+
+
+def print_report(report: Dict, server_stats: Dict):
+    """Таблица результатов по фазам"""
+    for phase, data in report.items():
+        print(f"\n=== {phase}: {data['wall_seconds']:.2f} с ===")
+        if data['updates']:
+            print(f"апдейтов: {data['updates']} ({data['updates_per_second']:.1f}/с), "
+                  f"ошибок: {data['update_error_rate']:.2%}")
+            for step, stats in data['steps'].items():
+                print(f"  {step:20s} n={stats['count']:<6d} p50 {stats['p50_ms']:8.2f} мс  "
+                      f"p95 {stats['p95_ms']:8.2f} мс  p99 {stats['p99_ms']:8.2f} мс")
+        print(f"вызовов Bot API: {data['api_calls']} ({data['api_calls_per_second']:.1f}/с), "
+              f"ошибок: {data['api_error_rate']:.2%} {data['api_errors'] or ''}")
+        for method, stats in data['methods'].items():
+            print(f"  {method:20s} n={stats['count']:<6d} p50 {stats['p50_ms']:8.2f} мс  "
+                  f"p95 {stats['p95_ms']:8.2f} мс  p99 {stats['p99_ms']:8.2f} мс")
+
+    print(f"\nFake Bot API: {server_stats['calls']}, 429: {server_stats['rate_limited']}")
+
+
+async def run(args) -> Dict:
+    server = FakeTelegramServer(latency=args.latency, jitter=args.jitter, rate_limit=args.rate_limit,
+                                retry_after=args.retry_after, seed=args.seed)
+    runner = web.AppRunner(server.create_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', args.port).start()
+
+    # Бот импортируется после настройки окружения: Bot и база создаются при импорте
+    import bot as bot_module
+    from hourly_push_system import HourlyPushSystem
+    from scheduler import ReportScheduler
+
+    recorder = LoadRecorder()
+    bot_module.bot.session.middleware(recorder.request_middleware)
+    bot_module.db.init_database()
+
+    test = LoadTest(bot_module, recorder, args.users, args.concurrency, args.taps, args.seed)
+    try:
+        await test.run_bot_phase()
+        test.prepare_background_data()
+
+        hourly_push = HourlyPushSystem(bot_module.bot, bot_module.app_context)
+        await test.run_background_phase('hourly_push', hourly_push._send_hourly_push_notifications)
+
+        scheduler = ReportScheduler(bot_module.bot, bot_module.app_context)
+        await test.run_background_phase('daily_reports', scheduler._send_daily_reports)
+        await test.run_background_phase('habits_daily_report', scheduler._send_habits_daily_report)
+    finally:
+        await bot_module.bot.session.close()
+        await runner.cleanup()
+
+    report = recorder.report()
+    print_report(report, server.get_stats())
+    return {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'users': args.users,
+            'concurrency': args.concurrency,
+            'taps': args.taps,
+            'latency': args.latency,
+            'jitter': args.jitter,
+            'rate_limit': args.rate_limit,
+            'outbound_rate': args.outbound_rate,
+            'seed': args.seed,
+        },
+        'phases': report,
+        'server': server.get_stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с fake Bot API")
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50, help="Одновременно активных пользователей")
+    parser.add_argument('--taps', type=int, default=3, help="Нажатий quick_habit на пользователя")
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.05, help="Задержка fake Bot API, секунды")
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--rate-limit', type=float, default=0.0, help="Доля ответов 429")
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--outbound-rate', type=float, default=25, help="Лимит исходящих рассылок, сообщений в секунду")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="Куда сохранить результаты в JSON")
+    parser.add_argument('--keep-db', action='store_true', help="Не удалять временную базу")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    work_dir = tempfile.mkdtemp(prefix='load_test_')
+    os.environ['BOT_TOKEN'] = FAKE_BOT_TOKEN
+    os.environ['TELEGRAM_API_URL'] = f"http://127.0.0.1:{args.port}"
+    os.environ['DATABASE_PATH'] = os.path.join(work_dir, 'load_test.db')
+    os.environ['OUTBOUND_RATE_PER_SECOND'] = str(args.outbound_rate)
+    os.environ['METRICS_PORT'] = '0'
+
+    try:
+        result = asyncio.run(run(args))
+    finally:
+        if args.keep_db:
+            print(f"\nБаза сохранена в {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump(result, output_file, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Сторож event loop: задержка цикла и поиск блокирующих вызовов.
+
+Корутина-пульс просыпается каждые LOOP_WATCHDOG_INTERVAL_MS (по умолчанию 50)
+и записывает, насколько позже срока она проснулась (event_loop_lag_seconds).
+Отдельный поток следит за пульсом: если цикл не отвечает дольше
+LOOP_LAG_THRESHOLD_MS (по умолчанию 100), он снимает стек потока event loop
+прямо во время блокировки. Когда цикл отпускает, пульс записывает
+event_loop_blocked_total{site} и event_loop_blocked_seconds, а в лог уходит
+место вызова, задача asyncio и стек. site — ближайший к вершине стека кадр
+из кода бота, то есть вызов, который держит цикл (sqlite3, openai и т. п.).
+LOOP_WATCHDOG=0 отключает сторожа.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Dict, List, Optional
+
+from app_context import app_context
+
+logger = logging.getLogger(__name__)
+
+# Каталог кода бота: кадры из него считаются местом вызова
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Мест вызова в метках метрики не больше, остальные — 'other'
+MAX_SITES = 100
+STACK_LIMIT = 20
+
+
+class LoopWatchdog:
+    def __init__(self, context=None, threshold_ms: float = None, interval_ms: float = None,
+                 enabled: bool = None):
+        self.context = context or app_context
+        self.enabled = enabled if enabled is not None else os.getenv('LOOP_WATCHDOG', '1') == '1'
+        self.threshold = (threshold_ms or float(os.getenv('LOOP_LAG_THRESHOLD_MS', '100'))) / 1000
+        self.interval = (interval_ms or float(os.getenv('LOOP_WATCHDOG_INTERVAL_MS', '50'))) / 1000
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        # Момент, к которому пульс должен проснуться
+        self._deadline = 0.0
+        # Снимок блокировки, сделанный потоком-наблюдателем; забирает пульс
+        self._capture: Optional[Dict] = None
+        self._sites = set()
+        self.recent: deque = deque(maxlen=50)
+
+    def start(self):
+        """Запуск пульса и потока-наблюдателя (нужен работающий event loop)"""
+        if not self.enabled or self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._deadline = time.monotonic() + self.interval
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._thread.start()
+        logger.info(f"Event loop watchdog started (threshold {self.threshold * 1000:.0f} ms)")
+
+    def stop(self):
+        """Остановка сторожа"""
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._thread = None
+
+    async def _heartbeat(self):
+        """Пульс: задержка пробуждения — это задержка event loop"""
+        while True:
+            self._deadline = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(time.monotonic() - self._deadline, 0.0)
+            self.context.metrics.observe('event_loop_lag_seconds', lag)
+            if lag >= self.threshold:
+                self._report(lag)
+            else:
+                self._capture = None
+
+    def _watch(self):
+        """Поток-наблюдатель: снимок стека, пока цикл заблокирован"""
+        check_interval = min(self.interval, self.threshold) / 2
+        while not self._stop.wait(check_interval):
+            if self._capture is None and time.monotonic() - self._deadline >= self.threshold:
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is not None:
+                    self._capture = self._describe(frame)
+
+    def _describe(self, frame) -> Dict:
+        """Место вызова, задача asyncio и стек заблокированного потока"""
+        stack = traceback.extract_stack(frame)[-STACK_LIMIT:]
+        # Ближайший кадр из кода бота, иначе — самый внутренний кадр
+        site_entry = next((
+            entry for entry in reversed(stack)
+            if entry.filename.startswith(PROJECT_DIR) and not entry.filename.endswith('loop_watchdog.py')
+        ), stack[-1] if stack else None)
+        site = f"{os.path.basename(site_entry.filename)}:{site_entry.lineno} {site_entry.name}" if site_entry else None
+        task = asyncio.current_task(self._loop)
+        coroutine = task.get_coro() if task is not None else None
+        return {
+            'site': site or 'unknown',
+            'task': task.get_name() if task is not None else None,
+            'coroutine': getattr(coroutine, '__qualname__', None),
+            'stack': traceback.format_list(stack),
+        }
+
+    def _site_label(self, site: str) -> str:
+        """Метка места вызова с ограничением числа рядов метрики"""
+        if site not in self._sites:
+            if len(self._sites) >= MAX_SITES:
+                return 'other'
+            self._sites.add(site)
+        return site
+
+    def _report(self, lag: float):
+        """Метрики и запись в лог о завершившейся блокировке"""
+        capture, self._capture = self._capture, None
+        if capture is None:
+            # Наблюдатель не успел снять стек (короткая блокировка на границе порога)
+            capture = {'site': 'unknown', 'task': None, 'coroutine': None, 'stack': []}
+        label = self._site_label(capture['site'])
+        self.context.metrics.inc('event_loop_blocked_total', site=label)
+        self.context.metrics.observe('event_loop_blocked_seconds', lag, site=label)
+        self.recent.append({'ts': time.time(), 'lag_ms': round(lag * 1000, 1), 'site': capture['site'],
+                            'task': capture['task'], 'coroutine': capture['coroutine']})
+        logger.warning(
+            f"Event loop blocked for {lag * 1000:.0f} ms at {capture['site']} "
+            f"(task {capture['task']}, coroutine {capture['coroutine']})\n" + "".join(capture['stack'])
+        )
+
+    def get_stats(self) -> List[Dict]:
+        """Последние блокировки"""
+        return list(self.recent)
+
+
+# Глобальный сторож event loop (запускается в main)
+loop_watchdog = LoopWatchdog()
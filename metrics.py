@@ -0,0 +1,211 @@
+"""
+Реестр метрик приложения: счетчики, гистограммы длительностей и gauge.
+
+Метрики с метками хранятся под ключом (имя, отсортированные метки).
+Реестр потокобезопасен: им пользуются и event loop бота, и поток планировщика.
+Обновление метрики — одна блокировка и бинарный поиск корзины, поэтому
+инструментирование можно держать включенным в продакшене. Для сбора
+Prometheus реестр отдается в текстовом формате (render_prometheus)
+на локальном HTTP-эндпоинте (start_metrics_server).
+"""
+
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм длительностей, секунды
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _key(name: str, labels: Dict) -> Tuple[str, tuple]:
+    """Ключ метрики с метками"""
+    return name, tuple(sorted(labels.items()))
+
+
+def _escape(value) -> str:
+    """Экранирование значения метки для текстового формата"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_metric_name(name: str, labels: tuple) -> str:
+    """Имя метрики с метками: name{label="value"}"""
+    if not labels:
+        return name
+    rendered = ",".join(f'{label}="{_escape(value)}"' for label, value in labels)
+    return f"{name}{{{rendered}}}"
+
+
+def _format_value(value: float) -> str:
+    """Значение метрики: целые без дробной части"""
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+class MetricsRegistry:
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, tuple], float] = {}
+        # (имя, метки) -> [количество, сумма, максимум, счетчики корзин...]
+        self._timings: Dict[Tuple[str, tuple], list] = {}
+        self._gauges: Dict[Tuple[str, tuple], float] = {}
+        # Gauge, значение которых вычисляется при сборе: (имя, метки) -> функция
+        self._gauge_functions: Dict[Tuple[str, tuple], Callable[[], float]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Увеличение счетчика"""
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        """Учет длительности операции (гистограмма)"""
+        key = _key(name, labels)
+        bucket = bisect_left(self.buckets, seconds)
+        with self._lock:
+            timing = self._timings.get(key)
+            if timing is None:
+                timing = self._timings[key] = [0, 0.0, seconds] + [0] * len(self.buckets)
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+            if bucket < len(self.buckets):
+                timing[3 + bucket] += 1
+
+    def set_gauge(self, name: str, value: float, **labels):
+        """Текущее значение gauge"""
+        with self._lock:
+            self._gauges[_key(name, labels)] = value
+
+    def register_gauge(self, name: str, function: Callable[[], float], **labels):
+        """Gauge, значение которого вычисляется функцией при каждом сборе"""
+        with self._lock:
+            self._gauge_functions[_key(name, labels)] = function
+
+    def get_counter(self, name: str, **labels) -> float:
+        """Значение счетчика"""
+        with self._lock:
+            return self._counters.get(_key(name, labels), 0)
+
+    def _collect_gauges(self) -> Dict[Tuple[str, tuple], float]:
+        """Все gauge, включая вычисляемые"""
+        with self._lock:
+            gauges = dict(self._gauges)
+            functions = list(self._gauge_functions.items())
+        for key, function in functions:
+            try:
+                gauges[key] = function()
+            except Exception as e:
+                logger.error(f"Error collecting gauge {key[0]}: {e}")
+        return gauges
+
+    def snapshot(self) -> Dict[str, float]:
+        """Плоский срез всех метрик"""
+        result = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                result[format_metric_name(name, labels)] = value
+            for (name, labels), timing in self._timings.items():
+                result[format_metric_name(f"{name}_count", labels)] = timing[0]
+                result[format_metric_name(f"{name}_sum", labels)] = timing[1]
+                result[format_metric_name(f"{name}_max", labels)] = timing[2]
+        for (name, labels), value in self._collect_gauges().items():
+            result[format_metric_name(name, labels)] = value
+        return result
+
+    def render_prometheus(self) -> str:
+        """Все метрики в текстовом формате Prometheus"""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            timings = sorted((key, list(timing)) for key, timing in self._timings.items())
+        gauges = sorted(self._collect_gauges().items())
+
+        lines = []
+        declared = set()
+
+        def declare(name: str, metric_type: str):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} {metric_type}")
+
+        for (name, labels), value in counters:
+            declare(name, 'counter')
+            lines.append(f"{format_metric_name(name, labels)} {_format_value(value)}")
+
+        for (name, labels), timing in timings:
+            declare(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(self.buckets, timing[3:]):
+                cumulative += count
+                lines.append(f"{format_metric_name(f'{name}_bucket', labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{format_metric_name(f'{name}_bucket', labels + (('le', '+Inf'),))} {timing[0]}")
+            lines.append(f"{format_metric_name(f'{name}_sum', labels)} {_format_value(timing[1])}")
+            lines.append(f"{format_metric_name(f'{name}_count', labels)} {timing[0]}")
+
+        for (name, labels), value in gauges:
+            declare(name, 'gauge')
+            lines.append(f"{format_metric_name(name, labels)} {_format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+
+def timed(metric: str):
+    """Декоратор метода: длительность вызова в metric{method=...}, реестр — self.metrics"""
+    def decorator(func):
+        method = func.__name__
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            metrics = self.metrics
+            if metrics is None:
+                return func(self, *args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                metrics.observe(metric, time.perf_counter() - started, method=method)
+        return wrapper
+    return decorator
+
+
+def instrument_methods(metric: str):
+    """Декоратор класса: timed для всех публичных методов.
+
+    Генераторы не оборачиваются — их вызов только создает итератор.
+    """
+    def decorator(cls):
+        for name, member in list(vars(cls).items()):
+            if name.startswith('_') or not inspect.isfunction(member) or inspect.isgeneratorfunction(member):
+                continue
+            setattr(cls, name, timed(metric)(member))
+        return cls
+    return decorator
+
+
+async def start_metrics_server(registry: MetricsRegistry, host: str = None, port: int = None):
+    """Локальный HTTP-эндпоинт /metrics; METRICS_PORT=0 отключает его"""
+    host = host or os.getenv('METRICS_HOST', '127.0.0.1')
+    port = port if port is not None else int(os.getenv('METRICS_PORT', '9108'))
+    if not port:
+        return None
+
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(text=registry.render_prometheus(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics endpoint listening on http://{host}:{port}/metrics")
+    return runner
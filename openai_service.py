@@ -1,15 +1,69 @@
-import openai
+import asyncio
+import hashlib
 import os
-from typing import Dict, Optional
+import random
+import re
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, Optional
 import logging
 
+BUSINESS_CARD_SYSTEM_PROMPT = """Ты - эксперт по созданию профессиональных визиток и резюме. 
+                        Создавай привлекательные, структурированные визитки в формате Markdown.
+                        Используй эмодзи для улучшения визуального восприятия.
+                        Визитка должна быть краткой, но информативной, подчеркивать уникальность человека."""
+
+REGENERATE_SYSTEM_PROMPT = """Ты - эксперт по созданию профессиональных визиток и резюме. 
+                        Создавай привлекательные, структурированные визитки в формате Markdown.
+                        Каждая новая версия должна отличаться от предыдущей по подаче и акцентам."""
+
+
+def _import_openai():
+    """Ленивый импорт openai: библиотека тяжелая и нужна только при первой генерации"""
+    import openai
+    return openai
+
+
+def retryable_errors() -> tuple:
+    """Ошибки, после которых запрос имеет смысл повторить"""
+    openai = _import_openai()
+    return (
+        asyncio.TimeoutError,
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+        openai.RateLimitError,
+        openai.InternalServerError,
+    )
+
+
 class OpenAIService:
     def __init__(self):
         self.api_key = os.getenv('OPENAI_API_KEY')
-        if self.api_key:
-            openai.api_key = self.api_key
-        else:
+        if not self.api_key:
             logging.error("OpenAI API key not found in environment variables")
+        
+        # Настройки асинхронного клиента (OPENAI_BASE_URL позволяет указать локальный stub-сервер)
+        self.base_url = os.getenv('OPENAI_BASE_URL')
+        self.model = os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo')
+        self.timeout = float(os.getenv('OPENAI_TIMEOUT', '30'))
+        self.max_retries = int(os.getenv('OPENAI_MAX_RETRIES', '3'))
+        self.max_concurrency = int(os.getenv('OPENAI_MAX_CONCURRENCY', '4'))
+        self.cache_ttl = int(os.getenv('OPENAI_CACHE_TTL', '86400'))
+        self.cache_size = int(os.getenv('OPENAI_CACHE_SIZE', '1000'))
+        
+        self._async_client = None
+        self._semaphore = None
+        # Кэш готовых визиток: sha256(промпт) -> (время создания, текст)
+        self._cache: "OrderedDict[str, tuple]" = OrderedDict()
+        # Запросы в работе: одинаковые промпты ждут один и тот же ответ
+        self._in_flight: Dict[str, asyncio.Future] = {}
+    
+    def _get_openai(self):
+        """Модуль openai с ключом API для синхронных вызовов"""
+        openai = _import_openai()
+        if self.api_key and openai.api_key != self.api_key:
+            openai.api_key = self.api_key
+        return openai
     
     def generate_business_card(self, profile_data: Dict) -> Optional[str]:
         """Генерация визитки на основе данных профиля"""
@@ -17,31 +71,32 @@ class OpenAIService:
             # Формируем промпт для генерации визитки
             prompt = self._create_business_card_prompt(profile_data)
             
-            response = openai.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": """Ты - эксперт по созданию профессиональных визиток и резюме. 
-                        Создавай привлекательные, структурированные визитки в формате Markdown.
-                        Используй эмодзи для улучшения визуального восприятия.
-                        Визитка должна быть краткой, но информативной, подчеркивать уникальность человека."""
-                    },
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
+            response = self._get_openai().chat.completions.create(
+                model=self.model,
+                messages=self._build_messages(BUSINESS_CARD_SYSTEM_PROMPT, prompt),
                 max_tokens=1000,
                 temperature=0.7
             )
             
             return response.choices[0].message.content.strip()
-            
+        
         except Exception as e:
             logging.error(f"Failed to generate business card: {e}")
             return None
     
+    def _build_messages(self, system_prompt: str, prompt: str) -> list:
+        """Сообщения для chat completions"""
+        return [
+            {
+                "role": "system",
+                "content": system_prompt
+            },
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
+    
     def _create_business_card_prompt(self, profile_data: Dict) -> str:
         """Создание промпта для генерации визитки"""
         prompt = f"""
@@ -68,10 +123,9 @@ class OpenAIService:
 """
         return prompt
     
-    def regenerate_business_card(self, profile_data: Dict, previous_card: str) -> Optional[str]:
-        """Перегенерация визитки с учетом предыдущей версии"""
-        try:
-            prompt = f"""
+    def _create_regenerate_prompt(self, profile_data: Dict, previous_card: str) -> str:
+        """Создание промпта для перегенерации визитки"""
+        prompt = f"""
 Создай новую версию профессиональной визитки в формате Markdown на основе следующих данных:
 
 **Данные профиля:**
@@ -94,31 +148,232 @@ class OpenAIService:
 4. Сохраняет профессиональный тон, но с новым подходом
 5. Остается в пределах 200-400 слов
 """
+        return prompt
+    
+    def regenerate_business_card(self, profile_data: Dict, previous_card: str) -> Optional[str]:
+        """Перегенерация визитки с учетом предыдущей версии"""
+        try:
+            prompt = self._create_regenerate_prompt(profile_data, previous_card)
             
-            response = openai.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": """Ты - эксперт по созданию профессиональных визиток и резюме. 
-                        Создавай привлекательные, структурированные визитки в формате Markdown.
-                        Каждая новая версия должна отличаться от предыдущей по подаче и акцентам."""
-                    },
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
+            response = self._get_openai().chat.completions.create(
+                model=self.model,
+                messages=self._build_messages(REGENERATE_SYSTEM_PROMPT, prompt),
                 max_tokens=1000,
                 temperature=0.8
             )
             
             return response.choices[0].message.content.strip()
-            
+        
         except Exception as e:
             logging.error(f"Failed to regenerate business card: {e}")
             return None
+    
+    # Асинхронный путь: не блокирует event loop бота
+    
+    def _get_async_client(self):
+        """Ленивое создание асинхронного клиента OpenAI"""
+        if self._async_client is None:
+            import httpx
+            
+            self._async_client = _import_openai().AsyncOpenAI(
+                api_key=self.api_key or 'stub',
+                base_url=self.base_url,
+                timeout=self.timeout,
+                max_retries=0,  # Повторы с jitter делаем сами
+                # Собственный httpx-клиент: openai 1.39 передает proxies, которых нет в httpx 0.28
+                http_client=httpx.AsyncClient(
+                    timeout=self.timeout,
+                    limits=httpx.Limits(max_connections=self.max_concurrency * 2)
+                )
+            )
+        return self._async_client
+    
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        """Семафор ограничения одновременных запросов к OpenAI"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+    
+    @staticmethod
+    def _normalize_prompt(prompt: str) -> str:
+        """Нормализация промпта: лишние пробелы и переводы строк не влияют на ключ кэша"""
+        lines = [re.sub(r'\s+', ' ', line).strip() for line in prompt.strip().splitlines()]
+        return '\n'.join(line for line in lines if line)
+    
+    def _cache_key(self, system_prompt: str, prompt: str, temperature: float) -> str:
+        """Ключ кэша по содержимому запроса"""
+        payload = '\x00'.join([
+            self.model,
+            f"{temperature:.2f}",
+            self._normalize_prompt(system_prompt),
+            self._normalize_prompt(prompt),
+        ])
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def _cache_get(self, key: str) -> Optional[str]:
+        """Получение визитки из кэша с учетом TTL"""
+        item = self._cache.get(key)
+        if item is None:
+            return None
+        created_at, content = item
+        if time.monotonic() - created_at > self.cache_ttl:
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return content
+    
+    def _cache_put(self, key: str, content: str):
+        """Сохранение визитки в кэш"""
+        self._cache[key] = (time.monotonic(), content)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+    
+    async def _complete_with_retries(self, messages: list, temperature: float) -> str:
+        """Запрос к OpenAI с таймаутом, повторами и экспоненциальной задержкой с jitter"""
+        client = self._get_async_client()
+        attempt = 0
+        
+        while True:
+            try:
+                async with self._get_semaphore():
+                    response = await asyncio.wait_for(
+                        client.chat.completions.create(
+                            model=self.model,
+                            messages=messages,
+                            max_tokens=1000,
+                            temperature=temperature
+                        ),
+                        timeout=self.timeout
+                    )
+                return response.choices[0].message.content.strip()
+            except retryable_errors() as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                await self._retry_sleep(attempt, e)
+    
+    async def _retry_sleep(self, attempt: int, error: Exception):
+        """Пауза перед повтором: full jitter, случайная задержка от 0 до base * 2^attempt"""
+        delay = random.uniform(0, min(10.0, 0.5 * (2 ** attempt)))
+        logging.warning(f"OpenAI request failed ({error!r}), retry {attempt}/{self.max_retries} in {delay:.2f}s")
+        await asyncio.sleep(delay)
+    
+    async def _generate_async(self, system_prompt: str, prompt: str, temperature: float,
+                              use_cache: bool = True) -> Optional[str]:
+        """Генерация с кэшем и объединением одинаковых одновременных запросов"""
+        key = self._cache_key(system_prompt, prompt, temperature)
+        
+        if use_cache:
+            cached = self._cache_get(key)
+            if cached is not None:
+                logging.info(f"Business card cache hit {key[:12]}")
+                return cached
+        
+        # Такой же запрос уже выполняется — ждем его результат
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            return await asyncio.shield(in_flight)
+        
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            content = await self._complete_with_retries(
+                self._build_messages(system_prompt, prompt), temperature
+            )
+            if use_cache and content:
+                self._cache_put(key, content)
+            future.set_result(content)
+            return content
+        except Exception as e:
+            logging.error(f"Failed to generate business card: {e}")
+            future.set_result(None)
+            return None
+        finally:
+            self._in_flight.pop(key, None)
+            # Задачу-владельца отменили (CancelledError не Exception): ожидающие
+            # получают None, как при ошибке, а не висят на future навсегда
+            if not future.done():
+                future.set_result(None)
+    
+    async def generate_business_card_async(self, profile_data: Dict) -> Optional[str]:
+        """Асинхронная генерация визитки (с кэшем по содержимому профиля)"""
+        prompt = self._create_business_card_prompt(profile_data)
+        return await self._generate_async(BUSINESS_CARD_SYSTEM_PROMPT, prompt, temperature=0.7)
+    
+    async def regenerate_business_card_async(self, profile_data: Dict, previous_card: str) -> Optional[str]:
+        """Асинхронная перегенерация визитки.
+
+        Результат не кэшируется — пользователь явно просит новую версию, но
+        одновременные одинаковые запросы (повторные нажатия) объединяются.
+        """
+        prompt = self._create_regenerate_prompt(profile_data, previous_card)
+        return await self._generate_async(REGENERATE_SYSTEM_PROMPT, prompt, temperature=0.8, use_cache=False)
+    
+    # Потоковая генерация: токены отдаются по мере поступления
+    
+    async def _stream_async(self, system_prompt: str, prompt: str, temperature: float,
+                            use_cache: bool = True) -> AsyncIterator[str]:
+        """Потоковая генерация с повтором, пока не получен первый токен"""
+        key = self._cache_key(system_prompt, prompt, temperature)
+        
+        if use_cache:
+            cached = self._cache_get(key)
+            if cached is not None:
+                logging.info(f"Business card cache hit {key[:12]}")
+                yield cached
+                return
+        
+        client = self._get_async_client()
+        messages = self._build_messages(system_prompt, prompt)
+        attempt = 0
+        parts = []
+        
+        while True:
+            try:
+                async with self._get_semaphore():
+                    stream = await asyncio.wait_for(
+                        client.chat.completions.create(
+                            model=self.model,
+                            messages=messages,
+                            max_tokens=1000,
+                            temperature=temperature,
+                            stream=True
+                        ),
+                        timeout=self.timeout
+                    )
+                    chunks = stream.__aiter__()
+                    while True:
+                        try:
+                            # Таймаут на паузу между токенами, а не на весь ответ
+                            chunk = await asyncio.wait_for(chunks.__anext__(), timeout=self.timeout)
+                        except StopAsyncIteration:
+                            break
+                        delta = chunk.choices[0].delta.content if chunk.choices else None
+                        if delta:
+                            parts.append(delta)
+                            yield delta
+                break
+            except retryable_errors() as e:
+                # После первого токена повтор невозможен — пользователь уже видит текст
+                attempt += 1
+                if parts or attempt > self.max_retries:
+                    raise
+                await self._retry_sleep(attempt, e)
+        
+        content = ''.join(parts).strip()
+        if use_cache and content:
+            self._cache_put(key, content)
+    
+    def stream_business_card(self, profile_data: Dict) -> AsyncIterator[str]:
+        """Потоковая генерация визитки (async-итератор фрагментов текста)"""
+        prompt = self._create_business_card_prompt(profile_data)
+        return self._stream_async(BUSINESS_CARD_SYSTEM_PROMPT, prompt, temperature=0.7)
+    
+    def stream_regenerate_business_card(self, profile_data: Dict, previous_card: str) -> AsyncIterator[str]:
+        """Потоковая перегенерация визитки (без кэша)"""
+        prompt = self._create_regenerate_prompt(profile_data, previous_card)
+        return self._stream_async(REGENERATE_SYSTEM_PROMPT, prompt, temperature=0.8, use_cache=False)
 
 # Создаем глобальный экземпляр сервиса OpenAI
 openai_service = OpenAIService()
-
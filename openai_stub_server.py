@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Локальный stub-сервер OpenAI Chat Completions для тестирования генерации визиток.
+
+Запуск:
+    python3 openai_stub_server.py --port 8089 --latency 1.5 --error-rate 0.2
+
+Бот направляется на сервер переменной окружения:
+    OPENAI_BASE_URL=http://127.0.0.1:8089/v1
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import re
+import time
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+def build_stub_card(prompt: str) -> str:
+    """Детерминированная визитка по тексту промпта"""
+    digest = hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:8]
+    name_line = next((line for line in prompt.splitlines() if line.startswith('**Имя:**')), '**Имя:** -')
+    return (
+        f"# 🆔 Визитка\n\n"
+        f"{name_line}\n\n"
+        f"💡 Сгенерировано stub-сервером OpenAI\n"
+        f"🔑 Отпечаток запроса: `{digest}`"
+    )
+
+
+class OpenAIStubServer:
+    def __init__(self, latency: float = 0.5, error_rate: float = 0.0, token_delay: float = 0.05):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.token_delay = token_delay
+        self.requests_count = 0
+
+    def create_app(self) -> web.Application:
+        """Создание aiohttp-приложения"""
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self.chat_completions)
+        app.router.add_get('/stats', self.stats)
+        return app
+
+    async def stats(self, request: web.Request) -> web.Response:
+        """Количество обработанных запросов (для проверки кэша и дедупликации)"""
+        return web.json_response({'requests': self.requests_count})
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        """Эмуляция POST /v1/chat/completions"""
+        self.requests_count += 1
+        body = await request.json()
+        prompt = body['messages'][-1]['content']
+
+        await asyncio.sleep(self.latency)
+
+        if random.random() < self.error_rate:
+            return web.json_response(
+                {'error': {'message': 'stub overloaded', 'type': 'server_error'}},
+                status=random.choice([429, 500, 503])
+            )
+
+        content = build_stub_card(prompt)
+        created = int(time.time())
+
+        if body.get('stream'):
+            return await self._stream_completion(request, body, content, created)
+
+        return web.json_response({
+            'id': f"chatcmpl-stub-{self.requests_count}",
+            'object': 'chat.completion',
+            'created': created,
+            'model': body.get('model', 'stub'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content},
+                'finish_reason': 'stop'
+            }],
+            'usage': {'prompt_tokens': len(prompt.split()), 'completion_tokens': len(content.split()),
+                      'total_tokens': len(prompt.split()) + len(content.split())}
+        })
+
+    async def _stream_completion(self, request: web.Request, body: dict, content: str,
+                                 created: int) -> web.StreamResponse:
+        """Ответ в формате server-sent events, как при stream=True"""
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+
+        completion_id = f"chatcmpl-stub-{self.requests_count}"
+        # Отдаем по слову вместе с последующими пробелами и переводами строк
+        for piece in re.findall(r'\S+\s*', content):
+            chunk = {
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': created,
+                'model': body.get('model', 'stub'),
+                'choices': [{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}]
+            }
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+            await asyncio.sleep(self.token_delay)
+
+        final_chunk = {
+            'id': completion_id,
+            'object': 'chat.completion.chunk',
+            'created': created,
+            'model': body.get('model', 'stub'),
+            'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]
+        }
+        await response.write(f"data: {json.dumps(final_chunk)}\n\n".encode('utf-8'))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub-сервер OpenAI для тестирования")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.5, help="Задержка ответа в секундах")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Доля ответов с ошибкой 429/5xx")
+    parser.add_argument('--token-delay', type=float, default=0.05, help="Пауза между токенами при stream=True")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = OpenAIStubServer(latency=args.latency, error_rate=args.error_rate, token_delay=args.token_delay)
+    web.run_app(server.create_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Исходящий диспетчер сообщений Telegram.
+
+Все фоновые рассылки (отчеты, напоминания, push) идут через один диспетчер:
+общий лимит скорости вместо пауз в каждом цикле, ожидание при 429
+(retry_after распространяется на все отправки) и метрики отправок.
+"""
+
+import asyncio
+import logging
+import os
+import time
+
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+
+class OutboundDispatcher:
+    def __init__(self, bot, metrics, rate_per_second: float = None, max_retries: int = 3):
+        self.bot = bot
+        self.metrics = metrics
+        rate = rate_per_second or float(os.getenv('OUTBOUND_RATE_PER_SECOND', '25'))
+        self.min_interval = 1.0 / rate
+        self.max_retries = max_retries
+        # Момент, раньше которого нельзя начинать следующую отправку
+        self._next_slot = 0.0
+
+    async def _acquire_slot(self):
+        """Резервирование слота отправки в пределах лимита скорости"""
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.min_interval
+        if slot > now:
+            self.metrics.observe('outbound_wait_seconds', slot - now)
+            with tracer.span('outbound.wait', seconds=round(slot - now, 3)):
+                await asyncio.sleep(slot - now)
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        """Отправка сообщения с учетом лимита и повтором при 429; прочие ошибки пробрасываются"""
+        attempt = 0
+        while True:
+            await self._acquire_slot()
+            started = time.monotonic()
+            try:
+                message = await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                self.metrics.inc('outbound_messages_total', status='sent')
+                self.metrics.observe('outbound_send_seconds', time.monotonic() - started)
+                return message
+            except TelegramRetryAfter as e:
+                self.metrics.inc('outbound_messages_total', status='retry_after')
+                attempt += 1
+                if attempt > self.max_retries:
+                    self.metrics.inc('outbound_messages_total', status='failed')
+                    raise
+                # Telegram ограничил бота целиком — откладываем все следующие отправки
+                self._next_slot = max(self._next_slot, time.monotonic() + e.retry_after)
+                logger.warning(f"Flood control for chat {chat_id}, retry in {e.retry_after}s")
+            except TelegramForbiddenError:
+                self.metrics.inc('outbound_messages_total', status='blocked')
+                raise
+            except Exception:
+                self.metrics.inc('outbound_messages_total', status='failed')
+                raise
+
+    def get_stats(self) -> dict:
+        """Счетчики отправок"""
+        return {
+            status: int(self.metrics.get_counter('outbound_messages_total', status=status))
+            for status in ('sent', 'retry_after', 'blocked', 'failed')
+        }
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+Трассировка SQL-запросов Database (включается явно).
+
+С DB_TRACE=1 соединения базы создаются с трассирующим курсором: для каждого
+запроса учитываются текст, форма параметров (типы, без значений), длительность
+вместе с чтением строк и число строк. Запросы дольше DB_SLOW_QUERY_MS
+(по умолчанию 100 мс) пишутся строкой JSON в DB_SLOW_LOG
+(по умолчанию slow_queries.jsonl); для каждого различного запроса один раз
+сохраняется EXPLAIN QUERY PLAN.
+
+Сводка по самым медленным запросам из лога:
+    python3 query_tracer.py --log slow_queries.jsonl --top 10 --sort total
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Запросы, для которых имеет смысл план выполнения
+_EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+_WHITESPACE = re.compile(r'\s+')
+# Списки плейсхолдеров разной длины (IN (?, ?, ?)) — один и тот же запрос
+_PLACEHOLDER_LIST = re.compile(r'\?(\s*,\s*\?)+')
+
+
+def normalize_statement(sql: str) -> str:
+    """Текст запроса без лишних пробелов и с одинаковыми списками плейсхолдеров"""
+    return _PLACEHOLDER_LIST.sub('?, ...', _WHITESPACE.sub(' ', sql).strip())
+
+
+def params_shape(params) -> List[str]:
+    """Типы параметров запроса (значения не сохраняются)"""
+    if isinstance(params, dict):
+        return [f"{name}:{type(value).__name__}" for name, value in params.items()]
+    return [type(value).__name__ for value in params or ()]
+
+
+class QueryTracer:
+    def __init__(self, enabled: bool = None, slow_ms: float = None, log_path: str = None):
+        self.enabled = enabled if enabled is not None else os.getenv('DB_TRACE', '0') == '1'
+        self.slow_seconds = (slow_ms if slow_ms is not None else float(os.getenv('DB_SLOW_QUERY_MS', '100'))) / 1000
+        self.log_path = log_path or os.getenv('DB_SLOW_LOG', 'slow_queries.jsonl')
+        self._lock = threading.Lock()
+        # Запросы, план которых уже записан в лог
+        self._explained = set()
+        # Нормализованный запрос -> [количество, суммарное время, максимум, строк всего]
+        self._stats: Dict[str, list] = {}
+
+    def record(self, connection: sqlite3.Connection, sql: str, params, seconds: float, rows: int,
+               executions: int = 1):
+        """Учет выполненного запроса; медленный — в лог"""
+        statement = normalize_statement(sql)
+        with self._lock:
+            stats = self._stats.get(statement)
+            if stats is None:
+                stats = self._stats[statement] = [0, 0.0, 0.0, 0]
+            stats[0] += executions
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            stats[3] += rows
+
+        if seconds < self.slow_seconds:
+            return
+
+        entry = {
+            'ts': datetime.now().isoformat(timespec='seconds'),
+            'statement': statement,
+            'params': params_shape(params),
+            'executions': executions,
+            'duration_ms': round(seconds * 1000, 3),
+            'rows': rows,
+        }
+        with self._lock:
+            need_plan = statement not in self._explained
+            self._explained.add(statement)
+        if need_plan:
+            entry['plan'] = self._explain(connection, sql, params)
+
+        line = json.dumps(entry, ensure_ascii=False)
+        with self._lock:
+            try:
+                with open(self.log_path, 'a', encoding='utf-8') as log_file:
+                    log_file.write(line + '\n')
+            except OSError as e:
+                logger.error(f"Error writing slow query log: {e}")
+
+    def _explain(self, connection: sqlite3.Connection, sql: str, params) -> Optional[List[str]]:
+        """EXPLAIN QUERY PLAN в том же соединении (не трассируется и не выполняет запрос)"""
+        if not sql.lstrip().upper().startswith(_EXPLAINABLE):
+            return None
+        try:
+            cursor = sqlite3.Cursor(connection)
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params or ())
+            return [row[3] for row in cursor.fetchall()]
+        except Exception as e:
+            return [f"error: {e}"]
+
+    def get_stats(self, top: int = 10) -> List[Dict]:
+        """Запросы процесса с наибольшим суммарным временем"""
+        with self._lock:
+            items = sorted(self._stats.items(), key=lambda item: item[1][1], reverse=True)[:top]
+        return [
+            {'statement': statement, 'count': count, 'total_ms': total * 1000,
+             'max_ms': maximum * 1000, 'rows': rows}
+            for statement, (count, total, maximum, rows) in items
+        ]
+
+
+class TracingCursor(sqlite3.Cursor):
+    """Курсор, который замеряет запрос вместе с чтением его строк"""
+
+    def __init__(self, connection):
+        super().__init__(connection)
+        self._trace = None
+
+    def _finish(self):
+        """Запись текущего запроса в трассировщик"""
+        trace, self._trace = self._trace, None
+        if trace is not None:
+            sql, params, seconds, rows, executions = trace
+            self.connection.tracer.record(self.connection, sql, params, seconds, rows, executions)
+
+    def _start(self, sql: str, params, seconds: float, executions: int = 1):
+        self._trace = [sql, params, seconds, 0, executions]
+        if self.description is None:
+            # Не SELECT: строк для чтения нет, учитываем сразу
+            self._trace[3] = max(self.rowcount, 0)
+            self._finish()
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        started = time.perf_counter()
+        super().execute(sql, parameters)
+        self._start(sql, parameters, time.perf_counter() - started)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        seq_of_parameters = list(seq_of_parameters)
+        started = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        self._start(sql, seq_of_parameters[0] if seq_of_parameters else (),
+                    time.perf_counter() - started, executions=len(seq_of_parameters))
+        return self
+
+    def _fetched(self, rows: int, seconds: float, exhausted: bool):
+        if self._trace is not None:
+            self._trace[2] += seconds
+            self._trace[3] += rows
+            if exhausted:
+                self._finish()
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(row is not None, time.perf_counter() - started, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(size if size is not None else self.arraysize)
+        self._fetched(len(rows), time.perf_counter() - started,
+                      len(rows) < (size if size is not None else self.arraysize))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(len(rows), time.perf_counter() - started, True)
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(0, time.perf_counter() - started, True)
+            raise
+        self._fetched(1, time.perf_counter() - started, False)
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        # Запрос, строки которого прочитаны не до конца (fetchone без повторного вызова)
+        if getattr(self, '_trace', None) is not None:
+            try:
+                self._finish()
+            except Exception:
+                pass
+
+
+class TracingConnection(sqlite3.Connection):
+    """Соединение, все курсоры которого трассируются"""
+
+    tracer: QueryTracer = None
+
+    def cursor(self, factory=TracingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    """Соединение с базой: трассируемое, если трассировка включена"""
+    if not query_tracer.enabled:
+        return sqlite3.connect(db_path)
+    connection = sqlite3.connect(db_path, factory=TracingConnection)
+    connection.tracer = query_tracer
+    return connection
+
+
+def summarize(log_path: str, top: int = 10, sort: str = 'total') -> List[Dict]:
+    """Сводка по медленным запросам из лога: худшие по суммарному, максимальному времени или числу"""
+    summary: Dict[str, Dict] = {}
+    with open(log_path, encoding='utf-8') as log_file:
+        for line in log_file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            item = summary.setdefault(entry['statement'], {
+                'statement': entry['statement'], 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                'rows': 0, 'params': entry.get('params'), 'plan': None
+            })
+            item['count'] += 1
+            item['total_ms'] += entry['duration_ms']
+            item['max_ms'] = max(item['max_ms'], entry['duration_ms'])
+            item['rows'] += entry.get('rows', 0)
+            if entry.get('plan'):
+                item['plan'] = entry['plan']
+
+    key = {'total': 'total_ms', 'max': 'max_ms', 'count': 'count'}[sort]
+    return sorted(summary.values(), key=lambda item: item[key], reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сводка по медленным SQL-запросам")
+    parser.add_argument('--log', default=os.getenv('DB_SLOW_LOG', 'slow_queries.jsonl'))
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--sort', choices=('total', 'max', 'count'), default='total')
+    args = parser.parse_args()
+
+    for index, item in enumerate(summarize(args.log, args.top, args.sort), 1):
+        print(f"{index}. {item['count']} раз, всего {item['total_ms']:.1f} мс, "
+              f"макс. {item['max_ms']:.1f} мс, в среднем {item['total_ms'] / item['count']:.1f} мс, "
+              f"строк в среднем {item['rows'] / item['count']:.0f}")
+        print(f"   {item['statement']}")
+        print(f"   параметры: {', '.join(item['params'] or []) or '—'}")
+        for step in item['plan'] or []:
+            print(f"   план: {step}")
+        print()
+
+
+# Глобальный трассировщик запросов (включается DB_TRACE=1)
+query_tracer = QueryTracer()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+Правила повторения событий и привычек.
+
+Правило хранится одной строкой в подмножестве формата RRULE (RFC 5545):
+    FREQ=DAILY;INTERVAL=2                 — через день
+    FREQ=WEEKLY;BYDAY=MO,TU,WE,TH,FR      — по будням
+    FREQ=MONTHLY;BYMONTHDAY=15            — 15-го числа каждого месяца
+плюс необязательные UNTIL=ГГГГММДД и COUNT=N. Вхождения не сохраняются в базе:
+они вычисляются лениво только внутри запрошенного окна, причем генератор
+сразу переходит к началу окна, а не перебирает все вхождения с первого.
+"""
+
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from typing import Iterator, Optional
+
+FREQUENCIES = ('DAILY', 'WEEKLY', 'MONTHLY')
+WEEKDAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+
+_WEEKDAY_NAMES = ('пн', 'вт', 'ср', 'чт', 'пт', 'сб', 'вс')
+
+# Готовые правила для кнопок бота
+RULE_DAILY = "FREQ=DAILY"
+RULE_EVERY_OTHER_DAY = "FREQ=DAILY;INTERVAL=2"
+RULE_WEEKDAYS = "FREQ=WEEKLY;BYDAY=MO,TU,WE,TH,FR"
+RULE_WEEKLY = "FREQ=WEEKLY"
+RULE_MONTHLY = "FREQ=MONTHLY"
+
+
+class RecurrenceRule:
+    __slots__ = ('freq', 'interval', 'weekdays', 'month_day', 'until', 'count')
+
+    def __init__(self, freq: str, interval: int = 1, weekdays: tuple = (), month_day: int = None,
+                 until: date = None, count: int = None):
+        if freq not in FREQUENCIES:
+            raise ValueError(f"Unsupported FREQ: {freq}")
+        if interval < 1:
+            raise ValueError(f"INTERVAL must be positive: {interval}")
+        if month_day is not None and not 1 <= month_day <= 31:
+            raise ValueError(f"BYMONTHDAY out of range: {month_day}")
+        if count is not None and count < 1:
+            raise ValueError(f"COUNT must be positive: {count}")
+        self.freq = freq
+        self.interval = interval
+        self.weekdays = tuple(sorted(set(weekdays)))
+        self.month_day = month_day
+        self.until = until
+        self.count = count
+
+    @classmethod
+    def parse(cls, text: str) -> "RecurrenceRule":
+        """Разбор строки правила; ValueError при неверном формате"""
+        parts = {}
+        for part in text.strip().upper().split(';'):
+            if not part:
+                continue
+            name, sep, value = part.partition('=')
+            if not sep or not value:
+                raise ValueError(f"Malformed rule part: {part}")
+            parts[name] = value
+
+        weekdays = ()
+        if 'BYDAY' in parts:
+            try:
+                weekdays = tuple(WEEKDAYS.index(day) for day in parts['BYDAY'].split(','))
+            except ValueError:
+                raise ValueError(f"Unsupported BYDAY: {parts['BYDAY']}")
+
+        return cls(
+            freq=parts.get('FREQ', ''),
+            interval=int(parts.get('INTERVAL', 1)),
+            weekdays=weekdays,
+            month_day=int(parts['BYMONTHDAY']) if 'BYMONTHDAY' in parts else None,
+            until=datetime.strptime(parts['UNTIL'][:8], '%Y%m%d').date() if 'UNTIL' in parts else None,
+            count=int(parts['COUNT']) if 'COUNT' in parts else None,
+        )
+
+    def __str__(self) -> str:
+        parts = [f"FREQ={self.freq}"]
+        if self.interval != 1:
+            parts.append(f"INTERVAL={self.interval}")
+        if self.weekdays:
+            parts.append("BYDAY=" + ",".join(WEEKDAYS[day] for day in self.weekdays))
+        if self.month_day is not None:
+            parts.append(f"BYMONTHDAY={self.month_day}")
+        if self.until is not None:
+            parts.append(f"UNTIL={self.until.strftime('%Y%m%d')}")
+        if self.count is not None:
+            parts.append(f"COUNT={self.count}")
+        return ";".join(parts)
+
+    def describe(self) -> str:
+        """Описание правила для пользователя"""
+        if self.freq == 'DAILY':
+            text = "каждый день" if self.interval == 1 else f"каждые {self.interval} дн."
+        elif self.freq == 'WEEKLY':
+            if self.weekdays == (0, 1, 2, 3, 4) and self.interval == 1:
+                text = "по будням"
+            else:
+                text = "каждую неделю" if self.interval == 1 else f"каждые {self.interval} нед."
+                if self.weekdays:
+                    text += " (" + ", ".join(_WEEKDAY_NAMES[day] for day in self.weekdays) + ")"
+        else:
+            text = "каждый месяц" if self.interval == 1 else f"каждые {self.interval} мес."
+            if self.month_day is not None:
+                text += f" ({self.month_day}-го числа)"
+        if self.until is not None:
+            text += f" до {self.until.strftime('%d.%m.%Y')}"
+        if self.count is not None:
+            text += f", {self.count} раз"
+        return text
+
+    def _candidates(self, dtstart: datetime, from_dt: datetime, to_dt: datetime) -> Iterator[datetime]:
+        """Вхождения по порядку от периода, содержащего from_dt, до периода, начинающегося после to_dt"""
+        if self.freq == 'DAILY':
+            step = timedelta(days=self.interval)
+            current = dtstart + step * max((from_dt - dtstart) // step, 0)
+            while current < to_dt:
+                yield current
+                current += step
+
+        elif self.freq == 'WEEKLY':
+            weekdays = self.weekdays or (dtstart.weekday(),)
+            first_monday = dtstart - timedelta(days=dtstart.weekday())
+            # Номер недели, выровненный на INTERVAL
+            weeks = max((from_dt - first_monday) // timedelta(weeks=1), 0)
+            monday = first_monday + timedelta(weeks=weeks - weeks % self.interval)
+            while monday < to_dt:
+                for day in weekdays:
+                    candidate = monday + timedelta(days=day)
+                    if candidate >= dtstart:
+                        yield candidate
+                monday += timedelta(weeks=self.interval)
+
+        else:
+            month_day = self.month_day or dtstart.day
+            months = max((from_dt.year - dtstart.year) * 12 + from_dt.month - dtstart.month, 0)
+            month = months - months % self.interval
+            while True:
+                year, month_index = divmod(dtstart.month - 1 + month, 12)
+                if datetime(dtstart.year + year, month_index + 1, 1) >= to_dt:
+                    return
+                try:
+                    candidate = dtstart.replace(year=dtstart.year + year, month=month_index + 1, day=month_day)
+                except ValueError:
+                    # В месяце нет такого числа (31-е в апреле) — месяц пропускается, как в RRULE
+                    candidate = None
+                if candidate is not None and candidate >= dtstart:
+                    yield candidate
+                month += self.interval
+
+    def occurrences(self, dtstart: datetime, window_start: datetime, window_end: datetime) -> Iterator[datetime]:
+        """Вхождения в [window_start, window_end) по возрастанию"""
+        # С COUNT нужно знать номер вхождения, поэтому счет идет с первого (их не больше COUNT)
+        from_dt = dtstart if self.count is not None else max(window_start, dtstart)
+        for index, occurrence in enumerate(self._candidates(dtstart, from_dt, window_end)):
+            if self.count is not None and index >= self.count:
+                return
+            if occurrence >= window_end:
+                return
+            if self.until is not None and occurrence.date() > self.until:
+                return
+            if occurrence >= window_start:
+                yield occurrence
+
+    def occurs_on(self, dtstart: date, day: date) -> bool:
+        """Есть ли вхождение в этот день (для привычек: dtstart — дата создания)"""
+        start = datetime.combine(dtstart, time())
+        day_start = datetime.combine(day, time())
+        return next(self.occurrences(start, day_start, day_start + timedelta(days=1)), None) is not None
+
+
+@lru_cache(maxsize=1024)
+def parse_rule(text: Optional[str]) -> Optional[RecurrenceRule]:
+    """Разобранное правило (с кэшем) или None для пустой строки"""
+    if not text:
+        return None
+    return RecurrenceRule.parse(text)
+
+
+def normalize_rule(text: Optional[str]) -> Optional[str]:
+    """Каноническая запись правила для сохранения; ValueError при неверном формате"""
+    rule = parse_rule(text)
+    return str(rule) if rule else None
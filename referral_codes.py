@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Детерминированные обратимые реферальные коды.
+
+Код — это user_id, зашифрованный перестановкой Фейстеля на 64 битах с ключом
+REFERRAL_CODE_SECRET (если он не задан — со случайным ключом, который создается
+при первом запуске и хранится в таблице internal_settings), плюс 24-битная
+HMAC-подпись; всё вместе записано в base62 с префиксом REF_. Код декодируется в user_id без обращения к базе, а подпись
+отсекает случайные и подобранные строки. Старые коды (случайные и REF_<id>_<дата>)
+ищутся по индексированной таблице referral_code_aliases.
+
+Перенос существующих пользователей на новые коды:
+    python3 referral_codes.py --backfill --batch-size 1000
+"""
+
+import argparse
+import hashlib
+import hmac
+import logging
+import os
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+REFERRAL_CODE_PREFIX = "REF_"
+
+_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+_CODE_LENGTH = 15  # 62^15 > 2^88: 64 бита идентификатора + 24 бита подписи
+_ROUNDS = 4
+_MASK32 = 0xFFFFFFFF
+_TAG_BITS = 24
+
+# Ключ из REFERRAL_CODE_SECRET; без него Database при инициализации задает ключ,
+# сгенерированный при первом запуске и сохраненный в таблице internal_settings
+_KEY: Optional[bytes] = os.getenv('REFERRAL_CODE_SECRET', '').encode('utf-8') or None
+
+
+def set_referral_key(secret: str):
+    """Ключ кодов (если REFERRAL_CODE_SECRET не задан)"""
+    global _KEY
+    if not secret:
+        raise ValueError("Referral code key must not be empty")
+    _KEY = secret.encode('utf-8')
+
+
+def has_referral_key() -> bool:
+    return _KEY is not None
+
+
+def referral_key_id() -> str:
+    """Отпечаток ключа: по нему видно, что коды в базе выданы другим ключом"""
+    return hmac.new(_require_key(), b"key-id", hashlib.sha256).hexdigest()[:16]
+
+
+def _require_key() -> bytes:
+    """Ключ кодов; без ключа коды не выдаются и не принимаются"""
+    if _KEY is None:
+        raise RuntimeError("Referral code key is not configured: set REFERRAL_CODE_SECRET or open the Database first")
+    return _KEY
+
+
+def _round(half: int, index: int) -> int:
+    """Раундовая функция Фейстеля"""
+    digest = hmac.new(_require_key(), bytes([index]) + half.to_bytes(4, 'big'), hashlib.sha256).digest()
+    return int.from_bytes(digest[:4], 'big')
+
+
+def _permute(value: int) -> int:
+    """Прямая перестановка 64-битного числа"""
+    left, right = value >> 32, value & _MASK32
+    for index in range(_ROUNDS):
+        left, right = right, left ^ _round(right, index)
+    return (left << 32) | right
+
+
+def _unpermute(value: int) -> int:
+    """Обратная перестановка"""
+    left, right = value >> 32, value & _MASK32
+    for index in reversed(range(_ROUNDS)):
+        left, right = right ^ _round(left, index), left
+    return (left << 32) | right
+
+
+def _tag(user_id: int) -> int:
+    """Подпись идентификатора"""
+    digest = hmac.new(_require_key(), b"tag" + user_id.to_bytes(8, 'big'), hashlib.sha256).digest()
+    return int.from_bytes(digest[:_TAG_BITS // 8], 'big')
+
+
+def encode_referral_code(user_id: int) -> str:
+    """Реферальный код пользователя"""
+    if not 0 <= user_id < 2 ** 64:
+        raise ValueError(f"user_id out of range: {user_id}")
+
+    number = (_permute(user_id) << _TAG_BITS) | _tag(user_id)
+    chars = []
+    for _ in range(_CODE_LENGTH):
+        number, remainder = divmod(number, 62)
+        chars.append(_ALPHABET[remainder])
+    return REFERRAL_CODE_PREFIX + "".join(reversed(chars))
+
+
+def decode_referral_code(code: str) -> Optional[int]:
+    """user_id из кода или None, если код не нового формата или подпись не сходится"""
+    if not code or not code.startswith(REFERRAL_CODE_PREFIX):
+        return None
+    body = code[len(REFERRAL_CODE_PREFIX):]
+    if len(body) != _CODE_LENGTH:
+        return None
+
+    number = 0
+    for char in body:
+        index = _ALPHABET.find(char)
+        if index < 0:
+            return None
+        number = number * 62 + index
+
+    if number >> (64 + _TAG_BITS):
+        return None
+
+    user_id = _unpermute(number >> _TAG_BITS)
+    if not hmac.compare_digest(_tag(user_id).to_bytes(3, 'big'),
+                               (number & ((1 << _TAG_BITS) - 1)).to_bytes(3, 'big')):
+        return None
+    return user_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Реферальные коды")
+    parser.add_argument('--backfill', action='store_true', help="Перевести пользователей на новые коды")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--db', default=os.getenv('DATABASE_PATH', 'bot_database.db'))
+    parser.add_argument('--encode', type=int, help="Показать код для user_id")
+    parser.add_argument('--decode', help="Показать user_id для кода")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if not has_referral_key():
+        # Ключ, сохраненный в базе при первом запуске бота (при запуске скрипта
+        # этот модуль — __main__, а не referral_codes, который настраивает Database)
+        from database import Database
+        set_referral_key(Database(args.db).get_internal_setting('referral_code_secret'))
+
+    if args.encode is not None:
+        print(encode_referral_code(args.encode))
+    if args.decode:
+        print(decode_referral_code(args.decode))
+    if args.backfill:
+        from database import Database
+        migrated = Database(args.db).backfill_referral_codes(batch_size=args.batch_size)
+        print(f"Migrated {migrated} users")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+Сэмплирующий профилировщик работающего бота.
+
+Профиль снимается без перезапуска и внешних инструментов: отдельный поток
+каждые PROFILER_INTERVAL_MS (по умолчанию 5) читает стек потока event loop
+через sys._current_frames(), код бота при этом не трассируется. Если стек
+снят во время выполнения задачи asyncio, в корень добавляется кадр
+task:<корутина>, поэтому время обработчиков, push и отчетов видно раздельно;
+ожидание в select помечается как idle.
+
+Результат сохраняется в PROFILE_DIR (по умолчанию profiles; /profile удаляет
+файлы после отправки) в двух видах:
+свернутые стеки (.folded, для flamegraph.pl и speedscope) и pstats (.pstats,
+собирается из тех же сэмплов: tottime — время на вершине стека,
+cumtime — время в стеке).
+"""
+
+import asyncio
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+MAX_PROFILE_SECONDS = 300
+MAX_STACK_DEPTH = 64
+
+# Функции, в которых event loop ждет событий
+_IDLE_FUNCTIONS = {('selectors.py', 'select'), ('base_events.py', '_run_once')}
+
+
+class _SampledProfile:
+    """Объект для pstats.Stats: статистика функций, собранная из сэмплов"""
+
+    def __init__(self, stats: Dict):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class SamplingProfiler:
+    def __init__(self, interval_ms: float = None, output_dir: str = None):
+        self.interval = (interval_ms or float(os.getenv('PROFILER_INTERVAL_MS', '5'))) / 1000
+        self.output_dir = output_dir or os.getenv('PROFILE_DIR', 'profiles')
+        self._running = False
+
+    @property
+    def is_running(self) -> bool:
+        return self._running
+
+    async def profile(self, seconds: float, all_threads: bool = False, async_tasks: bool = True) -> Dict:
+        """Профиль за seconds секунд; возвращает пути к файлам и сводку"""
+        if self._running:
+            raise RuntimeError("Profiler is already running")
+        seconds = min(max(seconds, 1), MAX_PROFILE_SECONDS)
+        loop = asyncio.get_running_loop()
+        loop_thread_id = threading.get_ident()
+
+        # Стек от корня к вершине -> количество сэмплов
+        samples: Counter = Counter()
+        stop = threading.Event()
+        self._running = True
+
+        def sample():
+            thread_names = {}
+            while not stop.wait(self.interval):
+                frames = sys._current_frames()
+                for thread_id, frame in frames.items():
+                    if thread_id == sampler.ident or (not all_threads and thread_id != loop_thread_id):
+                        continue
+                    stack = self._extract(frame)
+                    if thread_id == loop_thread_id:
+                        root = self._loop_root(loop, stack, async_tasks)
+                    else:
+                        if thread_id not in thread_names:
+                            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+                        root = ('', f"thread:{thread_names.get(thread_id, thread_id)}", 0)
+                    samples[(root,) + stack] += 1
+
+        sampler = threading.Thread(target=sample, name='sampling-profiler', daemon=True)
+        started = time.perf_counter()
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            stop.set()
+            await asyncio.to_thread(sampler.join)
+            self._running = False
+
+        elapsed = time.perf_counter() - started
+        return await asyncio.to_thread(self._save, samples, elapsed)
+
+    def _extract(self, frame) -> Tuple[Tuple[str, str, int], ...]:
+        """Кадры от корня к вершине: (файл, функция, первая строка функции)"""
+        stack = []
+        while frame is not None and len(stack) < MAX_STACK_DEPTH:
+            code = frame.f_code
+            stack.append((code.co_filename, code.co_name, code.co_firstlineno))
+            frame = frame.f_back
+        stack.reverse()
+        return tuple(stack)
+
+    def _loop_root(self, loop, stack: tuple, async_tasks: bool) -> Tuple[str, str, int]:
+        """Корневой кадр для потока event loop: задача asyncio или ожидание"""
+        if stack and (os.path.basename(stack[-1][0]), stack[-1][1]) in _IDLE_FUNCTIONS:
+            return ('', 'idle', 0)
+        if async_tasks:
+            task = asyncio.current_task(loop)
+            if task is not None:
+                coroutine = task.get_coro()
+                return ('', f"task:{getattr(coroutine, '__qualname__', task.get_name())}", 0)
+        return ('', 'loop', 0)
+
+    def _label(self, entry: Tuple[str, str, int]) -> str:
+        filename, function, _ = entry
+        if not filename:
+            return function
+        return f"{os.path.basename(filename)}:{function}"
+
+    def _save(self, samples: Counter, elapsed: float) -> Dict:
+        """Запись .folded и .pstats, сводка по самым затратным функциям"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        base = os.path.join(self.output_dir, f"profile_{datetime.now():%Y%m%d_%H%M%S}")
+        total = sum(samples.values())
+
+        with open(f"{base}.folded", 'w', encoding='utf-8') as folded_file:
+            for stack, count in samples.most_common():
+                folded_file.write(";".join(self._label(entry) for entry in stack) + f" {count}\n")
+
+        stats = self._build_stats(samples, elapsed / total if total else self.interval)
+        pstats.Stats(_SampledProfile(stats)).dump_stats(f"{base}.pstats")
+
+        self_samples: Counter = Counter()
+        for stack, count in samples.items():
+            self_samples[self._label(stack[-1])] += count
+        return {
+            'folded': f"{base}.folded",
+            'pstats': f"{base}.pstats",
+            'seconds': elapsed,
+            'samples': total,
+            'top': [(label, count / total) for label, count in self_samples.most_common(10)] if total else [],
+        }
+
+    def _build_stats(self, samples: Counter, sample_seconds: float) -> Dict:
+        """Статистика в формате pstats: {(файл, строка, функция): (cc, nc, tt, ct, callers)}"""
+        stats: Dict[tuple, list] = {}
+        for stack, count in samples.items():
+            seconds = count * sample_seconds
+            keys = [(filename or '~', line, function) for filename, function, line in stack]
+            for depth, key in enumerate(keys):
+                entry = stats.setdefault(key, [0, 0, 0.0, 0.0, {}])
+                # Рекурсия: функция учитывается в сэмпле один раз
+                if key not in keys[:depth]:
+                    entry[0] += count
+                    entry[1] += count
+                    entry[3] += seconds
+                if depth:
+                    caller = entry[4].get(keys[depth - 1], (0, 0, 0.0, 0.0))
+                    entry[4][keys[depth - 1]] = (caller[0] + count, caller[1] + count,
+                                                 caller[2], caller[3] + seconds)
+            stats[keys[-1]][2] += seconds
+        return {key: (cc, nc, tt, ct, callers) for key, (cc, nc, tt, ct, callers) in stats.items()}
+
+
+def format_profile_summary(result: Dict) -> List[str]:
+    """Строки сводки для ответа администратору"""
+    lines = [f"{result['samples']} сэмплов за {result['seconds']:.0f} с"]
+    for label, share in result['top']:
+        lines.append(f"{share:6.1%}  {label}")
+    return lines
+
+
+# Глобальный профилировщик (запускается командой /profile)
+sampling_profiler = SamplingProfiler()
@@ -3,29 +3,47 @@ import schedule
 import threading
 import time
 from datetime import datetime, date
-from typing import List
+from typing import Dict, List, Optional, Tuple
 import logging
 
 from aiogram import Bot
-from database import Database
 from google_sheets import sheets_manager
+from app_context import app_context
 
 logger = logging.getLogger(__name__)
 
 class ReportScheduler:
-    def __init__(self, bot: Bot):
+    def __init__(self, bot: Bot, context=None):
         self.bot = bot
-        self.db = Database()  # Создаем экземпляр базы данных
+        # База и исходящий диспетчер общие для всего приложения
+        self.context = context or app_context
+        self.db = self.context.db
+        self.outbound = self.context.outbound
         self.is_running = False
         self.scheduler_thread = None
+        # Event loop бота: задачи расписания выполняются в нем, а не в потоке планировщика
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop_event = threading.Event()
+        self.report_job = None
+        self.reminder_job = None
+        # Флаг выставляется фоновым обновлением настроек, расписание меняет поток планировщика
+        self._reschedule_needed = threading.Event()
     
     def start(self):
-        """Запуск планировщика"""
+        """Запуск планировщика (из корутины: нужен работающий event loop бота)"""
         if self.is_running:
             return
         
+        self.loop = asyncio.get_running_loop()
+        self._stop_event.clear()
         self.is_running = True
         
+        # Настройки читаются из снимка Google Sheets, который обновляется в фоне;
+        # до первой загрузки снимка используется таблица settings
+        sheets_manager.fallback_db = self.db
+        sheets_manager.add_listener(self._on_settings_changed)
+        sheets_manager.start_background_refresh()
+        
         # Настраиваем расписание
         self._setup_schedule()
         
@@ -38,97 +56,134 @@ class ReportScheduler:
     def stop(self):
         """Остановка планировщика"""
         self.is_running = False
+        self._stop_event.set()
         if self.scheduler_thread:
             self.scheduler_thread.join(timeout=5)
+        for job in (self.report_job, self.reminder_job):
+            if job:
+                schedule.cancel_job(job)
+        schedule.clear('habits')
+        sheets_manager.stop_background_refresh()
         logger.info("Report scheduler stopped")
     
     def _setup_schedule(self):
         """Настройка расписания задач"""
+        # Ежедневные отчеты и напоминания о невыполненных целях
+        self._schedule_timed_jobs()
+        
+        # Планируем ежедневный отчет по привычкам в 00:00
+        schedule.every().day.at("00:00").do(self._schedule_habits_daily_report).tag('habits')
+        
+        # Планируем сброс счетчиков привычек в 00:01
+        schedule.every().day.at("00:01").do(self._schedule_habits_reset).tag('habits')
+        
+        logger.info("Scheduled habits daily report at 00:00")
+        logger.info("Scheduled habits reset at 00:01")
+    
+    def _schedule_timed_jobs(self):
+        """Планирование задач, время которых задается в настройках"""
         # Получаем время из настроек (по умолчанию 21:00 для отчетов, 20:00 для напоминаний)
         report_time = self._get_setting_with_fallback('report_time', '21:00')
         reminder_time = self._get_setting_with_fallback('reminder_time', '20:00')
         
+        if self.report_job:
+            schedule.cancel_job(self.report_job)
+        if self.reminder_job:
+            schedule.cancel_job(self.reminder_job)
+        
         # Планируем ежедневные отчеты
-        schedule.every().day.at(report_time).do(self._schedule_daily_reports)
+        self.report_job = schedule.every().day.at(report_time).do(self._schedule_daily_reports)
         
         # Планируем напоминания о невыполненных целях
-        schedule.every().day.at(reminder_time).do(self._schedule_goal_reminders)
-        
-        # Планируем ежедневный отчет по привычкам в 00:00
-        schedule.every().day.at("00:00").do(self._schedule_habits_daily_report)
-        
-        # Планируем сброс счетчиков привычек в 00:01
-        schedule.every().day.at("00:01").do(self._schedule_habits_reset)
+        self.reminder_job = schedule.every().day.at(reminder_time).do(self._schedule_goal_reminders)
         
         logger.info(f"Scheduled daily reports at {report_time}")
         logger.info(f"Scheduled goal reminders at {reminder_time}")
-        logger.info("Scheduled habits daily report at 00:00")
-        logger.info("Scheduled habits reset at 00:01")
+    
+    def _on_settings_changed(self, changed: dict):
+        """Реакция на обновление снимка настроек (вызывается из потока обновления)"""
+        if 'report_time' in changed or 'reminder_time' in changed:
+            self._reschedule_needed.set()
     
     def _get_setting_with_fallback(self, key: str, default: str) -> str:
-        """Получение настройки с fallback на базу данных"""
-        # Сначала пытаемся получить из Google Sheets
-        if sheets_manager.is_connected():
-            value = sheets_manager.get_setting(key)
-            if value:
-                return value
-        
-        # Если не получилось, берем из локальной базы
-        value = self.db.get_setting(key)
+        """Получение настройки из снимка Google Sheets с fallback на базу данных"""
+        value = sheets_manager.get_setting(key, fallback_db=self.db)
         return value if value else default
     
     def _run_scheduler(self):
         """Основной цикл планировщика"""
         while self.is_running:
+            if self._reschedule_needed.is_set():
+                self._reschedule_needed.clear()
+                self._schedule_timed_jobs()
             schedule.run_pending()
-            time.sleep(60)  # Проверяем каждую минуту
+            self._stop_event.wait(60)  # Проверяем каждую минуту
+    
+    def _submit(self, coro):
+        """Запуск корутины в event loop бота из потока планировщика"""
+        if self.loop is None or self.loop.is_closed():
+            logger.error(f"Event loop is not available, job {coro.__qualname__} skipped")
+            coro.close()
+            return
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self._log_job_error)
+    
+    @staticmethod
+    def _log_job_error(future):
+        """Ошибка задачи расписания, не перехваченная в ней самой"""
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Scheduled job failed: {future.exception()!r}")
     
     def _schedule_daily_reports(self):
         """Планирование отправки ежедневных отчетов"""
-        asyncio.create_task(self._send_daily_reports())
+        self._submit(self._send_daily_reports())
     
     def _schedule_goal_reminders(self):
         """Планирование отправки напоминаний о целях"""
-        asyncio.create_task(self._send_goal_reminders())
+        self._submit(self._send_goal_reminders())
     
     def _schedule_habits_daily_report(self):
         """Планирование отправки ежедневного отчета по привычкам"""
-        asyncio.create_task(self._send_habits_daily_report())
+        self._submit(self._send_habits_daily_report())
     
     def _schedule_habits_reset(self):
         """Планирование сброса счетчиков привычек"""
-        asyncio.create_task(self._reset_habits_counters())
+        self._submit(self._reset_habits_counters())
     
     async def _send_daily_reports(self):
         """Отправка ежедневных отчетов пользователям"""
         try:
             logger.info("Starting daily reports sending")
             
-            # Получаем всех пользователей с целями на сегодня
-            users_with_goals = self._get_users_with_daily_goals()
+            # Сначала все отчеты строятся из одного запроса, потом рассылаются:
+            # курсор базы не держится открытым, пока идет отправка
+            stages = {'query': 0.0, 'render': 0.0, 'send': 0.0}
+            reports = self._build_daily_reports(date.today(), stages)
             
+            started = time.perf_counter()
             sent_count = 0
-            for user_id in users_with_goals:
+            for user_id, report in reports:
                 try:
-                    report = await self._generate_daily_report(user_id)
-                    if report:
-                        await self.bot.send_message(
-                            chat_id=user_id,
-                            text=report,
-                            parse_mode="Markdown"
-                        )
-                        sent_count += 1
-                        
-                        # Небольшая задержка между отправками
-                        await asyncio.sleep(0.1)
+                    await self.outbound.send_message(
+                        chat_id=user_id,
+                        text=report,
+                        parse_mode="Markdown"
+                    )
+                    sent_count += 1
                         
                 except Exception as e:
                     logger.error(f"Failed to send daily report to user {user_id}: {e}")
                     # Если пользователь заблокировал бота, помечаем его как неактивного
                     if "bot was blocked" in str(e).lower():
                         self.db.update_user_status(user_id, 'blocked')
+            stages['send'] = time.perf_counter() - started
             
-            logger.info(f"Daily reports sent to {sent_count} users")
+            for stage, seconds in stages.items():
+                self.context.metrics.observe('daily_report_stage_seconds', seconds, stage=stage)
+            logger.info(
+                f"Daily reports sent to {sent_count}/{len(reports)} users "
+                f"(query {stages['query']:.3f}s, render {stages['render']:.3f}s, send {stages['send']:.3f}s)"
+            )
             
         except Exception as e:
             logger.error(f"Error in daily reports sending: {e}")
@@ -138,24 +193,21 @@ class ReportScheduler:
         try:
             logger.info("Starting goal reminders sending")
             
-            # Получаем пользователей с невыполненными целями на сегодня
-            users_with_incomplete_goals = self.db.get_users_with_incomplete_goals(date.today())
+            # Пользователи с невыполненными целями на сегодня вместе с текстами целей — один запрос
+            incomplete_goals = self.db.get_incomplete_daily_goals(date.today())
             
             sent_count = 0
-            for user_id in users_with_incomplete_goals:
+            for user_id, user_goals in incomplete_goals.items():
                 try:
-                    reminder = await self._generate_goal_reminder(user_id)
+                    reminder = self._generate_goal_reminder(user_goals['first_name'], user_goals['goals'])
                     if reminder:
-                        await self.bot.send_message(
+                        await self.outbound.send_message(
                             chat_id=user_id,
                             text=reminder,
                             parse_mode="Markdown"
                         )
                         sent_count += 1
                         
-                        # Небольшая задержка между отправками
-                        await asyncio.sleep(0.1)
-                        
                 except Exception as e:
                     logger.error(f"Failed to send goal reminder to user {user_id}: {e}")
                     # Если пользователь заблокировал бота, помечаем его как неактивного
@@ -167,108 +219,74 @@ class ReportScheduler:
         except Exception as e:
             logger.error(f"Error in goal reminders sending: {e}")
     
-    def _get_users_with_daily_goals(self) -> List[int]:
-        """Получение пользователей с ежедневными целями"""
-        # Это упрощенная версия - в реальности нужно более сложный запрос
-        return self.db.get_all_active_users()
+    def _build_daily_reports(self, target_date: date, stages: Dict[str, float]) -> List[Tuple[int, str]]:
+        """Отчеты всех пользователей с целями: группы целей читаются потоком из одного запроса"""
+        reports = []
+        groups = self.db.iter_report_goals(target_date)
+        while True:
+            started = time.perf_counter()
+            group = next(groups, None)
+            stages['query'] += time.perf_counter() - started
+            if group is None:
+                break
+            
+            user_id, daily_goals, monthly_goals = group
+            started = time.perf_counter()
+            reports.append((user_id, self._render_daily_report(daily_goals, monthly_goals)))
+            stages['render'] += time.perf_counter() - started
+        return reports
     
-    async def _generate_daily_report(self, user_id: int) -> str:
-        """Генерация ежедневного отчета для пользователя"""
-        try:
-            # Получаем цели пользователя на сегодня
-            daily_goals = self.db.get_user_goals(
-                user_id=user_id,
-                goal_type='daily',
-                date_filter=date.today()
-            )
-            
-            monthly_goals = self.db.get_user_goals(
-                user_id=user_id,
-                goal_type='monthly'
-            )
-            
-            if not daily_goals and not monthly_goals:
-                return None
-            
-            # Формируем отчет
-            report = "📊 **Ваш ежедневный отчет**\n\n"
-            
-            if daily_goals:
-                report += "📅 **Цели на сегодня:**\n"
-                completed_daily = 0
-                for goal in daily_goals:
-                    emoji = "✅" if goal['status'] == 'completed' else "⚡️"
-                    report += f"{emoji} {goal['goal_text']}\n"
-                    if goal['status'] == 'completed':
-                        completed_daily += 1
-                
-                # Статистика по ежедневным целям
-                if daily_goals:
-                    completion_rate = (completed_daily / len(daily_goals)) * 100
-                    report += f"\n📈 Выполнено: {completed_daily}/{len(daily_goals)} ({completion_rate:.0f}%)\n"
-            
-            if monthly_goals:
-                report += "\n📆 **Цели на месяц:**\n"
-                completed_monthly = 0
-                for goal in monthly_goals:
-                    emoji = "✅" if goal['status'] == 'completed' else "⚡️"
-                    progress_info = ""
-                    if goal.get('progress_data'):
-                        progress_info = f" ({goal['progress_data']})"
-                    report += f"{emoji} {goal['goal_text']}{progress_info}\n"
-                    if goal['status'] == 'completed':
-                        completed_monthly += 1
-                
-                # Статистика по месячным целям
-                if monthly_goals:
-                    completion_rate = (completed_monthly / len(monthly_goals)) * 100
-                    report += f"\n📈 Выполнено: {completed_monthly}/{len(monthly_goals)} ({completion_rate:.0f}%)\n"
-            
-            # Мотивационное сообщение
-            if daily_goals and all(goal['status'] == 'completed' for goal in daily_goals):
-                report += "\n🎉 **Поздравляем! Все цели на сегодня выполнены!**"
-            elif daily_goals:
-                incomplete_count = len([g for g in daily_goals if g['status'] != 'completed'])
-                report += f"\n💪 **Осталось выполнить: {incomplete_count} целей. Вы можете это сделать!**"
-            
-            return report
-            
-        except Exception as e:
-            logger.error(f"Error generating daily report for user {user_id}: {e}")
-            return None
+    def _render_goals_section(self, title: str, goals: List[Dict], with_progress: bool = False) -> Tuple[str, int]:
+        """Раздел отчета и число выполненных целей за один проход"""
+        section = title
+        completed = 0
+        for goal in goals:
+            is_completed = goal['status'] == 'completed'
+            completed += is_completed
+            emoji = "✅" if is_completed else "⚡️"
+            progress_info = f" ({goal['progress_data']})" if with_progress and goal.get('progress_data') else ""
+            section += f"{emoji} {goal['goal_text']}{progress_info}\n"
+        
+        completion_rate = (completed / len(goals)) * 100
+        section += f"\n📈 Выполнено: {completed}/{len(goals)} ({completion_rate:.0f}%)\n"
+        return section, completed
+    
+    def _render_daily_report(self, daily_goals: List[Dict], monthly_goals: List[Dict]) -> str:
+        """Текст ежедневного отчета"""
+        report = "📊 **Ваш ежедневный отчет**\n\n"
+        
+        completed_daily = 0
+        if daily_goals:
+            section, completed_daily = self._render_goals_section("📅 **Цели на сегодня:**\n", daily_goals)
+            report += section
+        
+        if monthly_goals:
+            section, _ = self._render_goals_section("\n📆 **Цели на месяц:**\n", monthly_goals, with_progress=True)
+            report += section
+        
+        # Мотивационное сообщение
+        if daily_goals and completed_daily == len(daily_goals):
+            report += "\n🎉 **Поздравляем! Все цели на сегодня выполнены!**"
+        elif daily_goals:
+            incomplete_count = len(daily_goals) - completed_daily
+            report += f"\n💪 **Осталось выполнить: {incomplete_count} целей. Вы можете это сделать!**"
+        
+        return report
     
-    async def _generate_goal_reminder(self, user_id: int) -> str:
+    def _generate_goal_reminder(self, first_name: Optional[str], incomplete_goals: List[str]) -> Optional[str]:
         """Генерация напоминания о невыполненных целях"""
-        try:
-            # Получаем невыполненные цели на сегодня
-            incomplete_goals = [
-                goal for goal in self.db.get_user_goals(
-                    user_id=user_id,
-                    goal_type='daily',
-                    date_filter=date.today()
-                )
-                if goal['status'] != 'completed'
-            ]
-            
-            if not incomplete_goals:
-                return None
-            
-            user = self.db.get_user(user_id)
-            first_name = user['first_name'] if user else "Друг"
-            
-            reminder = f"⏰ **Напоминание, {first_name}!**\n\n"
-            reminder += f"У вас есть {len(incomplete_goals)} невыполненных целей на сегодня:\n\n"
-            
-            for goal in incomplete_goals:
-                reminder += f"⚡️ {goal['goal_text']}\n"
-            
-            reminder += "\n💪 **Время действовать! Каждый шаг приближает вас к успеху!**"
-            
-            return reminder
-            
-        except Exception as e:
-            logger.error(f"Error generating goal reminder for user {user_id}: {e}")
+        if not incomplete_goals:
             return None
+        
+        reminder = f"⏰ **Напоминание, {first_name or 'Друг'}!**\n\n"
+        reminder += f"У вас есть {len(incomplete_goals)} невыполненных целей на сегодня:\n\n"
+        
+        for goal_text in incomplete_goals:
+            reminder += f"⚡️ {goal_text}\n"
+        
+        reminder += "\n💪 **Время действовать! Каждый шаг приближает вас к успеху!**"
+        
+        return reminder
     
     async def send_broadcast_message(self, message: str, parse_mode: str = "Markdown"):
         """Отправка сообщения всем активным пользователям"""
@@ -279,16 +297,13 @@ class ReportScheduler:
             
             for user_id in active_users:
                 try:
-                    await self.bot.send_message(
+                    await self.outbound.send_message(
                         chat_id=user_id,
                         text=message,
                         parse_mode=parse_mode
                     )
                     sent_count += 1
                     
-                    # Небольшая задержка между отправками
-                    await asyncio.sleep(0.1)
-                    
                 except Exception as e:
                     failed_count += 1
                     logger.error(f"Failed to send broadcast to user {user_id}: {e}")
@@ -317,16 +332,13 @@ class ReportScheduler:
                 try:
                     report = await self._generate_habits_daily_report(user_id)
                     if report:
-                        await self.bot.send_message(
+                        await self.outbound.send_message(
                             chat_id=user_id,
                             text=report,
                             parse_mode="Markdown"
                         )
                         sent_count += 1
                         
-                        # Небольшая задержка между отправками
-                        await asyncio.sleep(0.1)
-                        
                 except Exception as e:
                     logger.error(f"Failed to send habits daily report to user {user_id}: {e}")
                     # Если пользователь заблокировал бота, помечаем его как неактивного
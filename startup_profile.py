@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Профиль запуска бота: время импортов, инициализации сервисов и первого апдейта.
+
+Во время работы бот пишет в лог разбивку по этапам при получении первого
+апдейта. Разбивка импортов по пакетам (python -X importtime):
+    BOT_TOKEN=... python3 startup_profile.py --module bot --top 15
+"""
+
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class StartupProfile:
+    def __init__(self):
+        # Отсчет от импорта модуля: bot.py импортирует его раньше тяжелых библиотек
+        self.started_at = time.perf_counter()
+        self.stages: List[Tuple[str, float]] = []
+        self.first_update_after: Optional[float] = None
+        self._last_mark = self.started_at
+
+    def elapsed(self) -> float:
+        """Секунды с начала запуска"""
+        return time.perf_counter() - self.started_at
+
+    def mark(self, name: str):
+        """Завершение этапа: время с предыдущей отметки"""
+        now = time.perf_counter()
+        self.stages.append((name, now - self._last_mark))
+        self._last_mark = now
+
+    @contextmanager
+    def stage(self, name: str):
+        """Замер отдельного этапа инициализации"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, time.perf_counter() - started))
+            self._last_mark = time.perf_counter()
+
+    def on_first_update(self) -> bool:
+        """Отметка первого апдейта; True только для самого первого"""
+        if self.first_update_after is not None:
+            return False
+        self.first_update_after = self.elapsed()
+        logger.info(self.report())
+        return True
+
+    def report(self) -> str:
+        """Текстовый отчет о запуске"""
+        lines = ["Startup profile:"]
+        for name, seconds in self.stages:
+            lines.append(f"  {name:<32} {seconds * 1000:9.1f} ms")
+        if self.first_update_after is not None:
+            lines.append(f"  {'time to first update':<32} {self.first_update_after * 1000:9.1f} ms")
+        return "\n".join(lines)
+
+
+def import_breakdown(module: str = 'bot') -> Tuple[List[Tuple[str, int, int]], int]:
+    """Время импорта по пакетам верхнего уровня: [(пакет, собственное мкс, модулей)], всего мкс"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, env=os.environ.copy()
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+
+    packages = {}
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        spent, count = packages.get(package, (0, 0))
+        packages[package] = (spent + int(self_us), count + 1)
+        if name.strip() == module:
+            total = int(cumulative_us)
+
+    rows = sorted(((name, spent, count) for name, (spent, count) in packages.items()),
+                  key=lambda row: row[1], reverse=True)
+    return rows, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Разбивка времени импорта по пакетам")
+    parser.add_argument('--module', default='bot', help="Модуль, импорт которого замеряется")
+    parser.add_argument('--top', type=int, default=15, help="Сколько пакетов показать")
+    args = parser.parse_args()
+
+    rows, total = import_breakdown(args.module)
+    print(f"import {args.module}: {total / 1000:.1f} ms")
+    print(f"{'package':<32} {'self, ms':>10} {'modules':>8}")
+    for name, spent, count in rows[:args.top]:
+        print(f"{name:<32} {spent / 1000:10.1f} {count:8d}")
+
+
+# Глобальный профиль запуска
+startup_profile = StartupProfile()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+Легковесная трассировка запросов: обработчик -> база -> Bot API.
+
+Текущий спан хранится в contextvars, поэтому вложенные вызовы (методы
+Database, отправки через исходящий диспетчер, запросы к Bot API) попадают
+в трассу обработчика без явной передачи контекста, в том числе в задачи
+asyncio, созданные внутри обработчика. Вне трассы спаны не создаются, и
+обертка стоит одного ContextVar.get.
+
+Трассы выбираются с вероятностью TRACE_SAMPLE_RATE (0..1, по умолчанию 0).
+С TRACE_SLOW_MS записываются все запросы, а сохраняются выбранные и те,
+что дольше порога. Трасса пишется одной строкой JSON в TRACE_EXPORT
+(по умолчанию traces.jsonl).
+
+Просмотр водопадов:
+    python3 tracing.py --file traces.jsonl --name quick_habit --slowest 5
+    python3 tracing.py --file traces.jsonl --summary
+    python3 tracing.py --file traces.jsonl --chrome traces_chrome.json   # chrome://tracing, Perfetto
+"""
+
+import argparse
+import functools
+import inspect
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Спанов в одной трассе не больше: циклы по привычкам не раздувают память
+MAX_SPANS_PER_TRACE = 500
+
+
+class Trace:
+    __slots__ = ('trace_id', 'started_at', 'started', 'spans', 'dropped')
+
+    def __init__(self):
+        self.trace_id = f"{random.getrandbits(64):016x}"
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.spans: List["Span"] = []
+        self.dropped = 0
+
+    def start_span(self, name: str, parent_id: Optional[str], attrs: Dict) -> Optional["Span"]:
+        """Новый спан трассы или None, если лимит спанов исчерпан"""
+        if len(self.spans) >= MAX_SPANS_PER_TRACE:
+            self.dropped += 1
+            return None
+        span = Span(self, name, parent_id, attrs)
+        self.spans.append(span)
+        return span
+
+    def to_dict(self) -> Dict:
+        root = self.spans[0]
+        return {
+            'trace_id': self.trace_id,
+            'name': root.name,
+            'ts': datetime.fromtimestamp(self.started_at).isoformat(timespec='milliseconds'),
+            'duration_ms': round(root.duration * 1000, 3),
+            'dropped_spans': self.dropped,
+            'spans': [span.to_dict() for span in self.spans],
+        }
+
+
+class Span:
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'attrs', 'started', 'duration', 'error')
+
+    def __init__(self, trace: Trace, name: str, parent_id: Optional[str], attrs: Dict):
+        self.trace = trace
+        self.span_id = f"{random.getrandbits(32):08x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = attrs
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.error = None
+
+    def set(self, **attrs):
+        """Дополнительные атрибуты спана"""
+        self.attrs.update(attrs)
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+
+    def to_dict(self) -> Dict:
+        span = {
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start_ms': round((self.started - self.trace.started) * 1000, 3),
+            'duration_ms': round(self.duration * 1000, 3),
+        }
+        if self.attrs:
+            span['attrs'] = self.attrs
+        if self.error:
+            span['error'] = self.error
+        return span
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar('current_span', default=None)
+
+
+def current_span() -> Optional[Span]:
+    """Текущий спан или None вне трассы"""
+    return _current_span.get()
+
+
+class Tracer:
+    def __init__(self, sample_rate: float = None, slow_ms: float = None, export_path: str = None):
+        self.sample_rate = sample_rate if sample_rate is not None else float(os.getenv('TRACE_SAMPLE_RATE', '0'))
+        if slow_ms is None and os.getenv('TRACE_SLOW_MS'):
+            slow_ms = float(os.getenv('TRACE_SLOW_MS'))
+        self.slow_seconds = slow_ms / 1000 if slow_ms is not None else None
+        self.export_path = export_path or os.getenv('TRACE_EXPORT', 'traces.jsonl')
+        self.enabled = self.sample_rate > 0 or self.slow_seconds is not None
+        self._lock = threading.Lock()
+        self.exported = 0
+
+    @contextmanager
+    def _activate(self, span: Optional[Span]):
+        """Спан становится текущим на время блока"""
+        if span is None:
+            yield None
+            return
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            _current_span.reset(token)
+            span.finish()
+
+    @contextmanager
+    def trace(self, name: str, **attrs):
+        """Корневой спан запроса; внутри другой трассы — обычный дочерний спан"""
+        parent = _current_span.get()
+        if parent is not None:
+            with self._activate(parent.trace.start_span(name, parent.span_id, attrs)) as span:
+                yield span
+            return
+
+        sampled = self.enabled and random.random() < self.sample_rate
+        if not sampled and self.slow_seconds is None:
+            yield None
+            return
+
+        trace = Trace()
+        root = trace.start_span(name, None, attrs)
+        try:
+            with self._activate(root):
+                yield root
+        finally:
+            if sampled or root.duration >= self.slow_seconds:
+                self._export(trace)
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """Дочерний спан текущей трассы (вне трассы ничего не записывается)"""
+        parent = _current_span.get()
+        if parent is None:
+            yield None
+            return
+        with self._activate(parent.trace.start_span(name, parent.span_id, attrs)) as span:
+            yield span
+
+    async def request_middleware(self, make_request, bot, method):
+        """Middleware сессии aiogram: спан на каждый вызов Bot API"""
+        if _current_span.get() is None:
+            return await make_request(bot, method)
+        with self.span(f"bot.{method.__api_method__}"):
+            return await make_request(bot, method)
+
+    def _export(self, trace: Trace):
+        """Запись трассы строкой JSON"""
+        line = json.dumps(trace.to_dict(), ensure_ascii=False, default=str)
+        with self._lock:
+            try:
+                with open(self.export_path, 'a', encoding='utf-8') as export_file:
+                    export_file.write(line + '\n')
+                self.exported += 1
+            except OSError as e:
+                logger.error(f"Error writing trace: {e}")
+
+
+def trace_methods(prefix: str):
+    """Декоратор класса: спан prefix.method на каждый вызов публичного метода внутри трассы.
+
+    Генераторы не оборачиваются — их вызов только создает итератор.
+    """
+    def decorator(cls):
+        for name, member in list(vars(cls).items()):
+            if name.startswith('_') or not inspect.isfunction(member) or inspect.isgeneratorfunction(member):
+                continue
+            setattr(cls, name, _traced(f"{prefix}.{name}", member))
+        return cls
+    return decorator
+
+
+def _traced(span_name: str, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _current_span.get() is None:
+            return func(*args, **kwargs)
+        with tracer.span(span_name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def load_traces(path: str, name: str = None) -> List[Dict]:
+    """Трассы из файла, при необходимости только с подстрокой name в имени"""
+    traces = []
+    with open(path, encoding='utf-8') as trace_file:
+        for line in trace_file:
+            try:
+                trace = json.loads(line)
+            except ValueError:
+                continue
+            if name is None or name in trace['name']:
+                traces.append(trace)
+    return traces
+
+
+def render_waterfall(trace: Dict, width: int = 50) -> str:
+    """Водопад трассы: вложенность спанов и их положение на шкале времени"""
+    total = trace['duration_ms'] or 1.0
+    children: Dict[Optional[str], List[Dict]] = {}
+    for span in trace['spans']:
+        children.setdefault(span['parent_id'], []).append(span)
+
+    lines = [f"{trace['ts']}  {trace['name']}  {trace['duration_ms']:.1f} мс  trace {trace['trace_id']}"]
+
+    def walk(span: Dict, depth: int):
+        offset = int(span['start_ms'] / total * width)
+        length = max(int(span['duration_ms'] / total * width), 1)
+        bar = " " * offset + "█" * min(length, width - offset)
+        label = "  " * depth + span['name'] + (f" [{span['error']}]" if span.get('error') else "")
+        lines.append(f"  {label:45.45s} {span['duration_ms']:9.2f} мс |{bar:{width}s}|")
+        for child in sorted(children.get(span['span_id'], []), key=lambda item: item['start_ms']):
+            walk(child, depth + 1)
+
+    for root in children.get(None, []):
+        walk(root, 0)
+        # Время вне дочерних спанов: код обработчика, рендеринг текста и клавиатур
+        self_ms = root['duration_ms'] - sum(child['duration_ms'] for child in children.get(root['span_id'], []))
+        lines.append(f"  {'(собственное время обработчика)':45s} {self_ms:9.2f} мс")
+    if trace.get('dropped_spans'):
+        lines.append(f"  ... еще {trace['dropped_spans']} спанов не записано")
+    return "\n".join(lines)
+
+
+def summarize_spans(traces: List[Dict]) -> List[Dict]:
+    """Суммарное время по именам спанов во всех трассах"""
+    summary: Dict[str, Dict] = {}
+    for trace in traces:
+        for span in trace['spans']:
+            item = summary.setdefault(span['name'], {'name': span['name'], 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            item['count'] += 1
+            item['total_ms'] += span['duration_ms']
+            item['max_ms'] = max(item['max_ms'], span['duration_ms'])
+    return sorted(summary.values(), key=lambda item: item['total_ms'], reverse=True)
+
+
+def to_chrome_trace(traces: List[Dict]) -> Dict:
+    """Трассы в формате Chrome Trace Event (chrome://tracing, ui.perfetto.dev)"""
+    events = []
+    for index, trace in enumerate(traces):
+        started_us = datetime.fromisoformat(trace['ts']).timestamp() * 1_000_000
+        for span in trace['spans']:
+            events.append({
+                'name': span['name'],
+                'ph': 'X',
+                'ts': started_us + span['start_ms'] * 1000,
+                'dur': span['duration_ms'] * 1000,
+                'pid': 1,
+                'tid': index,
+                'args': dict(span.get('attrs', {}), trace_id=trace['trace_id']),
+            })
+    return {'traceEvents': events}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Просмотр трасс запросов")
+    parser.add_argument('--file', default=os.getenv('TRACE_EXPORT', 'traces.jsonl'))
+    parser.add_argument('--name', help="Только трассы с подстрокой в имени (например, quick_habit)")
+    parser.add_argument('--trace-id', help="Одна трасса по идентификатору")
+    parser.add_argument('--slowest', type=int, default=5, help="Сколько самых медленных трасс показать")
+    parser.add_argument('--summary', action='store_true', help="Время по именам спанов вместо водопадов")
+    parser.add_argument('--chrome', help="Сохранить выбранные трассы в формате Chrome Trace Event")
+    args = parser.parse_args()
+
+    traces = load_traces(args.file, args.name)
+    if args.trace_id:
+        traces = [trace for trace in traces if trace['trace_id'] == args.trace_id]
+    traces.sort(key=lambda trace: trace['duration_ms'], reverse=True)
+
+    if args.chrome:
+        with open(args.chrome, 'w', encoding='utf-8') as chrome_file:
+            json.dump(to_chrome_trace(traces), chrome_file, ensure_ascii=False)
+        print(f"{len(traces)} трасс сохранено в {args.chrome}")
+        return
+
+    if args.summary:
+        for item in summarize_spans(traces):
+            print(f"{item['name']:45.45s} {item['count']:7d} раз  всего {item['total_ms']:10.1f} мс  "
+                  f"в среднем {item['total_ms'] / item['count']:8.2f} мс  макс. {item['max_ms']:8.2f} мс")
+        return
+
+    for trace in traces[:args.slowest]:
+        print(render_waterfall(trace))
+        print()
+
+
+# Глобальный трассировщик (включается TRACE_SAMPLE_RATE или TRACE_SLOW_MS)
+tracer = Tracer()
+
+
+if __name__ == "__main__":
+    main()